@@ -0,0 +1,207 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Runs the changes planned by update_bridges on a small pool of threads.
+#
+# Each change is a task of one of the ACTIONS types that may name tasks it
+# has to wait for (e.g. a port attach waits for its bridge to be created)
+# and the libvirt domain it touches.  Tasks on the same domain run in the
+# order they were added; everything else runs as soon as what it waits
+# for is done.  Each task records its wall time and the number of
+# privileged commands it ran.
+
+import logging as LOG
+import threading
+import time
+
+from collections import deque
+
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+
+
+DESTROY_PORT = "destroy-port"
+DESTROY_BRIDGE = "destroy-bridge"
+CREATE_BRIDGE = "create-bridge"
+CREATE_PORT = "create-port"
+UPDATE_PORT = "update-port"
+
+ACTIONS = [DESTROY_PORT, DESTROY_BRIDGE, CREATE_BRIDGE, CREATE_PORT, UPDATE_PORT]
+
+
+# Exception thrown by a task when the change it makes could not be made;
+# the task fails, and the tasks that require it are skipped.
+class ActuationError(Exception):
+    pass
+
+
+class ActuationTask(object):
+
+    def __init__(self, action, target, func, args, requires, after, domain):
+        self.action = action
+        self.target = target
+        self.name = action + " " + target
+        self.func = func
+        self.args = args
+        # Tasks that must have succeeded for this one to run.
+        self.requires = requires
+        # All tasks that must have finished first: requires, plus the
+        # previous task on the same domain.
+        self.after = after
+        self.domain = domain
+        self.dependents = []
+        self.failed = False
+        self.skipped = False
+        # Cost of running the task: wall time and privileged commands.
+        self.elapsed = 0.0
+        self.commands = 0
+
+    def __str__(self):
+        desc = self.name
+        if self.domain is not None:
+            desc += " [domain " + str(self.domain) + "]"
+        if self.requires:
+            desc += " (after " + ", ".join(t.name for t in self.requires) + ")"
+        return desc
+
+    def run(self):
+        for task in self.requires:
+            if task.failed:
+                LOG.error("Skipping " + self.name + ": " + task.name + " failed")
+                self.failed = True
+                self.skipped = True
+                return
+
+        start = time.time()
+        commands = RootHelper.commands_run()
+        try:
+            self.func(*self.args)
+        except Exception:
+            LOG.exception("Failed to " + self.name)
+            self.failed = True
+        self.elapsed = time.time() - start
+        self.commands = RootHelper.commands_run() - commands
+
+
+class ActuationPlan(object):
+
+    def __init__(self):
+        self.tasks = []
+        self.last_on_domain = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, action, target, func, args=(), after=(), domain=None):
+        """Add a task calling func(*args) once the tasks in after (None
+        entries are ignored) have succeeded and earlier tasks on domain
+        have finished."""
+        requires = [t for t in after if t is not None]
+        after = list(requires)
+        if domain is not None:
+            previous = self.last_on_domain.get(domain)
+            if previous is not None and previous not in after:
+                after.append(previous)
+
+        task = ActuationTask(action, target, func, args, requires, after, domain)
+        for t in after:
+            t.dependents.append(task)
+        if domain is not None:
+            self.last_on_domain[domain] = task
+        self.tasks.append(task)
+        return task
+
+    def describe(self):
+        """One line per task, in the order they were planned."""
+        return [str(task) for task in self.tasks]
+
+    def costs(self):
+        """Per action type: (tasks, failed, total seconds, total commands)."""
+        costs = {}
+        for task in self.tasks:
+            (count, failed, elapsed, commands) = costs.get(task.action, (0, 0, 0.0, 0))
+            costs[task.action] = (count + 1, failed + int(task.failed),
+                                  elapsed + task.elapsed, commands + task.commands)
+        return costs
+
+
+def run_plan(plan, workers):
+    """Run all tasks of plan on up to workers threads; returns the number
+    of tasks that failed or were skipped."""
+    if not plan.tasks:
+        return 0
+
+    start = time.time()
+    if workers <= 1 or len(plan.tasks) == 1:
+        # Tasks only wait for tasks added before them, so the order they
+        # were added in is a valid serial order.
+        for task in plan.tasks:
+            task.run()
+    else:
+        _run_parallel(plan.tasks, workers)
+
+    for task in plan.tasks:
+        if task.skipped:
+            metrics.ACTIONS.inc(1, task.action, "skipped")
+            continue
+        metrics.ACTIONS.inc(1, task.action, task.failed and "failed" or "ok")
+        metrics.ACTION_SECONDS.observe(task.elapsed, task.action)
+
+    failed = len([t for t in plan.tasks if t.failed])
+    LOG.info("Ran %d actuation tasks (%d failed) in %.2fs" %
+             (len(plan.tasks), failed, time.time() - start))
+    costs = plan.costs()
+    for action in ACTIONS:
+        if action in costs:
+            LOG.info("  %s: %d tasks, %d failed, %.2fs, %d commands" %
+                     ((action,) + costs[action]))
+    return failed
+
+
+def _run_parallel(tasks, workers):
+    cond = threading.Condition()
+    waiting_for = dict((task, len(task.after)) for task in tasks)
+    ready = deque(task for task in tasks if not task.after)
+    state = {"unfinished": len(tasks)}
+
+    def worker():
+        while True:
+            with cond:
+                while not ready and state["unfinished"]:
+                    cond.wait()
+                if not ready:
+                    return
+                task = ready.popleft()
+
+            task.run()
+
+            with cond:
+                for dependent in task.dependents:
+                    waiting_for[dependent] -= 1
+                    if not waiting_for[dependent]:
+                        ready.append(dependent)
+                state["unfinished"] -= 1
+                cond.notify_all()
+
+    threads = []
+    for i in range(min(workers, len(tasks))):
+        t = threading.Thread(target=worker, name="neuca-actuation-%d" % i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
@@ -0,0 +1,86 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Local checkpoint of the desired state the agent last applied in full.
+#
+# The state is kept as compact JSON: the bridges with their ports, and the
+# libvirt instances and neuca_generation rows it was read for.  The file
+# is replaced atomically (written to a temporary file in the same
+# directory, synced and renamed over the old one), so that a crash leaves
+# either the previous checkpoint or the new one, never a mix.
+
+import errno
+import json
+import logging as LOG
+import os
+import tempfile
+
+
+STATE_FILE = '/var/lib/neuca/agent-state.json'
+
+# Bumped whenever the layout below changes; checkpoints of another
+# version are ignored.
+FORMAT_VERSION = 1
+
+
+def save(path, state):
+    """Atomically replace the checkpoint at path with state (a dict)."""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    state = dict(state, version=FORMAT_VERSION)
+    (fd, tmp_path) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(state, f, separators=(',', ':'), sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load(path):
+    """The state saved at path, or None if there is no usable checkpoint."""
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            LOG.error("Unable to read checkpoint %s: %s" % (path, str(e)))
+        return None
+
+    try:
+        try:
+            state = json.load(f)
+        except ValueError, e:
+            LOG.error("Ignoring corrupt checkpoint %s: %s" % (path, str(e)))
+            return None
+    finally:
+        f.close()
+
+    if not isinstance(state, dict) or state.get('version') != FORMAT_VERSION:
+        LOG.warn("Ignoring checkpoint %s of an unknown format" % path)
+        return None
+    return state
@@ -0,0 +1,138 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Index of the network interfaces of all running libvirt domains, keyed by
+# target device name.  Built once per agent cycle; a domain's XML is only
+# re-parsed when it differs from what was seen in the previous cycle.
+
+import hashlib
+import logging as LOG
+import libxml2
+
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent import snapshot
+
+
+class DomainInterface(object):
+
+    __slots__ = ("dev", "domain", "mac", "model", "bridge")
+
+    def __init__(self, dev, domain, mac, model, bridge):
+        self.dev = dev
+        self.domain = domain
+        self.mac = mac
+        self.model = model
+        self.bridge = bridge
+
+    def __str__(self):
+        return "dev: "      + str(self.dev) + \
+               ", domain: " + str(self.domain) + \
+               ", mac: "    + str(self.mac) + \
+               ", model: "  + str(self.model) + \
+               ", bridge: " + str(self.bridge)
+
+
+def _prop(node, path, attr):
+    found = node.xpathEval(path)
+    if not found:
+        return None
+    value = found[0].prop(attr)
+    if value is None:
+        return None
+    return str(value)
+
+
+def parse_domain_interfaces(dom_name, xml):
+    interfaces = []
+    doc = libxml2.parseDoc(xml)
+    ctxt = doc.xpathNewContext()
+    try:
+        for node in ctxt.xpathEval('//domain/devices/interface'):
+            dev = _prop(node, 'target', 'dev')
+            if dev is None:
+                # Not plugged into the host (yet); nothing to index by.
+                continue
+            interfaces.append(DomainInterface(dev, dom_name,
+                                              _prop(node, 'mac', 'address'),
+                                              _prop(node, 'model', 'type'),
+                                              _prop(node, 'source', 'bridge')))
+    finally:
+        ctxt.xpathFreeContext()
+        doc.freeDoc()
+    return interfaces
+
+
+class DomainInterfaceIndex(object):
+
+    def __init__(self):
+        # domain UUID -> (XML digest, [DomainInterface, ...])
+        self.domains = {}
+        # target dev -> DomainInterface
+        self.by_dev = {}
+        self.built = False
+        # Changes whenever a domain is added, removed or redefined.
+        self.fingerprint = None
+
+    def refresh(self, domains):
+        """Rebuild the index from a list of running libvirt domains."""
+        by_dev = {}
+        seen = set()
+        parsed = 0
+
+        for dom in domains:
+            try:
+                metrics.LIBVIRT_CALLS.inc()
+                uuid = dom.UUIDString()
+                xml = dom.XMLDesc(0)
+            except Exception:
+                # Domain went away since it was listed.
+                LOG.debug('libvirt failed to describe domain')
+                continue
+
+            digest = hashlib.sha1(xml).hexdigest()
+            cached = self.domains.get(uuid)
+            if cached is None or cached[0] != digest:
+                cached = (digest, parse_domain_interfaces(dom.name(), xml))
+                self.domains[uuid] = cached
+                parsed += 1
+
+            seen.add(uuid)
+            for iface in cached[1]:
+                by_dev[iface.dev] = iface
+
+        for uuid in self.domains.keys():
+            if uuid not in seen:
+                del self.domains[uuid]
+
+        self.by_dev = by_dev
+        self.built = True
+        self.fingerprint = snapshot.fingerprint(
+            frozenset((uuid, cached[0]) for (uuid, cached) in self.domains.items()))
+        LOG.debug("Domain interface index: %d domains, %d interfaces, %d parsed" %
+                  (len(seen), len(by_dev), parsed))
+
+    def lookup(self, dev):
+        return self.by_dev.get(dev)
+
+    def get_mac(self, dev, default="not found"):
+        iface = self.by_dev.get(dev)
+        if iface is None or iface.mac is None:
+            return default
+        return iface.mac
+
+    def iface_to_vm_dict(self):
+        return dict((dev, iface.domain) for (dev, iface) in self.by_dev.items())
@@ -0,0 +1,244 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Change notifications that let the agent reconcile only when something
+# happened, instead of polling every REFRESH_INTERVAL.
+#
+# An event source is any object with start() and stop() methods that calls
+# ReconcileTrigger.notify() when the host state may have changed; tests can
+# hand the agent their own sources in place of the ones below.
+
+import logging as LOG
+import socket
+import threading
+import time
+
+from quantum.plugins.neuca.agent.ovsdb_client import OVSDB_Client, OVSDBError
+
+
+# Time to wait after an event before reconciling, so that a burst of
+# events (e.g. a VM boot adding several interfaces) costs one cycle.
+EVENT_SETTLE_INTERVAL = 0.5
+
+# Delay between attempts to re-establish a lost event connection.
+RECONNECT_INTERVAL = 5
+
+
+class ReconcileTrigger(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.reasons = []
+
+    def notify(self, reason):
+        with self.cond:
+            self.reasons.append(reason)
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for an event; returns the reasons seen
+        (an empty list means the timeout expired)."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while not self.reasons:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+
+        time.sleep(EVENT_SETTLE_INTERVAL)
+        with self.cond:
+            reasons = self.reasons
+            self.reasons = []
+        return reasons
+
+
+class LibvirtEventSource(object):
+
+    def __init__(self, trigger, uri="qemu:///system", libvirt_module=None):
+        if libvirt_module is None:
+            import libvirt as libvirt_module
+        self.libvirt = libvirt_module
+        self.trigger = trigger
+        self.uri = uri
+        self.conn = None
+        self.running = False
+        self.loop_thread = None
+        self.watch_thread = None
+
+    def _lifecycle_cb(self, conn, dom, event, detail, opaque):
+        interesting = (self.libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                       self.libvirt.VIR_DOMAIN_EVENT_UNDEFINED,
+                       self.libvirt.VIR_DOMAIN_EVENT_STARTED,
+                       self.libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        if event in interesting:
+            try:
+                name = dom.name()
+            except Exception:
+                name = "unknown"
+            LOG.debug("libvirt lifecycle event %d for domain %s" % (event, name))
+            self.trigger.notify("libvirt:" + name)
+
+    def _close_cb(self, conn, reason, opaque):
+        LOG.info("libvirt event connection closed (reason %d)" % reason)
+        self.conn = None
+
+    def _run_event_loop(self):
+        while self.running:
+            try:
+                self.libvirt.virEventRunDefaultImpl()
+            except Exception:
+                LOG.exception("Error in libvirt event loop")
+                time.sleep(RECONNECT_INTERVAL)
+
+    def _connect(self):
+        conn = self.libvirt.openReadOnly(self.uri)
+        conn.domainEventRegisterAny(None, self.libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                    self._lifecycle_cb, None)
+        try:
+            conn.registerCloseCallback(self._close_cb, None)
+        except AttributeError:
+            pass
+        self.conn = conn
+        LOG.info("Registered for libvirt lifecycle events on " + self.uri)
+
+    def _watch_connection(self):
+        # Re-register after libvirtd restarts; we may have missed events
+        # in between, so ask for a reconcile once reconnected.
+        while self.running:
+            if self.conn is None or not self.conn.isAlive():
+                try:
+                    self._connect()
+                    self.trigger.notify("libvirt:reconnect")
+                except Exception, e:
+                    LOG.debug("Unable to register for libvirt events: " + str(e))
+                    self.conn = None
+            time.sleep(RECONNECT_INTERVAL)
+
+    def start(self):
+        # Must be done before the connection used for events is opened.
+        self.libvirt.virEventRegisterDefaultImpl()
+        self.running = True
+        self.loop_thread = threading.Thread(target=self._run_event_loop)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self.watch_thread = threading.Thread(target=self._watch_connection)
+        self.watch_thread.daemon = True
+        self.watch_thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+
+class OVSDBMonitorSource(object):
+
+    # Only columns whose changes matter to the agent.  The QoS columns are
+    # among them: the agent writes them itself, which costs one more cycle
+    # that finds nothing to change, but anything else resetting them has
+    # to be undone.
+    MONITOR_REQUESTS = {
+        "Bridge": {"columns": ["name", "ports"]},
+        "Port": {"columns": ["name", "interfaces"]},
+        "Interface": {"columns": ["name", "external_ids", "ingress_policing_rate",
+                                  "ingress_policing_burst"]},
+    }
+
+    def __init__(self, trigger, connection, client=None):
+        self.trigger = trigger
+        self.connection = connection
+        self.client = client
+        self.running = False
+        self.thread = None
+
+    def _run(self):
+        while self.running:
+            try:
+                if self.client is None:
+                    self.client = OVSDB_Client(self.connection)
+                self.client.monitor(self.MONITOR_REQUESTS)
+                LOG.info("Monitoring ovsdb-server at " + self.connection)
+                # Changes may have happened while we were not monitoring.
+                self.trigger.notify("ovsdb:monitor")
+                while self.running:
+                    notification = self.client.next_notification(timeout=1.0)
+                    if notification and notification[0] == "update":
+                        self.trigger.notify("ovsdb")
+            except (OVSDBError, socket.error), e:
+                LOG.debug("OVSDB monitor error: " + str(e))
+            except Exception:
+                LOG.exception("Unexpected error in OVSDB monitor")
+
+            if self.client is not None:
+                self.client.close()
+            if self.running:
+                time.sleep(RECONNECT_INTERVAL)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+
+class GenerationPollSource(object):
+
+    # Calls read() every interval seconds, and asks for a reconcile when
+    # what it returns changes.  read is cheap, e.g. the neuca_generation
+    # rows of the instances on this host, which the plugin bumps on every
+    # change to their desired state.
+
+    def __init__(self, trigger, read, interval):
+        self.trigger = trigger
+        self.read = read
+        self.interval = interval
+        self.running = False
+        self.thread = None
+
+    def _run(self):
+        # The first value read is only remembered: the agent reconciles
+        # when it starts anyway.
+        last = None
+        first = True
+        while self.running:
+            try:
+                value = self.read()
+                if value is not None:
+                    if not first and value != last:
+                        self.trigger.notify("db")
+                    last = value
+                    first = False
+            except Exception:
+                LOG.exception("Unexpected error polling the database")
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
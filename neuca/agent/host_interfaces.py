@@ -0,0 +1,129 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Inventory of the host's network interfaces, taken once per agent cycle.
+#
+# The interface names under /sys/class/net and the VLAN table in
+# /proc/net/vlan/config are read in one pass when the inventory is
+# refreshed; per-interface attributes (MAC, operstate, MTU) are read from
+# sysfs the first time they are asked for and kept until the next refresh,
+# so that no lookup forks ifconfig or rescans a directory.
+
+import logging as LOG
+import os
+
+from quantum.plugins.neuca.agent import snapshot
+
+
+SYS_CLASS_NET = '/sys/class/net'
+PROC_NET_VLAN_CONFIG = '/proc/net/vlan/config'
+
+
+def parse_vlan_config(text):
+    """Return VLAN interface name -> (parent, VLAN ID) for the contents of
+    /proc/net/vlan/config."""
+    vlans = {}
+    for line in text.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) != 3:
+            continue
+        (name, vlan_id, parent) = fields
+        try:
+            vlans[name] = (parent, int(vlan_id))
+        except ValueError:
+            # The "VLAN Dev name | VLAN ID" heading.
+            continue
+    return vlans
+
+
+class HostInterfaceInventory(object):
+
+    def __init__(self, sys_class_net=SYS_CLASS_NET, proc_net_vlan_config=PROC_NET_VLAN_CONFIG):
+        self.sys_class_net = sys_class_net
+        self.proc_net_vlan_config = proc_net_vlan_config
+        self.names = frozenset()
+        # VLAN interface name -> (parent, VLAN ID)
+        self.vlans = {}
+        # (name, sysfs attribute) -> value, filled on demand
+        self.attrs = {}
+        self.built = False
+        # Changes whenever an interface or VLAN comes or goes.
+        self.fingerprint = None
+
+    def refresh(self):
+        """Re-read the interface names and the VLAN table."""
+        try:
+            names = os.listdir(self.sys_class_net)
+        except OSError, e:
+            LOG.error("Unable to list host interfaces: " + str(e))
+            names = []
+
+        try:
+            f = open(self.proc_net_vlan_config)
+            try:
+                vlans = parse_vlan_config(f.read())
+            finally:
+                f.close()
+        except IOError:
+            # No 8021q module loaded, hence no VLAN interfaces.
+            vlans = {}
+
+        self.names = frozenset(names)
+        self.vlans = vlans
+        self.attrs = {}
+        self.built = True
+        self.fingerprint = snapshot.fingerprint((self.names, frozenset(vlans.items())))
+        LOG.debug("Host interface inventory: %d interfaces, %d VLANs" % (len(names), len(vlans)))
+
+    def _attr(self, name, attr):
+        key = (name, attr)
+        if key not in self.attrs:
+            value = None
+            if name in self.names:
+                try:
+                    f = open(os.path.join(self.sys_class_net, name, attr))
+                    try:
+                        value = f.read().strip()
+                    finally:
+                        f.close()
+                except IOError:
+                    # Went away since the refresh.
+                    pass
+            self.attrs[key] = value
+        return self.attrs[key]
+
+    def exists(self, name):
+        return name in self.names
+
+    def vlan(self, name):
+        """(parent, VLAN ID) if name is a VLAN interface, else None."""
+        return self.vlans.get(name)
+
+    def get_mac(self, name, default=None):
+        return self._attr(name, "address") or default
+
+    def operstate(self, name):
+        return self._attr(name, "operstate")
+
+    def mtu(self, name):
+        value = self._attr(name, "mtu")
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return None
@@ -0,0 +1,146 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Shared, long-lived connection to libvirtd.
+#
+# Opening a connection per lookup is a large part of the cost of attaching
+# a port, so the agent keeps one connection open and re-opens it only when
+# libvirtd went away (e.g. was restarted).
+
+import logging as LOG
+import threading
+import libvirt
+
+from quantum.plugins.neuca.agent import metrics
+
+
+class LibvirtConnection:
+
+    uri = "qemu:///system"
+    conn = None
+    lock = threading.RLock()
+
+    @classmethod
+    def set_uri(self, uri):
+        with self.lock:
+            self.reset()
+            self.uri = uri
+
+    @classmethod
+    def reset(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except libvirt.libvirtError:
+                    pass
+            self.conn = None
+
+    @classmethod
+    def _is_alive(self, conn):
+        try:
+            return conn.isAlive()
+        except AttributeError:
+            # libvirt older than 0.9.8; a failed call will reset us instead.
+            return True
+        except libvirt.libvirtError:
+            return False
+
+    @classmethod
+    def get(self):
+        """Return an open connection, (re)connecting if needed; None if libvirtd is unreachable."""
+        with self.lock:
+            if self.conn is not None and self._is_alive(self.conn):
+                return self.conn
+
+            if self.conn is not None:
+                LOG.info("Connection to libvirt lost; reconnecting.")
+                self.reset()
+
+            try:
+                self.conn = libvirt.open(self.uri)
+            except libvirt.libvirtError:
+                LOG.exception('Fault occurred while attempting to connect to libvirt.')
+                self.conn = None
+
+            if not self.conn:
+                LOG.error('Failed to open connection to libvirt.')
+                self.conn = None
+            return self.conn
+
+    @classmethod
+    def _call(self, func):
+        # Runs func(conn), retrying once on a fresh connection if the
+        # first attempt fails (e.g. libvirtd was restarted under us).
+        for attempt in (1, 2):
+            conn = self.get()
+            if conn is None:
+                return None
+            try:
+                metrics.LIBVIRT_CALLS.inc()
+                return func(conn)
+            except libvirt.libvirtError, e:
+                if attempt == 2:
+                    raise
+                LOG.debug("libvirt call failed, retrying on a new connection: " + str(e))
+                self.reset()
+
+    @classmethod
+    def _list_domains_compat(self, conn, active_only):
+        # For libvirt without listAllDomains (added in 0.9.13).
+        domains = []
+        for dom_id in conn.listDomainsID():
+            try:
+                domains.append(conn.lookupByID(dom_id))
+            except libvirt.libvirtError:
+                LOG.debug('libvirt failed to find domain: ' + str(dom_id))
+        if not active_only:
+            for name in conn.listDefinedDomains():
+                try:
+                    domains.append(conn.lookupByName(name))
+                except libvirt.libvirtError:
+                    LOG.debug('libvirt failed to find domain: ' + name)
+        return domains
+
+    @classmethod
+    def list_domains(self, active_only=False):
+        """Return all (or only running) domains in one call; None if libvirt is unavailable."""
+        def _list(conn):
+            if not hasattr(conn, "listAllDomains"):
+                return self._list_domains_compat(conn, active_only)
+            if active_only:
+                return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+            return conn.listAllDomains(0)
+        return self._call(_list)
+
+    @classmethod
+    def is_running(self, dom):
+        """Whether a listed domain was running when listed; answered from
+        the domain's ID, without a call to libvirtd."""
+        return dom.ID() != -1
+
+    @classmethod
+    def lookup_domain(self, name):
+        """Return the domain called name, or None if it does not exist."""
+        def _lookup(conn):
+            try:
+                return conn.lookupByName(name)
+            except libvirt.libvirtError, e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                    return None
+                raise
+        return self._call(_lookup)
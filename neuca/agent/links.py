@@ -0,0 +1,190 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Host link management for the agent: VLAN subinterfaces and link state.
+#
+# Changes are collected in a LinkBatch and applied over rtnetlink (see
+# netlink.py), from the agent itself when it has CAP_NET_ADMIN (running as
+# root, or in a network namespace for testing), else from the root helper
+# daemon.  Without either, each change falls back to an "ip link" command
+# run through the root helper.
+
+import errno
+import logging as LOG
+import os
+
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent import netlink
+from quantum.plugins.neuca.agent.host_interfaces import SYS_CLASS_NET
+from quantum.plugins.neuca.agent.root_helper import RootHelper, RootHelperRequestNotRun
+
+
+LINK_MANAGER_NETLINK = "netlink"
+LINK_MANAGER_IP = "ip"
+
+
+def ip_command(op):
+    """The "ip link" command equivalent to a link operation."""
+    kind = op["op"]
+    if kind == "add_vlan":
+        return ["ip", "link", "add", "link", op["parent"], "name", op["name"],
+                "type", "vlan", "id", str(op["vlan"])]
+    if kind == "delete":
+        return ["ip", "link", "delete", op["name"]]
+    if kind == "set":
+        args = ["ip", "link", "set", "dev", op["name"]]
+        if op.get("up") is not None:
+            args.append(op["up"] and "up" or "down")
+        if op.get("mtu") is not None:
+            args += ["mtu", str(op["mtu"])]
+        return args
+    raise netlink.NetlinkError("unknown link operation: " + str(kind))
+
+
+class LinkManager:
+
+    mode = LINK_MANAGER_NETLINK
+    # In-process rtnetlink socket; set when the agent may change links
+    # itself.
+    netlink = None
+    # Where the links are looked for when an "ip" command fails.
+    sys_class_net = SYS_CLASS_NET
+
+    @classmethod
+    def configure(self, mode):
+        if mode not in (LINK_MANAGER_NETLINK, LINK_MANAGER_IP):
+            raise ValueError("Unknown link_manager: " + str(mode))
+        self.mode = mode
+        if self.netlink is not None:
+            self.netlink.close()
+            self.netlink = None
+        if mode == LINK_MANAGER_NETLINK and os.geteuid() == 0:
+            self.netlink = netlink.NetlinkSocket()
+
+    @classmethod
+    def set_netlink(self, sock):
+        # For running over a given socket, e.g. a recorded stand-in.
+        self.mode = LINK_MANAGER_NETLINK
+        self.netlink = netlink.NetlinkSocket(sock)
+
+    @classmethod
+    def batch(self):
+        return LinkBatch(self)
+
+    @classmethod
+    def apply(self, ops):
+        """Apply link operations in order; returns an error code (0 for
+        success) per operation."""
+        if not ops:
+            return []
+        metrics.LINK_BATCHES.inc()
+
+        if self.mode == LINK_MANAGER_NETLINK:
+            if self.netlink is not None:
+                try:
+                    return self.netlink.apply(ops)
+                except netlink.NetlinkError, e:
+                    LOG.error(str(e) + "; applying link changes with ip instead")
+            elif RootHelper.daemon is not None:
+                try:
+                    return RootHelper.apply_links(ops)
+                except RootHelperRequestNotRun, e:
+                    LOG.error(str(e) + "; applying link changes with ip instead")
+
+        codes = []
+        for op in ops:
+            (returncode, retval) = RootHelper.execute(ip_command(op))
+            codes.append(returncode and self.ip_error(op) or 0)
+        return codes
+
+    @classmethod
+    def ip_error(self, op):
+        """The error code netlink would have given for a failed "ip"
+        command.  ip does not tell us why it failed, so the links there
+        now are looked at: adding a VLAN interface that exists is EEXIST,
+        and changing a link (or the parent of a VLAN) that does not exist
+        is ENODEV; any other failure is EIO."""
+        def exists(name):
+            return os.path.exists(os.path.join(self.sys_class_net, name))
+
+        if op["op"] == "add_vlan":
+            if exists(op["name"]):
+                return errno.EEXIST
+            if not exists(op["parent"]):
+                return errno.ENODEV
+        elif not exists(op["name"]):
+            return errno.ENODEV
+        return errno.EIO
+
+    @classmethod
+    def set_link(self, name, up=None, mtu=None):
+        return self.batch().set(name, up, mtu).commit()
+
+    @classmethod
+    def delete_link(self, name):
+        return self.batch().delete(name).commit()
+
+
+# Collects link operations and applies them as one netlink batch; modeled
+# on OVS_Transaction.
+class LinkBatch:
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.ops = []
+        # Error codes that count as success, per operation.
+        self.tolerated = []
+        # Error code per operation, once committed.
+        self.results = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def add_vlan(self, parent, vlan, name=None, may_exist=True):
+        if name is None:
+            name = parent + "." + str(vlan)
+        self.ops.append({"op": "add_vlan", "name": name, "parent": parent, "vlan": int(vlan)})
+        self.tolerated.append(may_exist and (errno.EEXIST,) or ())
+        return self
+
+    def delete(self, name, if_exists=True):
+        self.ops.append({"op": "delete", "name": name})
+        self.tolerated.append(if_exists and (errno.ENODEV,) or ())
+        return self
+
+    def set(self, name, up=None, mtu=None):
+        op = {"op": "set", "name": name}
+        if up is not None:
+            op["up"] = bool(up)
+        if mtu is not None:
+            op["mtu"] = int(mtu)
+        self.ops.append(op)
+        self.tolerated.append(())
+        return self
+
+    def commit(self):
+        """Apply all collected operations; returns True if all of them succeeded."""
+        (ops, tolerated) = (self.ops, self.tolerated)
+        (self.ops, self.tolerated) = ([], [])
+        self.results = self.manager.apply(ops)
+
+        success = True
+        for (op, ok, code) in zip(ops, tolerated, self.results):
+            if code and code not in ok:
+                LOG.error("Link operation %s failed: %s" % (op, netlink.strerror(code)))
+                success = False
+        return success
@@ -0,0 +1,273 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Counters and histograms describing the agent's reconcile loop, served in
+# the Prometheus text format (version 0.0.4) over HTTP, on a local TCP
+# port or a unix socket:
+#
+#   curl http://127.0.0.1:9697/metrics
+#   curl --unix-socket /var/run/neuca/metrics.sock http://localhost/metrics
+#
+# Metrics are plain module level objects so that any part of the agent
+# can count what it does without passing a registry around.
+
+import BaseHTTPServer
+import SocketServer
+import logging as LOG
+import os
+import threading
+import time
+
+
+# Upper bounds (seconds) of the histogram buckets used for phase timings.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for (k, v) in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name + _format_labels(self.labels, k), v) for (k, v) in items]
+
+
+class Gauge(Counter):
+
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=(), func=None):
+        Counter.__init__(self, name, doc, labels)
+        # If given, called at scrape time for the (unlabelled) value.
+        self.func = func
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        if self.func is not None:
+            value = self.func()
+            if value is None:
+                return []
+            return [(self.name, value)]
+        return Counter.samples(self)
+
+
+class Histogram(object):
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> ([count per bucket], sum)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            (counts, total) = self.values.get(label_values, ([0] * len(self.buckets), 0.0))
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[label_values] = (counts, total + value)
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, (list(c), s)) for (k, (c, s)) in self.values.items())
+        samples = []
+        for (label_values, (counts, total)) in items:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket" +
+                                _format_labels(self.labels, label_values,
+                                               [("le", _format_value(bound))]),
+                                cumulative))
+            samples.append((self.name + "_sum" + _format_labels(self.labels, label_values), total))
+            samples.append((self.name + "_count" + _format_labels(self.labels, label_values),
+                            cumulative))
+        return samples
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.elapsed = time.time() - self.start
+        self.histogram.observe(self.elapsed, *self.label_values)
+        return False
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.doc))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for (name, value) in metric.samples():
+                lines.append("%s %s" % (name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "neuca_agent_phase_seconds",
+    "Time spent in each phase of a reconcile cycle.", ["phase"]))
+CYCLES = REGISTRY.register(Counter(
+    "neuca_agent_cycles_total",
+    "Reconcile cycles run, by result.", ["result"]))
+COMMANDS = REGISTRY.register(Counter(
+    "neuca_agent_commands_total",
+    "Privileged commands run (subprocesses or root helper daemon requests)."))
+LINK_BATCHES = REGISTRY.register(Counter(
+    "neuca_agent_link_batches_total",
+    "Batches of host link changes (VLAN interfaces, link state) applied."))
+LIBVIRT_CALLS = REGISTRY.register(Counter(
+    "neuca_agent_libvirt_calls_total",
+    "Calls made to libvirtd."))
+DB_QUERIES = REGISTRY.register(Counter(
+    "neuca_agent_db_queries_total",
+    "Statements sent to the Quantum database."))
+DIFFS_SKIPPED = REGISTRY.register(Counter(
+    "neuca_agent_diffs_skipped_total",
+    "Cycles that skipped planning since nothing observed or desired changed."))
+ACTIONS = REGISTRY.register(Counter(
+    "neuca_agent_actions_total",
+    "Reconcile actions applied, by type and result.", ["action", "result"]))
+ACTION_SECONDS = REGISTRY.register(Histogram(
+    "neuca_agent_action_seconds",
+    "Time taken by each reconcile action.", ["action"]))
+
+# Set by the agent after each cycle that completed without errors.
+last_success = {"time": None}
+
+
+def mark_success():
+    last_success["time"] = time.time()
+
+
+def _loop_lag():
+    if last_success["time"] is None:
+        return None
+    return time.time() - last_success["time"]
+
+
+LOOP_LAG = REGISTRY.register(Gauge(
+    "neuca_agent_loop_lag_seconds",
+    "Seconds since the last successful reconcile cycle.", func=_loop_lag))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def log_message(self, format, *args):
+        LOG.debug("metrics: " + self.address_string() + " " + (format % args))
+
+
+class _ThreadedTCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadedUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server(listen):
+    """Serve REGISTRY in a background thread.
+
+    listen is "host:port", or "unix:/path" for a unix socket.
+    """
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _ThreadedUnixServer(path, MetricsHandler)
+    else:
+        (host, _, port) = listen.rpartition(":")
+        server = _ThreadedTCPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever, name="neuca-metrics")
+    thread.daemon = True
+    thread.start()
+    LOG.info("Serving metrics on " + listen)
+    return server
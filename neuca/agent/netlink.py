@@ -0,0 +1,270 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Minimal rtnetlink client for the link changes the agent makes: creating
+# and deleting 802.1Q subinterfaces and setting link state and MTU.
+#
+# A batch of link operations is sent as one datagram of netlink requests
+# over a single long-lived socket, and all acknowledgements are collected
+# in one pass, instead of one vconfig/ifconfig fork per change.  Link
+# operations are plain dicts so that they can also be handed to the root
+# helper daemon as JSON:
+#
+#   {"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100}
+#   {"op": "delete", "name": "eth1.100"}
+#   {"op": "set", "name": "eth1.100", "up": true, "mtu": 9000}
+#
+# Only the standard library is used, as this module is also loaded by
+# neuca-rootwrap --daemon.
+
+import errno
+import os
+import socket
+import struct
+import threading
+
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_VLAN_ID = 1
+
+IFF_UP = 0x1
+
+# struct nlmsghdr, struct ifinfomsg, struct rtattr, struct nlmsgerr
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+RTATTR = struct.Struct("=HH")
+NLMSGERR = struct.Struct("=i")
+
+# Requests per datagram; keeps the acknowledgements of a batch within a
+# few receive buffers.
+MAX_BATCH = 64
+RECV_BUFSIZE = 65536
+
+OPS = ["add_vlan", "delete", "set"]
+
+
+# Exception thrown for malformed operations and transport errors; errors
+# reported by the kernel for a single operation are returned instead.
+class NetlinkError(Exception):
+    pass
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def pack_attr(attr_type, data):
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + "\0" * (_align(length) - length)
+
+
+def parse_attrs(data):
+    """Return attribute type -> payload for a packed list of rtattrs."""
+    attrs = {}
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        (length, attr_type) = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def pack_message(msg_type, flags, seq, body):
+    return NLMSGHDR.pack(NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body
+
+
+def parse_messages(data):
+    """Split a datagram into (type, flags, seq, body) tuples."""
+    messages = []
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        (length, msg_type, flags, seq, pid) = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        messages.append((msg_type, flags, seq, data[offset + NLMSGHDR.size:offset + length]))
+        offset += _align(length)
+    return messages
+
+
+def ifinfo(index=0, flags=0, change=0):
+    return IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, flags, change)
+
+
+def _ifname(name):
+    return pack_attr(IFLA_IFNAME, str(name) + "\0")
+
+
+def strerror(code):
+    if not code:
+        return "ok"
+    return "%s (%s)" % (os.strerror(code), errno.errorcode.get(code, code))
+
+
+class NetlinkSocket(object):
+
+    def __init__(self, sock=None):
+        # sock may be any object with send() and recv(), e.g. a stand-in
+        # that replays recorded replies.
+        self.sock = sock
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.sock is None:
+            sock = None
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+                sock.bind((0, 0))
+            except socket.error, e:
+                if sock is not None:
+                    sock.close()
+                raise NetlinkError("Unable to open rtnetlink socket: " + str(e))
+            self.sock = sock
+        return self
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def _next_seq(self):
+        self.seq = (self.seq + 1) & 0xffffffff or 1
+        return self.seq
+
+    def _transact(self, requests):
+        # Sends (msg_type, flags, body) requests, all acknowledged, and
+        # returns per request (error code, [reply bodies]).
+        self.open()
+        results = []
+        for i in range(0, len(requests), MAX_BATCH):
+            chunk = requests[i:i + MAX_BATCH]
+            pending = {}
+            data = []
+            for (msg_type, flags, body) in chunk:
+                seq = self._next_seq()
+                pending[seq] = [None, []]
+                results.append(pending[seq])
+                data.append(pack_message(msg_type, flags | NLM_F_REQUEST | NLM_F_ACK, seq, body))
+
+            try:
+                self.sock.send("".join(data))
+                unacked = len(pending)
+                while unacked:
+                    reply = self.sock.recv(RECV_BUFSIZE)
+                    if not reply:
+                        raise NetlinkError("netlink socket closed")
+                    for (msg_type, flags, seq, body) in parse_messages(reply):
+                        result = pending.get(seq)
+                        if result is None:
+                            continue
+                        if msg_type == NLMSG_ERROR:
+                            if result[0] is None:
+                                result[0] = -NLMSGERR.unpack_from(body)[0]
+                                unacked -= 1
+                        elif msg_type != NLMSG_DONE:
+                            result[1].append(body)
+            except (socket.error, struct.error), e:
+                self.close()
+                raise NetlinkError("netlink request failed: " + str(e))
+
+        return [tuple(r) for r in results]
+
+    def link_indexes(self, names):
+        """Return name -> ifindex for those of names that exist."""
+        names = sorted(set(names))
+        replies = self._transact([(RTM_GETLINK, 0, ifinfo() + _ifname(name)) for name in names])
+        indexes = {}
+        for (name, (code, bodies)) in zip(names, replies):
+            if not code and bodies:
+                indexes[name] = IFINFOMSG.unpack_from(bodies[0])[2]
+        return indexes
+
+    def _encode(self, op, parents):
+        kind = op.get("op")
+        if kind == "add_vlan":
+            parent = parents.get(op["parent"])
+            if parent is None:
+                return None
+            linkinfo = pack_attr(IFLA_INFO_KIND, "vlan") + \
+                pack_attr(IFLA_INFO_DATA, pack_attr(IFLA_VLAN_ID, struct.pack("=H", int(op["vlan"]))))
+            return (RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL,
+                    ifinfo() + _ifname(op["name"]) +
+                    pack_attr(IFLA_LINK, struct.pack("=I", parent)) +
+                    pack_attr(IFLA_LINKINFO, linkinfo))
+        if kind == "delete":
+            return (RTM_DELLINK, 0, ifinfo() + _ifname(op["name"]))
+        if kind == "set":
+            flags = change = 0
+            if op.get("up") is not None:
+                change = IFF_UP
+                flags = op["up"] and IFF_UP or 0
+            body = ifinfo(flags=flags, change=change) + _ifname(op["name"])
+            if op.get("mtu") is not None:
+                body += pack_attr(IFLA_MTU, struct.pack("=I", int(op["mtu"])))
+            return (RTM_NEWLINK, 0, body)
+        raise NetlinkError("unknown link operation: " + str(kind))
+
+    def apply(self, ops):
+        """Apply link operations in order; returns an error code (0 for
+        success) per operation."""
+        with self.lock:
+            parents = [op["parent"] for op in ops if op.get("op") == "add_vlan"]
+            if parents:
+                parents = self.link_indexes(parents)
+            else:
+                parents = {}
+
+            requests = []
+            codes = []
+            for op in ops:
+                request = self._encode(op, parents)
+                if request is None:
+                    codes.append(errno.ENODEV)
+                else:
+                    codes.append(None)
+                    requests.append(request)
+
+            replies = iter(self._transact(requests))
+            for (i, code) in enumerate(codes):
+                if code is None:
+                    codes[i] = replies.next()[0]
+            return codes
@@ -32,13 +32,24 @@ import time
 import signal
 import re
 import inspect
-import libxml2
 import libvirt
 import os
 
 from quantum.plugins.neuca.agent import ovs_network as ovs  
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+from quantum.plugins.neuca.agent import events
+from quantum.plugins.neuca.agent import actuation
+from quantum.plugins.neuca.agent import checkpoint
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent import scheduler
+from quantum.plugins.neuca.agent import snapshot
+from quantum.plugins.neuca.agent.domain_index import DomainInterfaceIndex
+from quantum.plugins.neuca.agent.host_interfaces import HostInterfaceInventory
+from quantum.plugins.neuca.agent.links import LinkManager, LINK_MANAGER_NETLINK
+from quantum.plugins.neuca.agent.libvirt_connection import LibvirtConnection
 
 from optparse import OptionParser
+from sqlalchemy import event
 from sqlalchemy.ext.sqlsoup import SqlSoup
 from subprocess import *
 
@@ -50,16 +61,41 @@ OP_STATUS_DOWN = "DOWN"
 # A placeholder for dead vlans.
 DEAD_VLAN_TAG = "4095"
 
+# Default bounds of the delay between polling cycles; see scheduler.py.
 REFRESH_INTERVAL = 2
+MAX_REFRESH_INTERVAL = 10
+REFRESH_JITTER = 0.2
+
+# In event driven mode, reconcile at least this often even without events.
+SAFETY_SWEEP_INTERVAL = 60
+
+# Largest number of instances named in one desired-state query.
+DB_QUERY_CHUNK_SIZE = 500
+
+# neuca_generation scope bumped by changes that affect every instance.
+ALL_INSTANCES = '*'
+
+# Number of threads applying bridge and port changes in parallel.
+ACTUATION_WORKERS = 4
+
+# Reload the desired state at least this often, even if no generation moved.
+DESIRED_STATE_MAX_AGE = 300
+
+
+def _str(value):
+    # JSON strings load as unicode.
+    if isinstance(value, unicode):
+        return str(value)
+    return value
 
 
 # A class to represent a VIF (i.e., a port that has 'iface-id' and 'vif-mac'
 # attributes set).
 class NEUCAPort:
-    @classmethod
-    def set_root_helper(self, rh):
-        self.root_helper = rh
-    
+    # Interface columns as read from OVS (see OVS_Network.get_inventory);
+    # only set on ports read from OVS.
+    ovs_iface = None
+
     def __init__(self, port_name, vif_iface, vif_mac, bridge, ID, vm_ID):
         self.port_name = port_name
         self.vif_iface = vif_iface
@@ -83,37 +119,28 @@ class NEUCAPort:
 
     @classmethod
     def run_cmd(self, args):
-        cmd = shlex.split(self.root_helper) + args
-
-        if not cmd:
+        if not args:
             return 'No Command'
         
-        LOG.debug("Running command: " + " ".join(cmd))
-        p = Popen(cmd, stdout=PIPE)
-        retval = p.communicate()[0]
-        if p.returncode == -(signal.SIGALRM):
-            LOG.debug("Timeout running command: " + " ".join(cmd))
-        return (p.returncode, retval)
+        LOG.debug("Running command: " + " ".join(args))
+        (returncode, retval) = RootHelper.execute(args)
+        if returncode == -(signal.SIGALRM):
+            LOG.debug("Timeout running command: " + " ".join(args))
+        return (returncode, retval)
 
     def destroy(self):
         LOG.info("Destroying port: " + self.port_name + ", vif_iface: " + self.vif_iface  + ", vm_ID: " + str(self.vm_ID))
 
-        conn = None
         dom = None
         if self.vm_ID:
-            try:
-                conn = libvirt.open("qemu:///system")
-            except:
-                LOG.exception('Fault occurred while attempting to connect to libvirt.')
-
-            if not conn:
-                LOG.error('Failed to open connection to libvirt.')
-                return
+            if not LibvirtConnection.get():
+                raise actuation.ActuationError('libvirt is unreachable')
 
             try:
-                dom = conn.lookupByName(self.vm_ID)
+                dom = LibvirtConnection.lookup_domain(self.vm_ID)
             except:
-                LOG.exception('Fault occurred while attempting to query libvirt for domain: ' + self.vm_ID)
+                LOG.error('Fault occurred while attempting to query libvirt for domain: ' + self.vm_ID)
+                raise
 
             try:
                 dataplane_interface_type = config.get("NEUCA", "default-dataplane-interface-type")
@@ -137,38 +164,31 @@ class NEUCAPort:
                                 dataplane_interface_type))
 
             if not deviceXML:
-                LOG.error('default-dataplane-interface-type is set to invalid value in configuration file.')
+                raise actuation.ActuationError('default-dataplane-interface-type is set to invalid value in configuration file.')
             elif not dom:
                 LOG.info('Failed to find domain ' + self.vm_ID  + ' while querying libvirt.')
             else:
                 LOG.info("Deleting interface: " + self.vif_mac + ", "+ self.vif_iface)
                 try:
+                    metrics.LIBVIRT_CALLS.inc()
                     dom.detachDeviceFlags(deviceXML, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
                 except:
-                    LOG.exception('libvirt failed to detach iface ' + self.port_name + ' from ' + self.vm_ID )
-
-            if conn:
-                conn.close()
+                    LOG.error('libvirt failed to detach iface ' + self.port_name + ' from ' + self.vm_ID )
+                    raise
 
-    def create(self):
+    def create(self, txn=None):
         LOG.info("Creating Port: " + str(self))
 
-        conn = None
         dom = None
         if self.vm_ID:
-            try:
-                conn = libvirt.open("qemu:///system")
-            except:
-                LOG.exception('Fault occurred while attempting to connect to libvirt.')
-
-            if not conn:
-                LOG.error('Failed to open connection to libvirt.')
-                return
+            if not LibvirtConnection.get():
+                raise actuation.ActuationError('libvirt is unreachable')
 
             try:
-                dom = conn.lookupByName(self.vm_ID)
+                dom = LibvirtConnection.lookup_domain(self.vm_ID)
             except:
-                LOG.exception('Fault occurred while attempting to query libvirt for domain: ' + self.vm_ID)
+                LOG.error('Fault occurred while attempting to query libvirt for domain: ' + self.vm_ID)
+                raise
 
             try:
                 dataplane_interface_type = config.get("NEUCA", "default-dataplane-interface-type")
@@ -196,62 +216,91 @@ class NEUCAPort:
                                 self.vif_iface))
 
             if not deviceXML:
-                LOG.error('default-dataplane-interface-type is set to invalid value in configuration file.')
+                raise actuation.ActuationError('default-dataplane-interface-type is set to invalid value in configuration file.')
             elif not dom:
                 LOG.debug('Failed to find domain ' + self.vm_ID  + ' while querying libvirt')
             else:
                 LOG.info("Creating interface: " + self.vif_mac + ", "+ self.vif_iface )
                 try:
-                    if dom.isActive():
+                    metrics.LIBVIRT_CALLS.inc(2)
+                    active = dom.isActive()
+                    if active:
                         dom.attachDeviceFlags(deviceXML, libvirt.VIR_DOMAIN_AFFECT_CURRENT)
-                        self.run_cmd(["ifconfig", self.vif_iface, "up" ])
                 except:
-                    LOG.exception('libvirt failed to attach iface ' + self.port_name + ' to ' + self.vm_ID )
-
-            if conn:
-                conn.close()
-            self.update()
+                    LOG.error('libvirt failed to attach iface ' + self.port_name + ' to ' + self.vm_ID )
+                    raise
+                if active and not LinkManager.set_link(self.vif_iface, up=True):
+                    raise actuation.ActuationError('Failed to bring up ' + self.vif_iface)
+
+            self.update(txn)
+
+    # Returns the (column, value) QoS settings of this port that differ
+    # from current, the Interface columns as last read from OVS; all of
+    # them if current is not known.
+    def qos_changes(self, current=None):
+        changes = []
+        for (column, value) in (("ingress_policing_rate", self.bridge.ingress_policing_rate),
+                                ("ingress_policing_burst", self.bridge.ingress_policing_burst)):
+            if value is None:
+                continue
+            if current is not None and column in current:
+                try:
+                    if int(current[column]) == int(value):
+                        continue
+                except (ValueError, TypeError):
+                    pass
+            changes.append((column, value))
+        return changes
+
+    # Queues the QoS settings of this port on txn; if no transaction is
+    # given, the settings are applied immediately.  Settings that already
+    # have the desired value in current are left alone.
+    def update(self, txn=None, current=None):
+        if txn is None:
+            port_txn = ovs.OVS_Network.transaction()
+        else:
+            port_txn = txn
 
-    def update(self):
-        if(self.bridge.ingress_policing_rate != None):
-            LOG.info("set_port_ingress_rate: " + str(self.vif_iface) + " to " +  str(self.bridge.ingress_policing_rate))
-            ovs.OVS_Network.set_port_ingress_rate(self.vif_iface, self.bridge.ingress_policing_rate)
+        for (column, value) in self.qos_changes(current):
+            LOG.info("set_port_" + column + ": " + str(self.vif_iface) + " to " + str(value))
+            port_txn.set("Interface", self.vif_iface, column, value)
 
-        if(self.bridge.ingress_policing_burst !=None):
-            LOG.info("set_port_ingress_burst: " + str(self.vif_iface) + " to " + str(self.bridge.ingress_policing_burst))
-            ovs.OVS_Network.set_port_ingress_burst(self.vif_iface, self.bridge.ingress_policing_burst)
+        if txn is None and not port_txn.commit():
+            raise actuation.ActuationError('Failed to set QoS of ' + str(self.vif_iface))
 
     def init_interfaces(self, interfaces):
         self.interfaces = interfaces
 
+    # As kept in the checkpoint; see NEUCABridge.to_checkpoint.
+    def to_checkpoint(self):
+        return [self.port_name, self.vif_iface, self.vif_mac, self.ID, self.vm_ID]
+
+    def snapshot(self):
+        return snapshot.PortSnapshot(self.port_name, self.vif_mac, self.ID, self.vm_ID)
+
 
 class NEUCABridge:
-    @classmethod
-    def set_root_helper(self, rh):
-        self.root_helper = rh
- 
+    domain_index = DomainInterfaceIndex()
+    host_interfaces = HostInterfaceInventory()
+    # Names of all libvirt domains as last listed by refresh_domain_index.
+    domain_names = None
+
     @classmethod
     def run_cmd(self, args):
-        cmd = shlex.split(self.root_helper) + args
-
-        if not cmd:
+        if not args:
             return 'No Command'
 
-
-        LOG.debug("Running command: " + " ".join(cmd))
-        p = Popen(cmd, stdout=PIPE)
-        retval = p.communicate()[0]
-        if p.returncode == -(signal.SIGALRM):
-            LOG.debug("Timeout running command: " + " ".join(cmd))
-        return (p.returncode, retval)
+        LOG.debug("Running command: " + " ".join(args))
+        (returncode, retval) = RootHelper.execute(args)
+        if returncode == -(signal.SIGALRM):
+            LOG.debug("Timeout running command: " + " ".join(args))
+        return (returncode, retval)
 
     @classmethod
     def getMac(self, port_name):
-        raw = self.run_cmd(["ifconfig", port_name])
-        try:
-            mac = raw.split(' ')[5]
-        except:
-            mac = 'mac_error'
+        if not self.host_interfaces.built:
+            self.host_interfaces.refresh()
+        mac = self.host_interfaces.get_mac(port_name, 'mac_error')
         
         if not re.match( r'^[0-9a-fA-f][0-9a-fA-f]:[0-9a-fA-f][0-9a-fA-f]:[0-9a-fA-f][0-9a-fA-f]:[0-9a-fA-f][0-9a-fA-f]:[0-9a-fA-f][0-9a-fA-f]:[0-9a-fA-f][0-9a-fA-f]$', mac, re.I):
             mac='mac_error'
@@ -260,47 +309,72 @@ class NEUCABridge:
 
     @classmethod
     def getMac_libvirt(self, vif_name):
-        rtn_val = "not found"
-
-        conn = None
+        if not self.domain_index.built:
+            self.refresh_domain_index()
+        return self.domain_index.get_mac(vif_name)
+
+    # Lists the libvirt domains, running or not, and rebuilds the shared
+    # index of the running ones' interfaces from the same listing; done once
+    # per agent cycle, and used for all dev -> domain/MAC lookups in that
+    # cycle.  If libvirt cannot be listed, the domains and index of the
+    # last listing are kept.
+    @classmethod
+    def refresh_domain_index(self):
         try:
-            conn = libvirt.open("qemu:///system")
+            domains = LibvirtConnection.list_domains()
         except:
-            LOG.exception('Fault occurred while attempting to connect to libvirt.')
-
-        if not conn:
-            LOG.error('Failed to open connection to libvirt.')
-            return rtn_val
-
-        try:
-            for dom_id in conn.listDomainsID():
-                d = conn.lookupByID(dom_id)
-
-                text = d.XMLDesc(0)
-                doc = libxml2.parseDoc(text)
-                ctxt =  doc.xpathNewContext()
-                result = ctxt.xpathEval('//domain/devices/interface')
+            LOG.exception('Fault occurred while listing libvirt domains.')
+            domains = None
 
-                for node in result:
-                    name = node.xpathEval('target')[0].prop('dev')
-                    mac = node.xpathEval('mac')[0].prop('address')
+        if domains is None:
+            if self.domain_names is not None:
+                LOG.warning('Unable to list libvirt domains; using the ' +
+                            str(len(self.domain_names)) + ' domains listed last.')
+            return
 
-                    if name == vif_name:
-                        rtn_val = str(mac)
-                        break
+        names = []
+        running = []
+        for dom in domains:
+            try:
+                names.append(dom.name())
+                if LibvirtConnection.is_running(dom):
+                    running.append(dom)
+            except:
+                LOG.debug('libvirt failed to name domain')
+        self.domain_names = names
 
-                doc.freeDoc()
-                ctxt.xpathFreeContext()
+        try:
+            self.domain_index.refresh(running)
         except:
-            LOG.exception("getMac_libvirt error for vif_name = " + str(vif_name))
-
-        if conn:
-            conn.close()
-        return rtn_val
+            LOG.exception('Failed to index domain interfaces from libvirt')
 
     def getName(self):
         return self.br_name
 
+    # The bridge and its ports as kept in the checkpoint file.
+    def to_checkpoint(self):
+        return {'switch_name': self.switch_name,
+                'vlan_tag': self.vlan_tag,
+                'switch_iface': self.switch_iface,
+                'rate': self.ingress_policing_rate,
+                'burst': self.ingress_policing_burst,
+                'ports': [port.to_checkpoint() for port in self.ports.values()]}
+
+    def snapshot(self):
+        return snapshot.BridgeSnapshot(self.br_name, self.switch_name, self.vlan_tag,
+                                       self.switch_iface, self.ingress_policing_rate,
+                                       self.ingress_policing_burst,
+                                       frozenset(port.snapshot() for port in self.ports.values()))
+
+    @classmethod
+    def from_checkpoint(self, name, state):
+        bridge = NEUCABridge(_str(name), _str(state['switch_name']), _str(state['vlan_tag']),
+                             _str(state['switch_iface']), state['rate'], state['burst'])
+        for (port_name, vif_iface, vif_mac, ID, vm_ID) in state['ports']:
+            bridge.add_port(NEUCAPort(_str(port_name), _str(vif_iface), _str(vif_mac),
+                                      bridge, _str(ID), _str(vm_ID)))
+        return bridge
+
     def add_port(self, port):
         self.ports[port.port_name] = port
 
@@ -334,41 +408,64 @@ class NEUCABridge:
         #delete all ports
         for port in self.ports.values():
             port.destroy()
- 
-        #detach and delete vlan iface
+
+        self.teardown()
+
+    # Deletes the bridge and its vlan iface, once its ports are gone
+    def teardown(self):
+        #detach vlan iface and delete bridge in one OVS transaction; the
+        #bridge's own link goes away with it
+        txn = ovs.OVS_Network.transaction()
         if self.vlan_iface:
             LOG.info("Deleting VLAN interface: " + str(self.vlan_iface))
-            ovs.OVS_Network.delete_port(self.br_name, self.vlan_iface)
-            self.run_cmd(["ifconfig", self.vlan_iface, "down"])
-            self.run_cmd(["vconfig", "rem", self.vlan_iface])
+            txn.del_port(self.br_name, self.vlan_iface, if_exists=True)
+        txn.del_bridge(self.br_name)
+        if not txn.commit():
+            raise actuation.ActuationError('Failed to delete bridge ' + self.br_name)
 
-        #delete bridge
-        ovs.OVS_Network.delete_bridge(self.br_name)
+        #delete vlan iface
+        if self.vlan_iface and not LinkManager.delete_link(self.vlan_iface):
+            raise actuation.ActuationError('Failed to delete ' + self.vlan_iface)
 
     # Really creates the Bridge on the system
     def create(self):
         LOG.info("Create bridge: " + str(self.br_name))
         
-        #create vlan_if 
-        self.run_cmd(["vconfig", "add", self.switch_iface, str(self.vlan_tag)])
-        
-        #LOG.debug("ifconfig " + self.switch_iface + '.' +  str(self.vlan_tag) + ' up')
-        (exitcode, retval) = self.run_cmd(["ifconfig", self.switch_iface + '.' +  str(self.vlan_tag), 'up'])
-        if exitcode != 0:
+        #create vlan_if and bring it up, in one batch
+        links = LinkManager.batch()
+        links.add_vlan(self.switch_iface, self.vlan_tag, self.vlan_iface)
+        links.set(self.vlan_iface, up=True)
+        if not links.commit():
             LOG.error("Failed to bring up " + self.switch_iface + '.' +  str(self.vlan_tag) + \
                       " ; Please ensure that " + self.switch_iface + \
                       " is the correct interface name, and has been brought up.")
+            raise actuation.ActuationError('Failed to bring up ' + str(self.vlan_iface))
  
-        #create the bridge in ovs
-        ovs.OVS_Network.reset_bridge(self.br_name.strip('"'))
+        #create the bridge in ovs and add the vlan iface, all at once
+        txn = ovs.OVS_Network.transaction()
+        txn.del_bridge(self.br_name.strip('"'), if_exists=True)
+        txn.add_bridge(self.br_name.strip('"'))
+        txn.add_port(self.br_name, self.vlan_iface)
+        if not txn.commit():
+            raise actuation.ActuationError('Failed to create bridge ' + self.br_name)
         
-        self.run_cmd(["ifconfig", self.br_name.strip('"'), 'up'])
-
-        #add the vlan iface 
-        ovs.OVS_Network.add_port(self.br_name, self.vlan_iface)
+        if not LinkManager.set_link(self.br_name.strip('"'), up=True):
+            raise actuation.ActuationError('Failed to bring up bridge ' + self.br_name)
         
 
 class NEUCAQuantumAgent(object):
+    # Desired state from the last database read, and the libvirt instances
+    # and neuca_generation rows it was read for.
+    desired_state = None
+    desired_state_key = None
+    desired_state_time = 0
+    desired_state_fingerprint = None
+    # The desired state last saved to, or loaded from, the checkpoint file.
+    checkpointed_state = None
+    # Observed and desired fingerprints of the last cycle that had nothing
+    # to change.
+    converged_fingerprints = None
+
     def __init__(self, config_file):
         # FIXME: Ugh. Use of "global" considered a code smell.
         # Re-factor based on default options are done in neuca-guest-agent.
@@ -396,6 +493,61 @@ class NEUCAQuantumAgent(object):
                 raise Exception('Empty db_connection_url in configuration file.')
 
             self.root_helper = config.get("AGENT", "root_helper")
+
+            try:
+                self.root_helper_daemon = config.get("AGENT", "root_helper_daemon")
+            except ConfigParser.NoOptionError:
+                self.root_helper_daemon = None
+
+            try:
+                self.ovsdb_connection = config.get("AGENT", "ovsdb_connection")
+            except ConfigParser.NoOptionError:
+                self.ovsdb_connection = None
+
+            try:
+                self.link_manager = config.get("AGENT", "link_manager") or LINK_MANAGER_NETLINK
+            except ConfigParser.NoOptionError:
+                self.link_manager = LINK_MANAGER_NETLINK
+
+            try:
+                self.event_driven = config.getboolean("AGENT", "event_driven")
+            except ConfigParser.NoOptionError:
+                self.event_driven = False
+
+            try:
+                self.safety_sweep_interval = config.getint("AGENT", "safety_sweep_interval")
+            except ConfigParser.NoOptionError:
+                self.safety_sweep_interval = SAFETY_SWEEP_INTERVAL
+
+            try:
+                self.actuation_workers = config.getint("AGENT", "actuation_workers")
+            except ConfigParser.NoOptionError:
+                self.actuation_workers = ACTUATION_WORKERS
+
+            try:
+                self.metrics_listen = config.get("AGENT", "metrics_listen")
+            except ConfigParser.NoOptionError:
+                self.metrics_listen = None
+
+            try:
+                self.state_file = config.get("AGENT", "state_file")
+            except ConfigParser.NoOptionError:
+                self.state_file = checkpoint.STATE_FILE
+
+            try:
+                self.min_interval = config.getfloat("AGENT", "min_interval")
+            except ConfigParser.NoOptionError:
+                self.min_interval = REFRESH_INTERVAL
+
+            try:
+                self.max_interval = config.getfloat("AGENT", "max_interval")
+            except ConfigParser.NoOptionError:
+                self.max_interval = MAX_REFRESH_INTERVAL
+
+            try:
+                self.interval_jitter = config.getfloat("AGENT", "interval_jitter")
+            except ConfigParser.NoOptionError:
+                self.interval_jitter = REFRESH_JITTER
             
             isVerbose = config.get("NEUCA", "verbose")
             if isVerbose.lower() == 'true':
@@ -432,115 +584,166 @@ class NEUCAQuantumAgent(object):
         self.db = SqlSoup(options["sql_connection"])
         LOG.info("Connecting to database \"%s\" on %s" %
                  (self.db.engine.url.database, self.db.engine.url.host))
-
-
-        ovs.OVS_Network.set_root_helper(self.root_helper)
-        NEUCABridge.set_root_helper(self.root_helper)
-        NEUCAPort.set_root_helper(self.root_helper)
-
+        event.listen(self.db.engine, "before_cursor_execute", self.count_db_query)
+
+
+        RootHelper.set_root_helper(self.root_helper)
+        if self.root_helper_daemon:
+            LOG.info("Using root helper daemon: " + self.root_helper_daemon)
+            RootHelper.set_daemon(self.root_helper_daemon)
+        if self.ovsdb_connection:
+            LOG.info("Using ovsdb-server at " + self.ovsdb_connection)
+            ovs.OVS_Network.set_ovsdb_connection(self.ovsdb_connection)
+        LinkManager.configure(self.link_manager)
+        LOG.info("Managing links with " + self.link_manager)
+
+        if self.state_file:
+            self.load_checkpoint(self.state_file)
+
+        self.scheduler = scheduler.ReconcileScheduler(self.min_interval, self.max_interval,
+                                                      self.interval_jitter)
+
+        self.trigger = events.ReconcileTrigger()
+        self.event_sources = []
+        if self.event_driven:
+            self.event_sources.append(events.LibvirtEventSource(self.trigger))
+            if self.ovsdb_connection:
+                self.event_sources.append(events.OVSDBMonitorSource(self.trigger,
+                                                                    self.ovsdb_connection))
+            else:
+                LOG.info("No ovsdb_connection configured; OVS changes are only "
+                         "picked up by the safety sweep.")
+            self.event_sources.append(events.GenerationPollSource(self.trigger,
+                                                                  self.read_generations,
+                                                                  self.min_interval))
+
+    # Takes the last applied desired state from the checkpoint, so that the
+    # first cycle after a restart only has to check that the generations
+    # still match it instead of reloading every port from the database.
     @classmethod
-    def __read_interface_info_from_libvirt(self):
-        self.iface_to_vm_dict = {}
+    def load_checkpoint(self, path):
+        state = checkpoint.load(path)
+        if state is None:
+            return
 
         try:
-            conn = libvirt.open("qemu:///system")
-        except:
-            LOG.exception('Fault occurred while attempting to connect to libvirt.')
-
-        if not conn:
-            LOG.error('Failed to open connection to libvirt.')
+            bridges = {}
+            for (name, bridge) in state['bridges'].items():
+                bridges[_str(name)] = NEUCABridge.from_checkpoint(name, bridge)
+            key = state['key']
+            if key is not None:
+                key = (frozenset(_str(i) for i in key['instances']),
+                       frozenset((_str(scope), gen) for (scope, gen) in key['generations']))
+        except (KeyError, TypeError, ValueError), e:
+            LOG.error("Ignoring malformed checkpoint %s: %s" % (path, str(e)))
             return
 
-        try:
-            for dom_id in conn.listDomainsID():
-            
-                d = conn.lookupByID(dom_id)
-                
-                text = d.XMLDesc(0)
+        LOG.info("Loaded checkpoint of %d bridges from %s" % (len(bridges), path))
+        self.set_desired_state(bridges)
+        self.desired_state_key = key
+        # The generations are checked before it is used, which is what
+        # reading it from the database would confirm as well.
+        self.desired_state_time = time.time()
+        self.checkpointed_state = bridges
 
-                doc = libxml2.parseDoc(text)
-                ctxt =  doc.xpathNewContext()
-                result = ctxt.xpathEval('//domain/devices/interface/target')
+    @classmethod
+    def set_desired_state(self, bridges):
+        self.desired_state = bridges
+        self.desired_state_fingerprint = snapshot.fingerprint(
+            frozenset(bridge.snapshot() for bridge in bridges.values()))
+
+    # Saves the desired state just applied in full, unless it is the one
+    # saved already.
+    def save_checkpoint(self, bridges):
+        if not self.state_file or bridges is self.checkpointed_state:
+            return
 
-                for node in result:
-                    self.iface_to_vm_dict[str(node.prop("dev"))] = d.name()
+        key = self.desired_state_key
+        if bridges is not self.desired_state:
+            key = None
+        if key is not None:
+            key = {'instances': sorted(key[0]),
+                   'generations': sorted([scope, gen] for (scope, gen) in key[1])}
+        state = {'bridges': dict((name, bridge.to_checkpoint())
+                                 for (name, bridge) in bridges.items()),
+                 'key': key}
 
-                doc.freeDoc()
-                ctxt.xpathFreeContext()
+        try:
+            checkpoint.save(self.state_file, state)
+        except (IOError, OSError), e:
+            LOG.error("Unable to save checkpoint %s: %s" % (self.state_file, str(e)))
+            return
+        NEUCAQuantumAgent.checkpointed_state = bridges
 
-        except:
-            LOG.debug('Failed to find domains in libvirt')
+    @staticmethod
+    def count_db_query(conn, cursor, statement, parameters, context, executemany):
+        metrics.DB_QUERIES.inc()
 
-        if conn:
-            conn.close()
+    @classmethod
+    def __read_interface_info_from_libvirt(self):
+        NEUCABridge.refresh_domain_index()
+        self.iface_to_vm_dict = NEUCABridge.domain_index.iface_to_vm_dict()
 
+    # Reads the OVS inventory, and the host's interfaces with it.
     @classmethod
-    def __read_bridge_info_from_ovs(self):
+    def __read_ovs_inventory(self):
+        inventory = ovs.OVS_Network.get_inventory()
+        if inventory is None:
+            raise Exception('Unable to read bridges from OVS')
 
-        self.__read_interface_info_from_libvirt()
-        
-        output = ovs.OVS_Network.run_vsctl(['show'])
+        # One look at the host's interfaces serves every port.
+        NEUCABridge.host_interfaces.refresh()
+        return inventory
 
-        isFirst = True
-        rtn_bridges = {}
-        lines = output.splitlines()
-        for item in lines:
-            item = item.strip(' ')
+    @classmethod
+    def __read_bridge_info_from_ovs(self, inventory=None):
+        # Expects __read_interface_info_from_libvirt to have run this cycle.
 
-            if item.startswith('Bridge'):
-                if not isFirst:
-                    curr_br = NEUCABridge(curr_br_name, curr_br_switch_name, curr_br_vlan,
-                                          curr_br_vlan_iface, curr_br_rate, curr_br_burst)
-                    for p in curr_br_ports:
-                        curr_br.add_port(NEUCAPort(p['name'],p['iface'],p['mac'],curr_br,p['ID'],p['curr_port_vm_ID']))
-                    rtn_bridges[curr_br_name] = curr_br
-                    
-                isFirst = False
-
-                curr_br_name = item.split(' ')[1].strip('"')
-                curr_br_switch_name = ''
-                curr_br_vlan = ''
-                curr_br_vlan_iface =''
-                curr_br_ports = []
-                #TODO
-                curr_br_rate = None
-                curr_br_burst = None
-
-            if item.startswith('Port'):
-                curr_port_name = item.split(' ')[1].strip('"')
-                curr_port_iface = curr_port_name
-                #curr_port_mac = NEUCABridge.getMac(curr_port_iface).strip('"')
-                curr_port_mac = NEUCABridge.getMac_libvirt(curr_port_iface).strip('"')
-                curr_port_ID = '' #TODO: should be DB lookup that might fail if port was deleted
+        if inventory is None:
+            inventory = self.__read_ovs_inventory()
+        host_interfaces = NEUCABridge.host_interfaces
 
-                try:
-                    curr_port_vm_ID = self.iface_to_vm_dict[curr_port_iface]
-                except:
-                    curr_port_vm_ID = None
-                #curr_port_vm_internal_iface = None 
-                
+        rtn_bridges = {}
+        for (curr_br_name, ports) in inventory.items():
+            curr_br_switch_name = ''
+            curr_br_vlan = ''
+            curr_br_vlan_iface =''
+            curr_br_ports = []
+            #TODO
+            curr_br_rate = None
+            curr_br_burst = None
+
+            for port in ports:
+                curr_port_name = port['name']
 
                 #try to classify ports: for now "vif-X" is vif, vlans are found in /proc/net/vlan,
                 #everything else is unknown 
+                vlan = host_interfaces.vlan(curr_port_name)
                 if re.match( r'^vif-[0-9a-fA-f\-]*$', curr_port_name, re.I):
                     #We have a vif                                                                               
-                    curr_br_ports.append({ 'name':curr_port_name, 'iface':curr_port_iface, 'mac':curr_port_mac, 
-                                           'ID':curr_port_ID, 'curr_port_vm_ID':curr_port_vm_ID }) 
+                    curr_br_ports.append(port)
+                elif vlan is not None:
+                    #We have a vlan interface 
+                    curr_br_vlan = str(vlan[1])
+                    curr_br_vlan_iface = vlan[0]
+                    curr_br_switch_name = '' #TODO: should be reverse conf file lookup
                 else:
-                    vlan_ifaces = [(f) for f in os.listdir('/proc/net/vlan')]
-                    if curr_port_name in vlan_ifaces:
-                        #We have a vlan interface 
-                        curr_br_vlan = curr_port_name.split('.')[1].strip('"')
-                        curr_br_vlan_iface = curr_port_name.split('.')[0].strip('"')
-                        curr_br_switch_name = '' #TODO: should be reverse conf file lookup
-                    else:
-                        #We don't know what we have
-                        pass
-
-        if not isFirst:
-            curr_br = NEUCABridge(curr_br_name, curr_br_switch_name, curr_br_vlan, curr_br_vlan_iface, curr_br_rate, curr_br_burst)
-            for p in curr_br_ports:
-                curr_br.add_port(NEUCAPort(p['name'],p['iface'],p['mac'],curr_br,p['ID'],p['curr_port_vm_ID']))
+                    #We don't know what we have
+                    pass
+
+            curr_br = NEUCABridge(curr_br_name, curr_br_switch_name, curr_br_vlan,
+                                  curr_br_vlan_iface, curr_br_rate, curr_br_burst)
+            for port in curr_br_ports:
+                curr_port_iface = port['name']
+                curr_port_mac = NEUCABridge.domain_index.get_mac(curr_port_iface).strip('"')
+                curr_port_ID = '' #TODO: should be DB lookup that might fail if port was deleted
+                curr_port_vm_ID = self.iface_to_vm_dict.get(curr_port_iface)
+
+                curr_port = NEUCAPort(port['name'], curr_port_iface, curr_port_mac,
+                                      curr_br, curr_port_ID, curr_port_vm_ID)
+                if port['interfaces']:
+                    curr_port.ovs_iface = port['interfaces'][0]
+                curr_br.add_port(curr_port)
             rtn_bridges[curr_br_name] = curr_br
 
         return rtn_bridges
@@ -584,83 +787,110 @@ class NEUCAQuantumAgent(object):
             
         return rtn_bridges
 
+    # Yields the desired-state rows of all ports attached to the given
+    # instances: one query (per DB_QUERY_CHUNK_SIZE instances) instead of
+    # one per instance, selecting only the columns the agent uses.
     @classmethod
-    def __read_bridge_info_from_db(self, db):
-
-        conn = None
-        instances = []
+    def __query_desired_ports(self, db, instances, tenant_id):
+        net_join = db.join(db.networks, db.network_properties, db.network_properties.network_id==db.networks.uuid)
+        port_join = db.with_labels(db.join(db.ports, db.port_properties, db.port_properties.port_id==db.ports.uuid))
+        all_join = db.join(port_join, net_join, port_join.ports_network_id==net_join.uuid)
 
+        columns = [all_join.switch_name,
+                   all_join.vlan_tag,
+                   all_join.max_ingress_rate,
+                   all_join.max_ingress_burst,
+                   all_join.ports_uuid,
+                   all_join.ports_interface_id,
+                   all_join.port_properties_port_id,
+                   all_join.port_properties_mac_addr,
+                   all_join.port_properties_vm_id]
+
+        num_ports = 0
+        for i in range(0, len(instances), DB_QUERY_CHUNK_SIZE):
+            chunk = instances[i:i + DB_QUERY_CHUNK_SIZE]
+            query = db.session.query(*columns).\
+                filter(all_join.port_properties_vm_id.in_(chunk)).\
+                filter(all_join.tenant_id == tenant_id)
+            for port in query:
+                num_ports += 1
+                yield port
+
+        LOG.debug('Read %d ports for %d instances from db' % (num_ports, len(instances)))
+
+    # Returns the instances and the generations of their desired state (and
+    # of ALL_INSTANCES) in one query; None if they cannot be read, e.g. the
+    # plugin predates neuca_generation.
+    @classmethod
+    def __read_generations(self, db, instances):
         try:
-            conn = libvirt.open("qemu:///system")
+            gen = db.neuca_generation
+            scopes = [ALL_INSTANCES] + instances
+            rows = []
+            for i in range(0, len(scopes), DB_QUERY_CHUNK_SIZE):
+                rows += db.session.query(gen.scope, gen.generation).\
+                    filter(gen.scope.in_(scopes[i:i + DB_QUERY_CHUNK_SIZE])).all()
         except:
-            LOG.exception('Fault occurred while attempting to connect to libvirt.')
-
-        if not conn:
-            LOG.error('Failed to open connection to libvirt.')
-            return
-
+            LOG.debug('Unable to read neuca_generation; reloading desired state.')
+            db.rollback()
+            return None
+        return (frozenset(instances), frozenset((r.scope, r.generation) for r in rows))
+
+    # The generations of the desired state of the instances last listed,
+    # as polled by events.GenerationPollSource; None if not known yet.
+    def read_generations(self):
+        instances = NEUCABridge.domain_names
+        if instances is None:
+            return None
         try:
-            # First, get the list of defined, but not running, instances.
-            instances = conn.listDefinedDomains()
+            return self.__read_generations(self.db, instances)
+        finally:
+            # Ends the poll's transaction, so the next one sees new rows.
+            self.db.rollback()
 
-            # Now, get the list of running instances, and append.
-            ids = conn.listDomainsID()
-            for id in ids:
-                try:
-                    dom = conn.lookupByID(id)
-                    if dom:
-                        new_instance_name = dom.name()
-                        LOG.debug(new_instance_name)
-                        instances.append(new_instance_name)
-                except:
-                    LOG.debug('libvirt failed to find domain: ' + id )
-        except:
-            LOG.exception('Exception occurred while querying libvirt:')
+    @classmethod
+    def __read_bridge_info_from_db(self, db):
 
-        #instances=['instance-00000f1c','instance-00000f1d']
-   
-        LOG.debug('List of all instances: ' + str(instances))
+        # Both defined-but-stopped and running instances, as listed by
+        # __read_interface_info_from_libvirt this cycle (or last, if libvirt
+        # could not be listed).
+        instances = NEUCABridge.domain_names
+        if instances is None:
+            # Going on without the instances would tear down all their ports.
+            raise Exception('Unable to list libvirt domains')
 
-        # Done with libvirt; close up the connection.
-        if conn:
-            conn.close()
+        LOG.debug('List of all instances: ' + str(instances))
 
         rtn_bridges = {}
 
-        net_join = db.join(db.networks, db.network_properties, db.network_properties.network_id==db.networks.uuid)
-        port_join = db.with_labels(db.join(db.ports, db.port_properties, db.port_properties.port_id==db.ports.uuid))
-        all_join = db.join(port_join, net_join, port_join.ports_network_id==net_join.uuid)
-
-        #ports_interface_id='instance-00000f1b.fe:16:3e:00:68:eb'
-        all_ports = []
-        for inst in instances:
-            all_ports += all_join.filter_by(port_properties_vm_id=inst).all()
-        LOG.debug('List of all ports: ' + str(all_ports))
- 
         try: 
             neuca_tenant_id = config.get("NEUCA", 'neuca_tenant_id')
         except:
             LOG.error('NEuca tenant ID unspecified; check neuca agent plugin configuration file.')
+            return rtn_bridges
+
+        key = self.__read_generations(db, instances)
+        if (key is not None and key == self.desired_state_key and
+                time.time() - self.desired_state_time < DESIRED_STATE_MAX_AGE):
+            LOG.debug('Desired state unchanged; reusing it.')
+            return self.desired_state
 
-        for port in all_ports:
+        #ports_interface_id='instance-00000f1b.fe:16:3e:00:68:eb'
+        for port in self.__query_desired_ports(db, instances, neuca_tenant_id):
             try:
-                if port.tenant_id == neuca_tenant_id:
-                     curr_br_name = 'br-'+ config.get("NETWORKS", port.switch_name) +"-"+str(port.vlan_tag)
-                     if curr_br_name in rtn_bridges:
-                         curr_br = rtn_bridges[curr_br_name]       
-                     else:
-                         curr_br_name_long = port.name
-                         curr_br_name = 'br-'+ config.get("NETWORKS", port.switch_name) +"-"+str(port.vlan_tag)
-                         curr_br_switch_name = port.switch_name
-                         curr_br_vlan = str(port.vlan_tag)
-                         curr_br_vlan_iface = config.get("NETWORKS", port.switch_name) # + "." + str(net.vlan_tag)
-                         curr_br_ports = []
-                         curr_br_rate = port.max_ingress_rate
-                         curr_br_burst = port.max_ingress_burst
-
-                         curr_br = NEUCABridge(curr_br_name, curr_br_switch_name, curr_br_vlan,
-                                               curr_br_vlan_iface, curr_br_rate, curr_br_burst)
-                         rtn_bridges[curr_br_name] = curr_br
+                curr_br_name = 'br-'+ config.get("NETWORKS", port.switch_name) +"-"+str(port.vlan_tag)
+                if curr_br_name in rtn_bridges:
+                    curr_br = rtn_bridges[curr_br_name]       
+                else:
+                    curr_br_switch_name = port.switch_name
+                    curr_br_vlan = str(port.vlan_tag)
+                    curr_br_vlan_iface = config.get("NETWORKS", port.switch_name) # + "." + str(net.vlan_tag)
+                    curr_br_rate = port.max_ingress_rate
+                    curr_br_burst = port.max_ingress_burst
+
+                    curr_br = NEUCABridge(curr_br_name, curr_br_switch_name, curr_br_vlan,
+                                          curr_br_vlan_iface, curr_br_rate, curr_br_burst)
+                    rtn_bridges[curr_br_name] = curr_br
 	                 
                 port_name = 'vif-' + port.ports_uuid[-11:]
                 curr_br.add_port(NEUCAPort(port_name, port_name, port.port_properties_mac_addr,
@@ -668,6 +898,10 @@ class NEUCAQuantumAgent(object):
             except:
                 LOG.debug('Error adding port ' + str(port.ports_interface_id))
 
+        self.set_desired_state(rtn_bridges)
+        self.desired_state_key = key
+        self.desired_state_time = time.time()
+
         return rtn_bridges
 
     def print_bridges(self, bridges):
@@ -678,24 +912,41 @@ class NEUCAQuantumAgent(object):
                 LOG.info('\tPort: ' + str(port))
         LOG.info('######################################')
 
-    def update_bridges(self, old_bridges, new_bridges):
+    # Works out the changes that take the system from old_bridges to
+    # new_bridges; port settings are queued on txn when the plan is run.
+    # Ports wait for their bridge, and libvirt operations on the same
+    # domain keep their order.
+    def plan_changes(self, old_bridges, new_bridges, txn):
         br_int = config.get("NEUCA", 'integration-bridge')
 
+        plan = actuation.ActuationPlan()
+        # vlan iface -> task deleting the old bridge that holds it
+        vlan_iface_teardowns = {}
+
         # delete old bridges and ports that are not in the new_bridge
         for br_old in old_bridges.keys():
             if br_old == br_int:
                 LOG.debug("Skipping " + br_old + " during old_bridges processing.")
                 continue
 
+            old_bridge = old_bridges[br_old]
             new_bridge_entry = new_bridges.get(br_old)
             if new_bridge_entry is None:
                 LOG.info("Deleting old bridge: " + br_old)
-                old_bridges[br_old].destroy()
+                port_tasks = [plan.add(actuation.DESTROY_PORT, port.port_name, port.destroy,
+                                       domain=port.vm_ID)
+                              for port in old_bridge.ports.values()]
+                teardown = plan.add(actuation.DESTROY_BRIDGE, br_old, old_bridge.teardown,
+                                    after=port_tasks)
+                if old_bridge.vlan_iface:
+                    vlan_iface_teardowns[old_bridge.vlan_iface] = teardown
             else:
-                for port_old in old_bridges[br_old].ports:
+                for port_old in old_bridge.ports:
                     if port_old not in new_bridge_entry.ports:
                         LOG.info("Deleting port: " + port_old)
-                        old_bridges[br_old].ports[port_old].destroy()
+                        port = old_bridge.ports[port_old]
+                        plan.add(actuation.DESTROY_PORT, port_old, port.destroy,
+                                 domain=port.vm_ID)
 
         # add new bridges and ports
         for br_new in new_bridges.keys():
@@ -703,48 +954,156 @@ class NEUCAQuantumAgent(object):
                 LOG.debug("Skipping " + br_new + " during new_bridges processing.")
                 continue
 
+            new_bridge = new_bridges[br_new]
+            create = None
             if br_new not in old_bridges:
                 LOG.info("Adding new bridge: " + br_new)
-                new_bridges[br_new].create()
+                create = plan.add(actuation.CREATE_BRIDGE, br_new, new_bridge.create,
+                                  after=[vlan_iface_teardowns.get(new_bridge.vlan_iface)])
 
             old_bridge_entry = old_bridges.get(br_new)
-            for port_new in new_bridges[br_new].ports:
+            for port_new in new_bridge.ports:
+                port = new_bridge.ports[port_new]
                 if old_bridge_entry is None:
                     LOG.info("Adding port to new bridge: " + port_new)
-                    new_bridges[br_new].ports[port_new].create()
+                    plan.add(actuation.CREATE_PORT, port_new, port.create, (txn,),
+                             after=[create], domain=port.vm_ID)
+                elif port_new in old_bridge_entry.ports:
+                    # Only write QoS that differs from what OVS has.
+                    current = old_bridge_entry.ports[port_new].ovs_iface
+                    if port.qos_changes(current):
+                        plan.add(actuation.UPDATE_PORT, port_new, port.update, (txn, current))
                 else:
-                    if port_new in old_bridge_entry.ports:
-                        new_bridges[br_new].ports[port_new].update()
-                    else:
-                        LOG.info("Adding port to old bridge: " + port_new)
-                        new_bridges[br_new].ports[port_new].create()
+                    LOG.info("Adding port to old bridge: " + port_new)
+                    plan.add(actuation.CREATE_PORT, port_new, port.create, (txn,),
+                             domain=port.vm_ID)
 
-    def daemon_loop(self):
-        while True:
-            try:
-                #Get the current state of local bridges/ports/interfaces
-                old_bridges = self.__read_bridge_info_from_ovs()
-                #self.print_bridges(old_bridges)
-            
-                #Get the desired state of local bridges/ports/interfaces from db
+        return plan
+
+    # Returns the number of changes planned and the number that failed.
+    def update_bridges(self, old_bridges, new_bridges):
+        # Port settings for the whole cycle are flushed in one transaction;
+        # they do not depend on each other, so a rejected batch is retried
+        # port by port.
+        txn = ovs.OVS_Network.transaction(independent=True)
+
+        with metrics.PHASE_SECONDS.time("diff"):
+            plan = self.plan_changes(old_bridges, new_bridges, txn)
+
+        with metrics.PHASE_SECONDS.time("apply"):
+            failed = actuation.run_plan(plan, self.actuation_workers)
+            if not txn.commit():
+                failed += 1
+
+        return (len(plan), failed)
+
+    # Prints what one cycle would change, without changing anything.
+    def dry_run(self):
+        self.__read_interface_info_from_libvirt()
+        old_bridges = self.__read_bridge_info_from_ovs()
+        new_bridges = self.__read_bridge_info_from_db(self.db)
+        plan = self.plan_changes(old_bridges, new_bridges, ovs.OVS_Network.transaction())
+
+        for line in plan.describe():
+            print line
+        print "%d actions planned" % len(plan)
+
+    def wait_for_next_cycle(self, result):
+        interval = self.scheduler.next_interval(result)
+
+        if not self.event_driven:
+            LOG.debug("Next cycle in %.1fs (%s)" % (interval, result))
+            time.sleep(interval)
+            return
+
+        if result == scheduler.CYCLE_FAILED:
+            # Retry after backing off, whether or not events arrive.
+            LOG.debug("Retrying in %.1fs" % interval)
+            time.sleep(interval)
+            return
+
+        reasons = self.trigger.wait(self.safety_sweep_interval)
+        if reasons:
+            LOG.debug("Reconciling after events: " + ", ".join(sorted(set(reasons))))
+        else:
+            LOG.debug("Reconciling for safety sweep")
+
+    # Runs one reconcile cycle; returns one of the scheduler.CYCLE_* results.
+    def reconcile_once(self):
+        result = scheduler.CYCLE_FAILED
+        try:
+            #Get the libvirt domains and their interfaces
+            with metrics.PHASE_SECONDS.time("libvirt"):
+                self.__read_interface_info_from_libvirt()
+
+            #Get the current state of local bridges/ports/interfaces
+            with metrics.PHASE_SECONDS.time("ovs"):
+                inventory = self.__read_ovs_inventory()
+                observed = (ovs.OVS_Network.inventory_fingerprint,
+                            NEUCABridge.domain_index.fingerprint,
+                            NEUCABridge.host_interfaces.fingerprint)
+        
+            #Get the desired state of local bridges/ports/interfaces from db
+            with metrics.PHASE_SECONDS.time("db"):
                 new_bridges = self.__read_bridge_info_from_db(self.db)
-                #self.print_bridges(new_bridges)
-            
+            #self.print_bridges(new_bridges)
+            fingerprints = (observed, self.desired_state_fingerprint)
+
+            if fingerprints == self.converged_fingerprints:
+                # Same as the last cycle that found nothing to do.
+                LOG.debug("Nothing changed since the last cycle; skipping the diff.")
+                metrics.DIFFS_SKIPPED.inc()
+                (planned, failed) = (0, 0)
+            else:
+                self.converged_fingerprints = None
+                old_bridges = self.__read_bridge_info_from_ovs(inventory)
+                #self.print_bridges(old_bridges)
+
                 #Apply changes
-                self.update_bridges(old_bridges, new_bridges)
+                (planned, failed) = self.update_bridges(old_bridges, new_bridges)
+                if not planned and not failed:
+                    self.converged_fingerprints = fingerprints
 
-            except KeyboardInterrupt:
-                LOG.error("Exception: KeyboardInterrupt")
-                sys.exit(0)
-            except:
-                LOG.exception("Exception in daemon_loop!")
+            if failed:
+                metrics.CYCLES.inc(1, "partial")
+            else:
+                metrics.CYCLES.inc(1, "success")
+                metrics.mark_success()
+                self.save_checkpoint(new_bridges)
+                if planned:
+                    result = scheduler.CYCLE_CHANGED
+                else:
+                    result = scheduler.CYCLE_IDLE
 
+        except KeyboardInterrupt:
+            LOG.error("Exception: KeyboardInterrupt")
+            sys.exit(0)
+        except:
+            metrics.CYCLES.inc(1, "failure")
+            LOG.exception("Exception in daemon_loop!")
+
+        try:
+           self.db.commit()
+        except Exception as e:
+           self.db.rollback()
+
+        return result
+
+    def daemon_loop(self):
+        if self.metrics_listen:
             try:
-               self.db.commit()
-            except Exception as e:
-               self.db.rollback()
-            
-            time.sleep(REFRESH_INTERVAL)
+                metrics.start_server(self.metrics_listen)
+            except Exception:
+                LOG.exception("Unable to serve metrics on " + self.metrics_listen)
+
+        for source in self.event_sources:
+            source.start()
+
+        time.sleep(self.scheduler.initial_delay())
+
+        while True:
+            result = self.reconcile_once()
+            self.wait_for_next_cycle(result)
 
 
 import time
@@ -772,6 +1131,9 @@ def main():
     parser = OptionParser(usage=usagestr)
     parser.add_option("-d", "--daemonize", dest="daemonize",
       action="store_true", default=False, help="Daemonize the NEuca Agent")
+    parser.add_option("-n", "--dry-run", dest="dry_run",
+      action="store_true", default=False,
+      help="Print the changes one cycle would make, without making them")
    
     options, args = parser.parse_args()
 
@@ -791,7 +1153,10 @@ def main():
     #Start an agent
     config_file = args[0]
     
-    if options.daemonize:
+    if options.dry_run:
+        plugin = NEUCAQuantumAgent(config_file)
+        plugin.dry_run()
+    elif options.daemonize:
         #start as daemon
         #Re-create argv without options for daemonizing code
         sys.argv=[sys.argv[0], 'start']
@@ -25,6 +25,7 @@
 # @author: Dave Lapsley, Nicira Networks, Inc.
 
 import ConfigParser
+import json
 import logging as LOG
 import shlex
 import sys
@@ -36,6 +37,11 @@ from optparse import OptionParser
 from sqlalchemy.ext.sqlsoup import SqlSoup
 from subprocess import *
 
+from quantum.plugins.neuca.agent.links import LinkManager
+from quantum.plugins.neuca.agent.ovsdb_client import OVSDB_Client, OVSDBError, to_python
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+from quantum.plugins.neuca.agent import snapshot
+
 
 # Global constants.
 OP_STATUS_UP = "UP"
@@ -46,49 +52,122 @@ DEAD_VLAN_TAG = "4095"
 
 REFRESH_INTERVAL = 2
 
+# Interface columns returned by OVS_Network.get_inventory.
+INVENTORY_IFACE_COLUMNS = ["name", "type", "ofport", "external_ids",
+                           "ingress_policing_rate", "ingress_policing_burst"]
+
+
+def as_list(value):
+    # Set columns holding a single element are read back as that element.
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def as_optional(value):
+    # Optional columns (e.g. Port.tag) are read back as [] when unset.
+    if value == []:
+        return None
+    return value
+
 
 class OVS_Network:
 
+    # When set, reads and writes go straight to ovsdb-server over JSON-RPC
+    # instead of forking ovs-vsctl for every call.
+    ovsdb = None
+    # Fingerprints of the tables read by the last list_tables and
+    # get_inventory; see snapshot.py.
+    tables_fingerprint = None
+    inventory_fingerprint = None
+    # (requests, output fingerprint, tables) of the last ovs-vsctl listing
+    # parsed, reused while the output stays exactly the same.
+    parsed_tables = None
+
     @classmethod
     def set_root_helper(self, rh):
-        self.root_helper = rh
+        RootHelper.set_root_helper(rh)
+
+    @classmethod
+    def set_ovsdb_connection(self, connection):
+        if self.ovsdb is not None:
+            self.ovsdb.close()
+        if connection:
+            self.ovsdb = OVSDB_Client(connection)
+        else:
+            self.ovsdb = None
+
+    @classmethod
+    def run_ovsdb(self, method, *args):
+        # Mirror ovs-vsctl behavior as seen through run_cmd: failures are
+        # logged, not raised.
+        try:
+            return getattr(self.ovsdb, method)(*args)
+        except OVSDBError, e:
+            LOG.error("OVSDB " + method + str(args) + " failed: " + str(e))
+            return None
+
+    @classmethod
+    def execute(self, args):
+        return RootHelper.execute(args)
 
     @classmethod
     def run_cmd(self, args):
-        cmd = shlex.split(self.root_helper) + args
-        p = Popen(cmd, stdout=PIPE)
-        retval = p.communicate()[0]
-        return retval
+        return self.execute(args)[1]
 
     @classmethod
     def run_vsctl(self, args):
         full_args = ["ovs-vsctl", "--timeout=2"] + args
         return self.run_cmd(full_args)
 
+    @classmethod
+    def transaction(self, independent=False):
+        return OVS_Transaction(self, independent)
+
+    @classmethod
+    def run_batch(self, commands):
+        # Applies a list of (verb, options, args) commands atomically;
+        # returns True on success.
+        if self.ovsdb:
+            try:
+                self.ovsdb.run_batch(commands)
+                return True
+            except (OVSDBError, ValueError), e:
+                LOG.error("OVSDB transaction failed: " + str(e))
+                return False
+
+        args = ["ovs-vsctl", "--timeout=2"]
+        for (verb, options, cmd_args) in commands:
+            if verb == "set":
+                (table, record, column, value) = cmd_args
+                cmd_args = [table, record, "%s=%s" % (column, value)]
+            args += ["--"] + options + [verb] + cmd_args
+        (exitcode, retval) = self.execute(args)
+        if exitcode != 0:
+            LOG.error("ovs-vsctl transaction failed (exit code " + str(exitcode) + ")")
+            return False
+        return True
+
     @classmethod
     def delete_bridge(self, br_name):
-        self.run_cmd(["ifconfig", br_name, "down" ])
-        self.run_vsctl(["del-br", br_name])
+        LinkManager.set_link(br_name, up=False)
+        self.transaction().del_bridge(br_name).commit()
 
     @classmethod
     def reset_bridge(self, br_name):
-        self.run_vsctl(["--", "--if-exists", "del-br", br_name])
-        self.run_vsctl(["add-br", br_name])
+        self.transaction().del_bridge(br_name, if_exists=True).add_bridge(br_name).commit()
 
     @classmethod
     def delete_port(self, br_name, port_name):
-        self.run_vsctl(["--", "--if-exists", "del-port", br_name,
-          port_name])
+        self.transaction().del_port(br_name, port_name, if_exists=True).commit()
 
     @classmethod
     def set_db_attribute(self, table_name, record, column, value):
-        args = ["set", table_name, record, "%s=%s" % (column, value)]
-        self.run_vsctl(args)
+        self.transaction().set(table_name, record, column, value).commit()
 
     @classmethod
     def clear_db_attribute(self, table_name, record, column):
-        args = ["clear", table_name, record, column]
-        self.run_vsctl(args)
+        self.transaction().clear(table_name, record, column).commit()
 
     @classmethod
     def run_ofctl(self, br_name, cmd, a1rgs):
@@ -130,47 +209,159 @@ class OVS_Network:
 
     @classmethod
     def add_tunnel_port(self, br_name, port_name, remote_ip):
-        self.run_vsctl(["add-port", br_name, port_name])
-        self.set_db_attribute("Interface", port_name, "type", "gre")
-        self.set_db_attribute("Interface", port_name, "options", "remote_ip=" +
-            remote_ip)
-        self.set_db_attribute("Interface", port_name, "options", "in_key=flow")
-        self.set_db_attribute("Interface", port_name, "options",
-            "out_key=flow")
+        txn = self.transaction()
+        txn.add_port(br_name, port_name)
+        txn.set("Interface", port_name, "type", "gre")
+        txn.set("Interface", port_name, "options", "remote_ip=" + remote_ip)
+        txn.set("Interface", port_name, "options", "in_key=flow")
+        txn.set("Interface", port_name, "options", "out_key=flow")
+        txn.commit()
         return self.get_port_ofport(port_name)
 
     @classmethod
     def add_port(self, br_name, port_name):
-        self.run_vsctl(["add-port", br_name, port_name])
+        self.transaction().add_port(br_name, port_name).commit()
         return port_name
     
     @classmethod
     def set_port_ingress_rate(self, iface, rate):
-        self.run_vsctl(["set", "Interface", iface, "ingress_policing_rate="+str(rate)])
+        self.set_db_attribute("Interface", iface, "ingress_policing_rate", rate)
         return iface
 
     @classmethod
     def set_port_ingress_burst(self, iface, burst):    
-        self.run_vsctl(["set", "Interface", iface, "ingress_policing_burst="+str(burst)])
+        self.set_db_attribute("Interface", iface, "ingress_policing_burst", burst)
         return iface
 
     @classmethod
     def add_patch_port(self, local_name, remote_name):
-        self.run_vsctl(["add-port", self.br_name, local_name])
-        self.set_db_attribute("Interface", local_name, "type", "patch")
-        self.set_db_attribute("Interface", local_name, "options", "peer=" +
-                              remote_name)
+        txn = self.transaction()
+        txn.add_port(self.br_name, local_name)
+        txn.set("Interface", local_name, "type", "patch")
+        txn.set("Interface", local_name, "options", "peer=" + remote_name)
+        txn.commit()
         return self.get_port_ofport(local_name)
 
     @classmethod
     def db_get_map(self, table, record, column):
+        if self.ovsdb:
+            value = self.run_ovsdb("get_column", table, record, column)
+            if isinstance(value, dict):
+                return value
+            return {}
         str = self.run_vsctl(["get", table, record, column]).rstrip("\n\r")
         return self.db_str_to_map(str)
 
     @classmethod
     def db_get_val(self, table, record, column):
+        if self.ovsdb:
+            value = self.run_ovsdb("get_column", table, record, column)
+            if value is None:
+                return ""
+            if isinstance(value, list):
+                return "[" + ", ".join(str(v) for v in value) + "]"
+            if isinstance(value, dict):
+                return "{" + ", ".join("%s=\"%s\"" % (k, v)
+                                       for k, v in sorted(value.items())) + "}"
+            if isinstance(value, bool):
+                return str(value).lower()
+            return str(value)
         return self.run_vsctl(["get", table, record, column]).rstrip("\n\r")
 
+    @classmethod
+    def list_tables(self, requests):
+        """Read the given columns of every row of several tables in one call.
+
+        requests is a list of (table, columns).  Returns one list of dicts
+        (column -> python value) per request, or None if the tables could
+        not be read.  The rows may be shared with earlier calls and must
+        not be modified.
+        """
+        # Taken from the rows as received, which is much cheaper than
+        # comparing what is built from them; the same rows in another order
+        # only make the agent plan a cycle it could have skipped.
+        self.tables_fingerprint = None
+
+        if self.ovsdb:
+            tables = self.run_ovsdb("select_tables", requests)
+            if tables is not None:
+                self.tables_fingerprint = snapshot.fingerprint(repr(tables))
+            return tables
+
+        args = ["--format=json"]
+        for (table, columns) in requests:
+            args += ["--", "--columns=" + ",".join(columns), "list", table]
+        output = self.run_vsctl(args)
+        self.tables_fingerprint = snapshot.fingerprint(output)
+
+        parsed = self.parsed_tables
+        if parsed is not None and parsed[0] == requests and parsed[1] == self.tables_fingerprint:
+            return parsed[2]
+
+        # One JSON document per "list" command.
+        decoder = json.JSONDecoder()
+        tables = []
+        try:
+            output = output.strip()
+            while output:
+                (listing, end) = decoder.raw_decode(output)
+                output = output[end:].strip()
+                headings = [str(h) for h in listing["headings"]]
+                tables.append([dict(zip(headings, [to_python(v) for v in row]))
+                               for row in listing["data"]])
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            LOG.error("Unable to parse ovs-vsctl list output: " + str(e))
+            return None
+
+        if len(tables) != len(requests):
+            LOG.error("ovs-vsctl list returned %d tables, expected %d" %
+                      (len(tables), len(requests)))
+            return None
+        self.parsed_tables = (requests, self.tables_fingerprint, tables)
+        return tables
+
+    @classmethod
+    def list_table(self, table, columns):
+        """Read the given columns of every row of table; None on failure."""
+        tables = self.list_tables([(table, columns)])
+        if tables is None:
+            return None
+        return tables[0]
+
+    @classmethod
+    def get_inventory(self):
+        """Read all bridges, ports and interfaces in one call.
+
+        Returns bridge name -> list of ports, each a dict with the port's
+        name, tag and interfaces (dicts of INVENTORY_IFACE_COLUMNS); None
+        if OVS could not be read.
+        """
+        self.inventory_fingerprint = None
+        tables = self.list_tables([("Bridge", ["_uuid", "name", "ports"]),
+                                   ("Port", ["_uuid", "name", "tag", "interfaces"]),
+                                   ("Interface", ["_uuid"] + INVENTORY_IFACE_COLUMNS)])
+        if tables is None:
+            return None
+        self.inventory_fingerprint = self.tables_fingerprint
+        (bridge_rows, port_rows, iface_rows) = tables
+
+        ifaces = dict((row["_uuid"], row) for row in iface_rows)
+        ports = dict((row["_uuid"], row) for row in port_rows)
+
+        inventory = {}
+        for bridge in bridge_rows:
+            bridge_ports = []
+            for port_uuid in as_list(bridge["ports"]):
+                port = ports.get(port_uuid)
+                if port is None:
+                    continue
+                bridge_ports.append({"name": port["name"],
+                                     "tag": as_optional(port["tag"]),
+                                     "interfaces": [ifaces[u] for u in as_list(port["interfaces"])
+                                                    if u in ifaces]})
+            inventory[bridge["name"]] = bridge_ports
+        return inventory
+
     @classmethod
     def db_str_to_map(self, full_str):
         list = full_str.strip("{}").split(", ")
@@ -184,6 +375,8 @@ class OVS_Network:
 
     @classmethod
     def get_port_name_list(self, br_name):
+        if self.ovsdb:
+            return self.run_ovsdb("list_ports", br_name) or []
         res = self.run_vsctl(["list-ports", br_name])
         return res.split("\n")[0:-1]
 
@@ -204,10 +397,10 @@ class OVS_Network:
     # returns a VIF object for each VIF port
     def get_vif_ports(self):
         edge_ports = []
-        port_names = self.get_port_name_list()
-        for name in port_names:
-            external_ids = self.db_get_map("Interface", name, "external_ids")
-            ofport = self.db_get_val("Interface", name, "ofport")
+        for iface in self.list_table("Interface", ["name", "ofport", "external_ids"]) or []:
+            name = iface["name"]
+            external_ids = iface["external_ids"]
+            ofport = iface["ofport"]
             if "iface-id" in external_ids and "attached-mac" in external_ids:
                 p = VifPort(name, ofport, external_ids["iface-id"],
                             external_ids["attached-mac"], self)
@@ -224,4 +417,72 @@ class OVS_Network:
         return edge_ports
 
 
+# Collects ovs-vsctl style commands and applies them as one OVSDB
+# transaction (a single "ovs-vsctl -- cmd1 -- cmd2 ..." run, or a single
+# JSON-RPC transact when the OVSDB backend is in use).
+#
+# A transaction whose commands are independent of each other (e.g. the
+# QoS settings of many ports) may be created with independent=True: if
+# the batch is rejected, each command is then retried on its own, so that
+# one vanished port does not hold back the rest.  Structural batches
+# (building or deleting a bridge with its ports) must never be split, and
+# are simply reported as failed for the next cycle to re-plan.
+class OVS_Transaction:
+
+    def __init__(self, network, independent=False):
+        self.network = network
+        self.independent = independent
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add_bridge(self, br_name):
+        self.commands.append(("add-br", [], [br_name]))
+        return self
+
+    def del_bridge(self, br_name, if_exists=False):
+        options = if_exists and ["--if-exists"] or []
+        self.commands.append(("del-br", options, [br_name]))
+        return self
 
+    def add_port(self, br_name, port_name):
+        self.commands.append(("add-port", [], [br_name, port_name]))
+        return self
+
+    def del_port(self, br_name, port_name, if_exists=False):
+        options = if_exists and ["--if-exists"] or []
+        self.commands.append(("del-port", options, [br_name, port_name]))
+        return self
+
+    def set(self, table_name, record, column, value):
+        self.commands.append(("set", [], [table_name, record, column, str(value)]))
+        return self
+
+    def clear(self, table_name, record, column):
+        self.commands.append(("clear", [], [table_name, record, column]))
+        return self
+
+    def commit(self):
+        """Apply all collected commands; returns True if all of them succeeded.
+
+        Either all commands are applied or none, unless the transaction
+        was created independent (see above).
+        """
+        commands = self.commands
+        self.commands = []
+        if not commands:
+            return True
+
+        LOG.debug("Committing OVS transaction of " + str(len(commands)) + " commands")
+        if self.network.run_batch(commands):
+            return True
+        if not self.independent or len(commands) == 1:
+            return False
+
+        LOG.info("Retrying " + str(len(commands)) + " OVS commands individually")
+        success = True
+        for command in commands:
+            if not self.network.run_batch([command]):
+                success = False
+        return success
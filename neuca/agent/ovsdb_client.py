@@ -0,0 +1,534 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Minimal OVSDB (RFC 7047) JSON-RPC client.
+#
+# Keeps a single connection to ovsdb-server open and issues "transact"
+# requests directly, so that reads and writes done by OVS_Network do not
+# each cost a fork of the root helper and ovs-vsctl.
+
+import json
+import logging as LOG
+import re
+import socket
+import threading
+
+
+DEFAULT_DATABASE = "Open_vSwitch"
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+
+
+# Exception thrown for protocol, transport and transaction errors.
+class OVSDBError(Exception):
+    pass
+
+
+# Exception thrown when ovsdb-server drops the connection.
+class OVSDBConnectionClosed(OVSDBError):
+    pass
+
+
+def to_python(datum):
+    """Convert an OVSDB JSON datum into plain python values.
+
+    Maps become dicts, sets become lists and UUID atoms become strings.
+    """
+    if isinstance(datum, list) and len(datum) == 2:
+        if datum[0] == "map":
+            return dict((to_python(k), to_python(v)) for k, v in datum[1])
+        if datum[0] == "set":
+            return [to_python(e) for e in datum[1]]
+        if datum[0] in ("uuid", "named-uuid"):
+            return str(datum[1])
+    if isinstance(datum, unicode):
+        return str(datum)
+    return datum
+
+
+def to_ovsdb(value):
+    """Convert python values into an OVSDB JSON datum."""
+    if isinstance(value, dict):
+        return ["map", [[to_ovsdb(k), to_ovsdb(v)] for k, v in sorted(value.items())]]
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return ["set", [to_ovsdb(e) for e in value]]
+    return value
+
+
+def name_or_uuid(record):
+    """Return an OVSDB "where" clause for a vsctl style record reference."""
+    if UUID_RE.match(record):
+        return [["_uuid", "==", ["uuid", record]]]
+    return [["name", "==", record]]
+
+
+class OVSDB_Client(object):
+
+    def __init__(self, connection, database=DEFAULT_DATABASE, timeout=2):
+        # connection is "unix:/path/to/db.sock" or "tcp:host:port",
+        # the same syntax used by ovs-vsctl --db.
+        self.connection = connection
+        self.database = database
+        self.timeout = timeout
+        self.sock = None
+        self.buf = ""
+        self.next_id = 0
+        self.schema = None
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return "OVSDB_Client(" + self.connection + ", " + self.database + ")"
+
+    def _open(self):
+        # Returns a socket connected to ovsdb-server.
+        method, _, address = self.connection.partition(":")
+        if method == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif method == "tcp":
+            host, _, port = address.rpartition(":")
+            address = (host, int(port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            raise OVSDBError("Unsupported OVSDB connection: " + self.connection)
+
+        # The "wait" operation may legitimately block for self.timeout.
+        sock.settimeout(self.timeout + 1)
+        try:
+            sock.connect(address)
+        except socket.error, e:
+            sock.close()
+            raise OVSDBError("Unable to connect to %s: %s" % (self.connection, e))
+        return sock
+
+    def connect(self):
+        if self.sock is not None:
+            return
+
+        self.sock = self._open()
+        self.buf = ""
+        LOG.debug("Connected to ovsdb-server at " + self.connection)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.buf = ""
+
+    def _send(self, msg):
+        self.sock.sendall(json.dumps(msg))
+
+    def _recv(self):
+        decoder = json.JSONDecoder()
+        while True:
+            self.buf = self.buf.lstrip()
+            if self.buf:
+                try:
+                    msg, end = decoder.raw_decode(self.buf)
+                    self.buf = self.buf[end:]
+                    return msg
+                except ValueError:
+                    # Incomplete message; read some more.
+                    pass
+            data = self.sock.recv(65536)
+            if not data:
+                raise OVSDBConnectionClosed("Connection closed by ovsdb-server")
+            self.buf += data
+
+    def _call_once(self, method, params):
+        self.connect()
+        self.next_id += 1
+        call_id = self.next_id
+        self._send({"method": method, "params": params, "id": call_id})
+
+        while True:
+            msg = self._recv()
+            if msg.get("method") == "echo":
+                # Keepalive from the server; answer and keep waiting.
+                self._send({"result": msg.get("params", []),
+                            "error": None, "id": msg.get("id")})
+                continue
+            if msg.get("id") != call_id:
+                # Notifications (e.g. monitor updates) are not handled here.
+                continue
+            if msg.get("error") is not None:
+                raise OVSDBError("%s failed: %s" % (method, msg["error"]))
+            return msg.get("result")
+
+    def call(self, method, params):
+        """Issue one JSON-RPC call, reconnecting once if the connection dropped."""
+        with self.lock:
+            try:
+                return self._call_once(method, params)
+            except (socket.error, OVSDBConnectionClosed), e:
+                LOG.debug("Lost connection to ovsdb-server, reconnecting: " + str(e))
+                self.close()
+
+            try:
+                return self._call_once(method, params)
+            except (socket.error, OVSDBConnectionClosed), e:
+                self.close()
+                raise OVSDBError("Error talking to %s: %s" % (self.connection, e))
+
+    def monitor(self, requests, monitor_id="neuca"):
+        """Start monitoring tables; returns the initial contents.
+
+        Changes are then delivered as "update" notifications, read with
+        next_notification().  A monitoring client should not be used for
+        other calls, since those would discard pending notifications.
+        """
+        return self.call("monitor", [self.database, monitor_id, requests])
+
+    def next_notification(self, timeout=None):
+        """Wait for a notification; returns (method, params) or None on timeout."""
+        with self.lock:
+            self.connect()
+            self.sock.settimeout(timeout)
+            try:
+                while True:
+                    try:
+                        msg = self._recv()
+                    except socket.timeout:
+                        return None
+                    if msg.get("method") == "echo":
+                        self._send({"result": msg.get("params", []),
+                                    "error": None, "id": msg.get("id")})
+                        continue
+                    if msg.get("method") and msg.get("id") is None:
+                        return (msg["method"], msg.get("params"))
+            finally:
+                if self.sock is not None:
+                    self.sock.settimeout(self.timeout + 1)
+
+    def get_schema(self):
+        if self.schema is None:
+            self.schema = self.call("get_schema", [self.database])
+        return self.schema
+
+    def column_type(self, table, column):
+        try:
+            return self.get_schema()["tables"][table]["columns"][column]["type"]
+        except KeyError:
+            raise OVSDBError("Unknown column %s in table %s" % (column, table))
+
+    def transact(self, operations):
+        """Run a list of operations atomically; returns the per-operation results."""
+        results = self.call("transact", [self.database] + list(operations))
+        for (op, res) in zip(operations, results):
+            if res and res.get("error"):
+                raise OVSDBError("%s on %s failed: %s %s" %
+                                 (op.get("op"), op.get("table"), res["error"],
+                                  res.get("details", "")))
+        if len(results) > len(operations) and results[-1] and results[-1].get("error"):
+            raise OVSDBError("transaction failed: %s %s" %
+                             (results[-1]["error"], results[-1].get("details", "")))
+        return results
+
+    def select(self, table, where=None, columns=None):
+        op = {"op": "select", "table": table, "where": where or []}
+        if columns is not None:
+            op["columns"] = list(columns)
+        rows = self.transact([op])[0]["rows"]
+        return [dict((str(k), to_python(v)) for k, v in row.items()) for row in rows]
+
+    def select_tables(self, requests):
+        """Read whole tables in one transaction.
+
+        requests is a list of (table, columns); returns one list of rows
+        per request.
+        """
+        results = self.transact([{"op": "select", "table": table, "where": [],
+                                  "columns": list(columns)}
+                                 for (table, columns) in requests])
+        return [[dict((str(k), to_python(v)) for k, v in row.items()) for row in res["rows"]]
+                for res in results[:len(requests)]]
+
+    # Conversion of the textual values accepted by "ovs-vsctl set".
+
+    def _parse_atom(self, atom_type, text):
+        if isinstance(atom_type, dict):
+            atom_type = atom_type["type"]
+        text = text.strip()
+        if atom_type == "integer":
+            return int(text)
+        if atom_type == "real":
+            return float(text)
+        if atom_type == "boolean":
+            return text.lower() == "true"
+        if atom_type == "uuid":
+            return ["uuid", text]
+        return text.strip('"')
+
+    def parse_value(self, table, column, text):
+        """Convert an ovs-vsctl style value string into an OVSDB datum."""
+        col_type = self.column_type(table, column)
+        if not isinstance(col_type, dict):
+            return self._parse_atom(col_type, str(text))
+
+        text = str(text).strip()
+        if "value" in col_type:
+            pairs = []
+            for item in text.strip("{}").split(","):
+                if "=" not in item:
+                    continue
+                k, v = item.split("=", 1)
+                pairs.append([self._parse_atom(col_type["key"], k),
+                              self._parse_atom(col_type["value"], v)])
+            return ["map", pairs]
+
+        if col_type.get("min", 1) != 1 or col_type.get("max", 1) != 1:
+            items = [i for i in text.strip("[]").split(",") if i.strip()]
+            return ["set", [self._parse_atom(col_type["key"], i) for i in items]]
+
+        return self._parse_atom(col_type["key"], text)
+
+    def empty_value(self, table, column):
+        col_type = self.column_type(table, column)
+        if isinstance(col_type, dict) and "value" in col_type:
+            return ["map", []]
+        return ["set", []]
+
+    # Configuration changes.  Like ovs-vsctl, structural changes bump
+    # next_cfg and wait (up to self.timeout) for ovs-vswitchd to catch up.
+
+    def _transact_and_wait(self, operations):
+        operations = list(operations) + [
+            {"op": "mutate", "table": "Open_vSwitch", "where": [],
+             "mutations": [["next_cfg", "+=", 1]]},
+            {"op": "select", "table": "Open_vSwitch", "where": [],
+             "columns": ["next_cfg"]}]
+        results = self.transact(operations)
+        rows = results[len(operations) - 1]["rows"]
+        if not rows:
+            return results
+
+        next_cfg = rows[0]["next_cfg"]
+        try:
+            self.transact([{"op": "wait", "timeout": int(self.timeout * 1000),
+                            "table": "Open_vSwitch", "where": [],
+                            "columns": ["cur_cfg"], "until": "==",
+                            "rows": [{"cur_cfg": next_cfg}]}])
+        except OVSDBError, e:
+            LOG.debug("Timeout waiting for ovs-vswitchd to reconfigure: " + str(e))
+        return results
+
+    def _port_ops(self, port_name, iface_type, suffix):
+        iface = {"name": port_name}
+        if iface_type:
+            iface["type"] = iface_type
+        return [{"op": "insert", "table": "Interface", "row": iface,
+                 "uuid-name": "iface" + suffix},
+                {"op": "insert", "table": "Port",
+                 "row": {"name": port_name,
+                         "interfaces": ["named-uuid", "iface" + suffix]},
+                 "uuid-name": "port" + suffix}]
+
+    def _guard(self, table, name, row, columns):
+        # A "wait" operation that fails the transaction unless the row
+        # named name still has the given columns as read in row, or if row
+        # is None, unless there still is no such row.
+        if row is None:
+            return {"op": "wait", "timeout": 0, "table": table,
+                    "where": [["name", "==", name]], "columns": ["name"],
+                    "until": "==", "rows": []}
+        return {"op": "wait", "timeout": 0, "table": table,
+                "where": [["_uuid", "==", row["_uuid"]]], "columns": columns,
+                "until": "==", "rows": [dict((c, row[c]) for c in columns)]}
+
+    def run_batch(self, commands):
+        """Apply a list of ovs-vsctl style commands in a single transaction.
+
+        Each command is a (verb, options, args) tuple as collected by
+        OVS_Transaction; supported verbs are add-br, del-br, add-port,
+        del-port, set and clear.
+
+        The commands are translated using the bridges and ports as read
+        beforehand.  "wait" operations in the same transaction check that
+        the rows relied on are unchanged, so that if another client
+        changed them in between, the transaction fails instead of
+        applying changes meant for other rows.
+        """
+        results = self.transact([
+            {"op": "select", "table": "Bridge", "where": [],
+             "columns": ["_uuid", "name", "ports"]},
+            {"op": "select", "table": "Port", "where": [],
+             "columns": ["_uuid", "name"]}])
+
+        # Current bridge/port layout, updated as the batch is translated.
+        ports = {}
+        uuid_to_port = {}
+        port_rows = {}
+        for row in results[1]["rows"]:
+            uuid = to_python(row["_uuid"])
+            ports[str(row["name"])] = ["uuid", uuid]
+            uuid_to_port[uuid] = str(row["name"])
+            port_rows[str(row["name"])] = row
+
+        bridges = {}
+        bridge_ports = {}
+        bridge_rows = {}
+        for row in results[0]["rows"]:
+            name = str(row["name"])
+            bridges[name] = ["uuid", to_python(row["_uuid"])]
+            bridge_rows[name] = row
+            members = to_python(row["ports"])
+            if not isinstance(members, list):
+                members = [members]
+            bridge_ports[name] = set(uuid_to_port[u] for u in members if u in uuid_to_port)
+
+        # (table, name) -> "wait" operation on the row as read
+        guards = {}
+
+        def expect(table, name):
+            if (table, name) in guards:
+                return
+            if table == "Bridge":
+                guards[(table, name)] = self._guard(table, name, bridge_rows.get(name),
+                                                    ["name", "ports"])
+            else:
+                guards[(table, name)] = self._guard(table, name, port_rows.get(name),
+                                                    ["name"])
+
+        new_bridges = {}
+        ops = []
+        for (n, (verb, options, args)) in enumerate(commands):
+            suffix = str(n)
+            if verb in ("add-br", "del-br", "add-port", "del-port"):
+                expect("Bridge", args[0])
+            if verb == "add-port":
+                expect("Port", args[1])
+
+            if verb == "del-br":
+                br_name = args[0]
+                if br_name not in bridges:
+                    if "--if-exists" in options:
+                        continue
+                    raise OVSDBError("no bridge named " + br_name)
+                if br_name in new_bridges:
+                    raise OVSDBError("cannot delete bridge %s created in the same batch" % br_name)
+                # Ports and interfaces are garbage collected with the bridge.
+                for port_name in bridge_ports.pop(br_name):
+                    ports.pop(port_name, None)
+                ops.append({"op": "mutate", "table": "Open_vSwitch", "where": [],
+                            "mutations": [["bridges", "delete", bridges.pop(br_name)]]})
+
+            elif verb == "add-br":
+                br_name = args[0]
+                if br_name in bridges:
+                    if "--may-exist" in options:
+                        continue
+                    raise OVSDBError("a bridge named %s already exists" % br_name)
+                bridge_op = {"op": "insert", "table": "Bridge",
+                             "row": {"name": br_name,
+                                     "ports": ["set", [["named-uuid", "port" + suffix]]]},
+                             "uuid-name": "bridge" + suffix}
+                ops += self._port_ops(br_name, "internal", suffix)
+                ops += [bridge_op,
+                        {"op": "mutate", "table": "Open_vSwitch", "where": [],
+                         "mutations": [["bridges", "insert", ["named-uuid", "bridge" + suffix]]]}]
+                bridges[br_name] = ["named-uuid", "bridge" + suffix]
+                bridge_ports[br_name] = set([br_name])
+                ports[br_name] = ["named-uuid", "port" + suffix]
+                new_bridges[br_name] = bridge_op
+
+            elif verb == "add-port":
+                br_name, port_name = args[0], args[1]
+                if br_name not in bridges:
+                    raise OVSDBError("no bridge named " + br_name)
+                if port_name in ports:
+                    if "--may-exist" in options:
+                        continue
+                    raise OVSDBError("a port named %s already exists" % port_name)
+                ops += self._port_ops(port_name, None, suffix)
+                port_ref = ["named-uuid", "port" + suffix]
+                if br_name in new_bridges:
+                    new_bridges[br_name]["row"]["ports"][1].append(port_ref)
+                else:
+                    ops.append({"op": "mutate", "table": "Bridge",
+                                "where": [["_uuid", "==", bridges[br_name]]],
+                                "mutations": [["ports", "insert", port_ref]]})
+                ports[port_name] = port_ref
+                bridge_ports[br_name].add(port_name)
+
+            elif verb == "del-port":
+                br_name, port_name = args[0], args[1]
+                if port_name not in bridge_ports.get(br_name, ()):
+                    if "--if-exists" in options:
+                        continue
+                    raise OVSDBError("no port named %s on bridge %s" % (port_name, br_name))
+                port_ref = ports.pop(port_name)
+                if port_ref[0] == "named-uuid":
+                    raise OVSDBError("cannot delete port %s created in the same batch" % port_name)
+                bridge_ports[br_name].discard(port_name)
+                ops.append({"op": "mutate", "table": "Bridge",
+                            "where": [["_uuid", "==", bridges[br_name]]],
+                            "mutations": [["ports", "delete", port_ref]]})
+
+            elif verb in ("set", "clear"):
+                if verb == "set":
+                    table, record, column, value = args
+                    value = self.parse_value(table, column, value)
+                else:
+                    table, record, column = args
+                    value = self.empty_value(table, column)
+                # Like ovs-vsctl, fail if the record does not exist (by
+                # then: it may be added earlier in the batch).
+                ops += [{"op": "wait", "timeout": 0, "table": table,
+                         "where": name_or_uuid(record), "columns": ["_uuid"],
+                         "until": "!=", "rows": []},
+                        {"op": "update", "table": table,
+                         "where": name_or_uuid(record), "row": {column: value}}]
+
+            else:
+                raise OVSDBError("unsupported batch command: " + verb)
+
+        if ops:
+            self._transact_and_wait([guards[key] for key in sorted(guards)] + ops)
+
+    def set_columns(self, table, record, values):
+        """Set several columns of one record; values are OVSDB datums."""
+        results = self.transact([{"op": "update", "table": table,
+                                  "where": name_or_uuid(record), "row": values}])
+        if results[0].get("count", 0) == 0:
+            raise OVSDBError("no row %s in table %s" % (record, table))
+
+    def get_column(self, table, record, column):
+        rows = self.select(table, name_or_uuid(record), [column])
+        if not rows:
+            raise OVSDBError("no row %s in table %s" % (record, table))
+        return rows[0][column]
+
+    def list_ports(self, br_name):
+        results = self.transact([
+            {"op": "select", "table": "Bridge", "where": name_or_uuid(br_name),
+             "columns": ["ports"]},
+            {"op": "select", "table": "Port", "where": [],
+             "columns": ["_uuid", "name"]}])
+        if not results[0]["rows"]:
+            raise OVSDBError("no bridge named " + br_name)
+
+        bridge_ports = to_python(results[0]["rows"][0]["ports"])
+        if not isinstance(bridge_ports, list):
+            bridge_ports = [bridge_ports]
+        bridge_ports = set(bridge_ports)
+
+        names = [str(row["name"]) for row in results[1]["rows"]
+                 if to_python(row["_uuid"]) in bridge_ports]
+        # Like "ovs-vsctl list-ports", leave out the bridge's local port.
+        return sorted(n for n in names if n != br_name)
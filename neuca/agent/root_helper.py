@@ -0,0 +1,221 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Runs privileged commands for the agent, either through the configured
+# root helper (one sudo/neuca-rootwrap per command) or through a
+# long-lived "neuca-rootwrap --daemon" started once.
+
+import json
+import logging as LOG
+import shlex
+import socket
+import threading
+
+from subprocess import *
+
+from quantum.plugins.neuca.agent import metrics
+
+
+# Exception thrown when the root helper daemon cannot be used.
+class RootHelperError(Exception):
+    pass
+
+
+# Exception thrown when a request is known not to have been acted on by
+# the daemon (it could not be sent, or was refused), so it is safe to run
+# it some other way.  Any other RootHelperError leaves it unknown whether
+# the daemon ran the request.
+class RootHelperRequestNotRun(RootHelperError):
+    pass
+
+
+class RootwrapDaemonClient(object):
+
+    def __init__(self, daemon_cmd):
+        self.daemon_cmd = daemon_cmd
+        self.process = None
+        self.socket_path = None
+        # Bumped on every (re)start so that per-thread connections to an
+        # old daemon get replaced.
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+
+            cmd = shlex.split(self.daemon_cmd)
+            LOG.info("Starting root helper daemon: " + " ".join(cmd))
+            try:
+                self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)
+            except OSError, e:
+                self.process = None
+                raise RootHelperRequestNotRun("Unable to start root helper daemon: " + str(e))
+
+            path = self.process.stdout.readline().strip()
+            if not path:
+                self.process.wait()
+                self.process = None
+                raise RootHelperRequestNotRun("Root helper daemon exited during startup")
+
+            self.socket_path = path
+            self.generation += 1
+
+    def stop(self):
+        with self.lock:
+            if self.process is not None:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait()
+                except (IOError, OSError):
+                    pass
+            self.process = None
+
+    def _connection(self):
+        if getattr(self.local, "generation", None) != self.generation or \
+                self.process is None or self.process.poll() is not None:
+            self._drop_connection()
+            self.start()
+
+        if getattr(self.local, "sock", None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+            self.local.reader = sock.makefile("rb")
+            self.local.generation = self.generation
+        return (self.local.sock, self.local.reader)
+
+    def _drop_connection(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self.local.sock = None
+        self.local.reader = None
+
+    def request(self, request):
+        """Send one request object to the daemon and return its reply.
+
+        Raises RootHelperRequestNotRun if the request could not be sent;
+        once it has been, the daemon may have acted on it, and a failure
+        to read the reply raises RootHelperError without a retry.
+        """
+        request = json.dumps(request) + "\n"
+        for attempt in (1, 2):
+            try:
+                (sock, reader) = self._connection()
+                # A partly sent request has no end of line, and so is
+                # never run by the daemon.
+                sock.sendall(request)
+                break
+            except socket.error, e:
+                self._drop_connection()
+                if attempt == 2:
+                    raise RootHelperRequestNotRun("Unable to reach root helper daemon: " +
+                                                  str(e))
+                LOG.debug("Root helper daemon connection lost, retrying: " + str(e))
+
+        try:
+            line = reader.readline()
+            if not line:
+                raise socket.error("connection closed by root helper daemon")
+            reply = json.loads(line)
+            if not isinstance(reply, dict) or "returncode" not in reply:
+                raise ValueError("malformed reply: " + line.strip())
+            return reply
+        except (socket.error, ValueError), e:
+            self._drop_connection()
+            raise RootHelperError("Root helper daemon request failed: " + str(e))
+
+    def execute(self, args):
+        reply = self.request({"cmd": args})
+        try:
+            return (reply["returncode"], reply["stdout"].encode("latin-1"))
+        except (KeyError, AttributeError), e:
+            raise RootHelperError("Malformed reply from root helper daemon: " + str(e))
+
+    def apply_links(self, ops):
+        reply = self.request({"link": ops})
+        if reply["returncode"] != 0:
+            # Refused as a whole, before any change was made.
+            raise RootHelperRequestNotRun("Root helper daemon could not apply link changes: " +
+                                          str(reply.get("stderr")))
+        if not isinstance(reply.get("results"), list):
+            raise RootHelperError("Malformed reply from root helper daemon: " + str(reply))
+        return reply["results"]
+
+
+class RootHelper:
+
+    root_helper = "sudo"
+    daemon = None
+    # Per-thread count of commands run, so callers can account for the
+    # commands issued by a piece of work.
+    stats = threading.local()
+
+    @classmethod
+    def commands_run(self):
+        return getattr(self.stats, "commands", 0)
+
+    @classmethod
+    def set_root_helper(self, rh):
+        self.root_helper = rh
+
+    @classmethod
+    def set_daemon(self, daemon_cmd):
+        if self.daemon is not None:
+            self.daemon.stop()
+        if daemon_cmd:
+            self.daemon = RootwrapDaemonClient(daemon_cmd)
+        else:
+            self.daemon = None
+
+    @classmethod
+    def execute(self, args):
+        """Run args as root; returns (returncode, stdout).
+
+        Falls back to the root helper only if the daemon could not be
+        reached; if the command may have run there, the RootHelperError
+        is raised rather than running it a second time.
+        """
+        self.stats.commands = self.commands_run() + 1
+        metrics.COMMANDS.inc()
+        if self.daemon is not None:
+            try:
+                return self.daemon.execute(args)
+            except RootHelperRequestNotRun, e:
+                LOG.error(str(e) + "; falling back to " + self.root_helper)
+
+        cmd = shlex.split(self.root_helper) + args
+        p = Popen(cmd, stdout=PIPE)
+        retval = p.communicate()[0]
+        return (p.returncode, retval)
+
+    @classmethod
+    def apply_links(self, ops):
+        """Apply link operations (see netlink.py) as root through the
+        daemon; returns an error code per operation.  Raises
+        RootHelperError if there is no daemon to send them to."""
+        if self.daemon is None:
+            raise RootHelperError("No root helper daemon configured")
+        self.stats.commands = self.commands_run() + 1
+        metrics.COMMANDS.inc()
+        return self.daemon.apply_links(ops)
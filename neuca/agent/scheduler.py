@@ -0,0 +1,71 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Picks the delay before the next reconcile cycle.
+#
+# Right after a cycle that changed something the agent checks again after
+# min_interval, since more changes tend to follow (e.g. the rest of a
+# slice being set up).  Each idle cycle stretches the delay towards
+# max_interval, and failing cycles back off exponentially so that a dead
+# libvirtd or database is not hammered.  A per-host random jitter keeps
+# the hypervisors of a deployment from polling the database in lockstep.
+
+import random
+import socket
+
+
+CYCLE_CHANGED = "changed"
+CYCLE_IDLE = "idle"
+CYCLE_FAILED = "failed"
+
+# Growth of the delay after each idle cycle.
+IDLE_BACKOFF = 1.5
+
+
+class ReconcileScheduler(object):
+
+    def __init__(self, min_interval, max_interval, jitter=0.2, seed=None):
+        if max_interval < min_interval:
+            max_interval = min_interval
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.jitter = jitter
+        self.interval = self.min_interval
+        self.failures = 0
+        # Seeded per host, so that hosts started together drift apart.
+        if seed is None:
+            seed = socket.gethostname()
+        self.random = random.Random(seed)
+
+    def initial_delay(self):
+        """A random delay within min_interval, to spread agent start-up."""
+        return self.random.uniform(0, self.min_interval)
+
+    def next_interval(self, result):
+        """Returns the delay before the next cycle, given how the last one went."""
+        if result == CYCLE_FAILED:
+            self.failures += 1
+            self.interval = min(self.min_interval * (2 ** min(self.failures, 16)),
+                                self.max_interval)
+        elif result == CYCLE_CHANGED:
+            self.failures = 0
+            self.interval = self.min_interval
+        else:
+            self.failures = 0
+            self.interval = min(self.interval * IDLE_BACKOFF, self.max_interval)
+
+        return self.interval * (1 + self.random.uniform(-self.jitter, self.jitter))
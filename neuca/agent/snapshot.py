@@ -0,0 +1,68 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Immutable snapshots of bridges and ports, and fingerprints of them.
+#
+# A reconcile cycle's plan depends only on what it reads from OVS, libvirt
+# and the host's interfaces, and on the desired state from the database.
+# Each source gets a fingerprint when it is read: the OVS tables behind
+# OVS_Network.get_inventory, the libvirt domain index (from the digests of
+# the domains' XML) and the host interface inventory.  The desired state is
+# fingerprinted from its snapshot once, whenever it is reloaded.  When all
+# of them match those of the last cycle that found nothing to change, the
+# agent skips building its bridge objects and planning altogether.
+#
+# A fingerprint keeps the value it was taken from: fingerprints only match
+# if their values are equal, so that a hash collision cannot make a cycle
+# skip a real change.  The hashes are compared first, which tells most
+# differing values apart without comparing them in full.
+
+from collections import namedtuple
+
+
+class PortSnapshot(namedtuple('PortSnapshot', ['name', 'mac', 'id', 'vm_id'])):
+    __slots__ = ()
+
+
+class BridgeSnapshot(namedtuple('BridgeSnapshot',
+                                ['name', 'switch_name', 'vlan_tag', 'switch_iface',
+                                 'rate', 'burst', 'ports'])):
+    __slots__ = ()
+
+
+class Fingerprint(object):
+
+    __slots__ = ('value', 'hash')
+
+    def __init__(self, value):
+        self.value = value
+        self.hash = hash(value)
+
+    def __eq__(self, other):
+        return (isinstance(other, Fingerprint) and self.hash == other.hash and
+                self.value == other.value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.hash
+
+
+def fingerprint(value):
+    """Fingerprint of a hashable value, e.g. a frozenset of snapshots."""
+    return Fingerprint(value)
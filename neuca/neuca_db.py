@@ -27,13 +27,65 @@
 # Neuca plugin for Quantum.  Based on OVS plugin.
 #
 
+import contextlib
+
+from sqlalchemy import and_, exists, or_
+from sqlalchemy import exc as sa_exc
 from sqlalchemy.orm import exc
 
+from quantum.api.api_common import OperationalStatus
 import quantum.db.api as db
 import quantum.db.models as models
 import neuca_models
 
 
+def bump_generation(session, scope):
+    # Tells agents that the desired state of scope (a vm_id, or
+    # ALL_INSTANCES) changed; they reload it when its generation moves.
+    # Call after flushing the change itself, so that a failed insert here
+    # cannot roll it back.
+    if scope is None:
+        return
+    deferred = getattr(session, 'deferred_generations', None)
+    if deferred is not None:
+        # Within transaction(); bumped once it commits.
+        deferred.add(scope)
+        return
+    gen = neuca_models.neuca_generation
+    for attempt in (1, 2):
+        if session.query(gen).filter_by(scope=scope).\
+                update({gen.generation: gen.generation + 1}, synchronize_session=False):
+            return
+        try:
+            session.add(gen(scope, 1))
+            session.flush()
+            return
+        except sa_exc.IntegrityError:
+            # Someone else created the row first; bump theirs.
+            session.rollback()
+            if attempt == 2:
+                raise
+
+
+@contextlib.contextmanager
+def transaction(session=None):
+    # Unit of work: the writes made with the session yielded commit or
+    # roll back together.  Generations are bumped once per scope after the
+    # commit, so that a conflict there cannot undo the writes.  Given a
+    # session, joins that session's unit of work instead.
+    if session is not None:
+        yield session
+        return
+    session = db.get_session()
+    session.deferred_generations = set()
+    with session.begin():
+        yield session
+    scopes = session.deferred_generations
+    session.deferred_generations = None
+    for scope in sorted(scopes):
+        bump_generation(session, scope)
+
+
 def get_network_properties():
     session = db.get_session()
     try:
@@ -47,44 +99,112 @@ def get_network_properties():
     return res
 
 
-def add_network_properties(network_id, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst):
-    session = db.get_session()
-    network = neuca_models.network_properties(network_id, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst)
-    session.add(network)
-    session.flush()
+def add_network_properties(network_id, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst, session=None):
+    with transaction(session) as session:
+        network = neuca_models.network_properties(network_id, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst)
+        session.add(network)
+        session.flush()
+        bump_generation(session, neuca_models.ALL_INSTANCES)
     return network.network_id
 
 
-def remove_network_properties(netid):
+def add_network_properties_bulk(networks, session=None):
+    # networks: (network_id, network_type, switch_name, vlan_tag,
+    # max_ingress_rate, max_ingress_burst) tuples, inserted with one
+    # statement.
+    if not networks:
+        return
+    columns = ('network_id', 'network_type', 'switch_name', 'vlan_tag',
+               'max_ingress_rate', 'max_ingress_burst')
+    with transaction(session) as session:
+        session.execute(neuca_models.network_properties.__table__.insert(),
+                        [dict(zip(columns, n)) for n in networks])
+        bump_generation(session, neuca_models.ALL_INSTANCES)
+
+
+def remove_network_properties(netid, session=None):
+    with transaction(session) as session:
+        try:
+            network = session.query(neuca_models.network_properties).\
+              filter_by(network_id=netid).\
+              one()
+            session.delete(network)
+        except exc.NoResultFound:
+                pass
+        session.flush()
+        bump_generation(session, neuca_models.ALL_INSTANCES)
+
+def update_network_properties(netid, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst, session=None):
+    # Properties given as None are left as they are.  Returns None if
+    # network netid has no properties.
+    with transaction(session) as session:
+        try:
+            net = session.query(neuca_models.network_properties).\
+                filter_by(network_id=netid).\
+                one()
+        except exc.NoResultFound:
+            return None
+
+        if network_type is not None:
+            net.network_type = network_type
+        if switch_name is not None:
+            net.switch_name = switch_name
+        if vlan_tag is not None:
+            net.vlan_tag = vlan_tag
+        if max_ingress_rate is not None:
+            net.max_ingress_rate = max_ingress_rate
+        if max_ingress_burst is not None:
+            net.max_ingress_burst = max_ingress_burst
+
+        session.flush()
+        bump_generation(session, neuca_models.ALL_INSTANCES)
+    return net.network_id
+
+
+
+def get_used_vlans(switch_name):
+    # VLANs of switch_name that are allocated, or used by networks created
+    # before VLAN allocations were recorded.
     session = db.get_session()
+    alloc = neuca_models.neuca_vlan_allocation
+    net = neuca_models.network_properties
+    used = set(row.vlan_id for row in
+               session.query(alloc.vlan_id).filter_by(switch_name=switch_name))
+    used.update(row.vlan_tag for row in
+                session.query(net.vlan_tag).filter_by(switch_name=switch_name)
+                if row.vlan_tag)
+    return used
+
+
+def add_vlan_allocation(switch_name, vlan_id, network_id, session=None):
+    # Returns False if the VLAN is already allocated, e.g. by another
+    # plugin worker, or used by a network created before VLAN allocations
+    # were recorded.  The primary key makes the check and the insert one
+    # atomic step.  A conflict on insert rolls back the transaction it is
+    # made in: a caller that passed its session has to start over.
+    net = neuca_models.network_properties
     try:
-        network = session.query(neuca_models.network_properties).\
-          filter_by(network_id=netid).\
-          one()
-        session.delete(network)
-    except exc.NoResultFound:
-            pass
-    session.flush()
+        with transaction(session) as session:
+            if session.query(net.network_id).\
+                    filter_by(switch_name=switch_name, vlan_tag=vlan_id).first():
+                return False
+            session.add(neuca_models.neuca_vlan_allocation(switch_name, vlan_id, network_id))
+            session.flush()
+    except sa_exc.IntegrityError:
+        return False
+    return True
+
 
-def update_network_properties(netid, network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst):
+def remove_vlan_allocations(network_id):
+    # Returns the (switch_name, vlan_id) pairs released.
     session = db.get_session()
-    try:
-        net = session.query(neuca_models.network_properties).\
-            filter_by(net_id=netid).\
-            one()
-    except exc.NoResultFound:
-        pass
-    
-    net.network_type = network_type
-    net.switch_name = switch_name
-    net.vlan_tag = vlan_tag
-    net.max_ingress_rate = max_ingress_rate  
-    net.max_ingress_burst = max_ingress_burst
-
-    session.merge(net)
+    alloc = neuca_models.neuca_vlan_allocation
+    allocations = session.query(alloc).filter_by(network_id=network_id).all()
+    released = [(a.switch_name, a.vlan_id) for a in allocations]
+    for a in allocations:
+        session.delete(a)
     session.flush()
-    return net.net_id
-
+    return released
 
 
 def get_port_properties():
@@ -96,54 +216,186 @@ def get_port_properties():
         return []
     res = []
     for x in ports:
-        res.append((x.port_id, x.mac_addr, x.vm_id, x.vm_interface))
+        res.append((x.port_id, x.mac_addr, x.vm_id))
     return res
 
-def get_port_properties(portid):
-    session = db.get_session()
-    try:
-        port = session.query(neuca_models.port_properties).\
-          filter_by(port_id=portid).\
-            one()
-    except exc.NoResultFound:
-            pass
-    return port
-
 
-def add_port_properties(port_id, mac_addr, vm_id):
-    session = db.get_session()
-    port = neuca_models.port_properties(port_id, mac_addr, vm_id)
-    session.add(port)
-    session.flush()
+def add_port_properties(port_id, mac_addr, vm_id, session=None):
+    with transaction(session) as session:
+        port = neuca_models.port_properties(port_id, mac_addr, vm_id)
+        session.add(port)
+        session.flush()
+        bump_generation(session, vm_id)
     return port.port_id
 
-def remove_port_properties(portid):
-    session = db.get_session()
-    try:
-        port = session.query(neuca_models.port_properties).\
-          filter_by(port_id=portid).\
-            one()
-        session.delete(port)
-    except exc.NoResultFound:
-            pass
-    session.flush()
+
+def add_port_properties_bulk(ports, session=None):
+    # ports: (port_id, mac_addr, vm_id) tuples, inserted with one
+    # statement.
+    if not ports:
+        return
+    with transaction(session) as session:
+        session.execute(neuca_models.port_properties.__table__.insert(),
+                        [{'port_id': port_id, 'mac_addr': mac_addr, 'vm_id': vm_id}
+                         for (port_id, mac_addr, vm_id) in ports])
+        for vm_id in set(p[2] for p in ports):
+            bump_generation(session, vm_id)
+
+def remove_port_properties(portid, session=None):
+    with transaction(session) as session:
+        vm_id = None
+        try:
+            port = session.query(neuca_models.port_properties).\
+              filter_by(port_id=portid).\
+                one()
+            vm_id = port.vm_id
+            session.delete(port)
+        except exc.NoResultFound:
+                pass
+        session.flush()
+        bump_generation(session, vm_id)
 
  
-def update_port_properties_iface(portid, vm_id, vm_mac):
+def update_port_properties_iface(portid, vm_id, vm_mac, session=None):
+    update_port_properties_iface_bulk([(portid, vm_id, vm_mac)], session)
+    return portid
+
+
+# Port ids per IN clause of the bulk updates.
+IN_BATCH = 500
+
+def update_port_properties_iface_bulk(updates, session=None):
+    # updates: (port_id, vm_id, vm_mac) tuples; the ports are loaded with
+    # one query per IN_BATCH of them and written back with one flush.
+    updates = dict((port_id, (vm_id, vm_mac)) for (port_id, vm_id, vm_mac) in updates)
+    if not updates:
+        return
+    props = neuca_models.port_properties
+    with transaction(session) as session:
+        port_ids = sorted(updates)
+        ports = []
+        for i in range(0, len(port_ids), IN_BATCH):
+            ports += session.query(props).\
+                filter(props.port_id.in_(port_ids[i:i + IN_BATCH])).all()
+        if len(ports) != len(port_ids):
+            missing = set(port_ids) - set(p.port_id for p in ports)
+            raise exc.NoResultFound("No port properties for ports %s" % ", ".join(sorted(missing)))
+
+        scopes = set()
+        for port in ports:
+            (vm_id, vm_mac) = updates[port.port_id]
+            scopes.update((port.vm_id, vm_id))
+            port.vm_id = vm_id
+            port.mac_addr = vm_mac
+        session.flush()
+        for scope in scopes:
+            bump_generation(session, scope)
+
+
+
+
+
+# Listing networks and ports for the API.  Filters are the query options
+# of the Quantum 1.1 API (see quantum/api/filters.py) and are applied in
+# SQL; pagination is by uuid, returning at most limit rows after marker.
+# Only the columns the API responses need are selected, and rows are
+# fetched in batches, so that long listings are never loaded as mapped
+# objects all at once.
+
+FETCH_BATCH = 500
+
+TRUE_VALUES = ('true', 'yes', '1')
+
+
+def _has_attachment(value):
+    port = models.Port
+    if str(value).lower() in TRUE_VALUES:
+        return and_(port.interface_id != None, port.interface_id != '')
+    return or_(port.interface_id == None, port.interface_id == '')
+
+
+def _port_op_status(value):
+    # As reported by the plugin: ports that are not ACTIVE are DOWN.
+    port = models.Port
+    if value == OperationalStatus.DOWN:
+        return or_(port.state != 'ACTIVE', port.op_status == value)
+    return and_(port.state == 'ACTIVE', port.op_status == value)
+
+
+NETWORK_FILTERS = {'name': lambda v: models.Network.name == v,
+                   'op-status': lambda v: models.Network.op_status == v}
+
+PORT_FILTERS = {'state': lambda v: models.Port.state == v,
+                'op-status': _port_op_status,
+                'has-attachment': _has_attachment,
+                'attachment': lambda v: models.Port.interface_id == v}
+
+# Network filters that select networks with at least one matching port.
+NETWORK_PORT_FILTERS = {'port-state': PORT_FILTERS['state'],
+                        'port-op-status': PORT_FILTERS['op-status'],
+                        'has-attachment': _has_attachment,
+                        'attachment': PORT_FILTERS['attachment'],
+                        'port': lambda v: models.Port.uuid == v}
+
+
+def _paginate(query, column, limit, marker):
+    if marker:
+        query = query.filter(column > marker)
+    query = query.order_by(column)
+    if limit:
+        query = query.limit(int(limit))
+    return query.yield_per(FETCH_BATCH)
+
+
+def network_list(tenant_id, filters=None, limit=None, marker=None):
+    # Yields (uuid, name, op_status) of the tenant's networks.
     session = db.get_session()
-    try:
-        port = session.query(neuca_models.port_properties).\
-            filter_by(port_id=portid).\
-            one()
-    except exc.NoResultFound:
-        pass
+    net = models.Network
+    query = session.query(net.uuid, net.name, net.op_status).\
+        filter_by(tenant_id=tenant_id)
+    for (key, value) in (filters or {}).items():
+        if key in NETWORK_FILTERS:
+            query = query.filter(NETWORK_FILTERS[key](value))
+        elif key in NETWORK_PORT_FILTERS:
+            query = query.filter(exists().where(
+                and_(models.Port.network_id == net.uuid, NETWORK_PORT_FILTERS[key](value))))
+    return _paginate(query, net.uuid, limit, marker)
 
-    port.vm_id = vm_id
-    port.mac_addr = vm_mac
 
-    session.merge(port)
-    session.flush()
-    return port.port_id
+def port_list(net_id, filters=None, limit=None, marker=None):
+    # Yields the uuids of the network's ports.
+    session = db.get_session()
+    port = models.Port
+    query = session.query(port.uuid).filter_by(network_id=net_id)
+    for (key, value) in (filters or {}).items():
+        if key in PORT_FILTERS:
+            query = query.filter(PORT_FILTERS[key](value))
+    return _paginate(query, port.uuid, limit, marker)
+
 
+def network_tenants(net_ids, session=None):
+    # Returns net_id -> tenant_id for those of net_ids that exist.
+    session = session or db.get_session()
+    net = models.Network
+    net_ids = sorted(net_ids)
+    tenants = {}
+    for i in range(0, len(net_ids), IN_BATCH):
+        for (uuid, tenant_id) in session.query(net.uuid, net.tenant_id).\
+                filter(net.uuid.in_(net_ids[i:i + IN_BATCH])):
+            tenants[uuid] = tenant_id
+    return tenants
 
 
+def attached_ports(interface_ids, session=None):
+    # Returns interface_id -> (net_id, port_id) for those of interface_ids
+    # already plugged into a port.
+    session = session or db.get_session()
+    port = models.Port
+    interface_ids = sorted(interface_ids)
+    attached = {}
+    for i in range(0, len(interface_ids), IN_BATCH):
+        for (interface_id, net_id, port_id) in \
+                session.query(port.interface_id, port.network_id, port.uuid).\
+                filter(port.interface_id.in_(interface_ids[i:i + IN_BATCH])):
+            attached[interface_id] = (net_id, port_id)
+    return attached
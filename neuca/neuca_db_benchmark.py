@@ -0,0 +1,197 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Times the agent's desired-state query against a seeded database, before
+# and after neuca_db_upgrade adds its indexes, and prints the query plan
+# of each run:
+#
+#   python neuca_db_benchmark.py [--hosts 40] [--instances 80] [sqlite://]
+#
+# The database must be empty (or a scratch MySQL schema); the tables are
+# created here with the columns the agent reads, so that the Quantum
+# server is not needed.
+
+import sys
+import time
+import uuid
+
+from optparse import OptionParser
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, \
+     ForeignKey, select, and_
+
+import neuca_db_upgrade
+
+
+TENANT_ID = 'neuca'
+SWITCHES = ['data', 'management']
+
+
+def define_tables(meta):
+    # Same columns as quantum.db.models and neuca_models, without the
+    # indexes neuca_db_upgrade adds.
+    networks = Table('networks', meta,
+                     Column('uuid', String(255), primary_key=True),
+                     Column('tenant_id', String(255), nullable=False),
+                     Column('name', String(255)),
+                     Column('op_status', String(16)))
+    ports = Table('ports', meta,
+                  Column('uuid', String(255), primary_key=True),
+                  Column('network_id', String(255), ForeignKey('networks.uuid'), nullable=False),
+                  Column('interface_id', String(255)),
+                  Column('state', String(8)),
+                  Column('op_status', String(16)))
+    network_properties = Table('network_properties', meta,
+                               Column('network_id', String(255), primary_key=True),
+                               Column('network_type', String(255)),
+                               Column('switch_name', String(255)),
+                               Column('vlan_tag', Integer),
+                               Column('max_ingress_rate', Integer),
+                               Column('max_ingress_burst', Integer))
+    port_properties = Table('port_properties', meta,
+                            Column('port_id', String(255), primary_key=True),
+                            Column('mac_addr', String(255)),
+                            Column('vm_id', String(255)))
+    return (networks, ports, network_properties, port_properties)
+
+
+def seed(engine, tables, num_hosts, num_instances, ports_per_instance):
+    (networks, ports, network_properties, port_properties) = tables
+    net_rows = []
+    net_prop_rows = []
+    port_rows = []
+    port_prop_rows = []
+    vlan = 1
+
+    for host in range(num_hosts):
+        for inst in range(num_instances):
+            vm_id = 'instance-%08x' % (host * num_instances + inst)
+            for p in range(ports_per_instance):
+                net_id = str(uuid.uuid4())
+                switch_name = SWITCHES[p % len(SWITCHES)]
+                net_rows.append({'uuid': net_id, 'tenant_id': TENANT_ID,
+                                 'name': 'vlan:%s:%d' % (switch_name, vlan),
+                                 'op_status': 'UP'})
+                net_prop_rows.append({'network_id': net_id, 'network_type': 'vlan',
+                                      'switch_name': switch_name, 'vlan_tag': vlan,
+                                      'max_ingress_rate': 0, 'max_ingress_burst': 0})
+                vlan = vlan % 4094 + 1
+
+                port_id = str(uuid.uuid4())
+                mac = 'fe:16:3e:%02x:%02x:%02x' % (host % 256, inst % 256, p % 256)
+                port_rows.append({'uuid': port_id, 'network_id': net_id,
+                                  'interface_id': vm_id + '.' + mac,
+                                  'state': 'ACTIVE', 'op_status': 'UP'})
+                port_prop_rows.append({'port_id': port_id, 'mac_addr': mac, 'vm_id': vm_id})
+
+    conn = engine.connect()
+    try:
+        conn.execute(networks.insert(), net_rows)
+        conn.execute(network_properties.insert(), net_prop_rows)
+        conn.execute(ports.insert(), port_rows)
+        conn.execute(port_properties.insert(), port_prop_rows)
+    finally:
+        conn.close()
+
+    return len(port_rows)
+
+
+def desired_state_query(tables, instances):
+    # The statement NEUCAQuantumAgent.__query_desired_ports issues.
+    (networks, ports, network_properties, port_properties) = tables
+    return select([network_properties.c.switch_name,
+                   network_properties.c.vlan_tag,
+                   network_properties.c.max_ingress_rate,
+                   network_properties.c.max_ingress_burst,
+                   ports.c.uuid,
+                   ports.c.interface_id,
+                   port_properties.c.port_id,
+                   port_properties.c.mac_addr,
+                   port_properties.c.vm_id],
+                  and_(port_properties.c.port_id == ports.c.uuid,
+                       network_properties.c.network_id == networks.c.uuid,
+                       ports.c.network_id == networks.c.uuid,
+                       port_properties.c.vm_id.in_(instances),
+                       networks.c.tenant_id == TENANT_ID))
+
+
+def query_plan(engine, query):
+    compiled = query.compile(bind=engine)
+    params = [compiled.params[k] for k in compiled.positiontup] \
+        if compiled.positional else compiled.params
+    if engine.dialect.name == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    else:
+        explain = 'EXPLAIN '
+    rows = engine.execute(explain + str(compiled), params).fetchall()
+    return [" | ".join([str(v) for v in row]) for row in rows]
+
+
+def time_query(engine, query, repeat):
+    start = time.time()
+    for i in range(repeat):
+        num_rows = len(engine.execute(query).fetchall())
+    return ((time.time() - start) / repeat, num_rows)
+
+
+def report(label, engine, query, repeat):
+    (elapsed, num_rows) = time_query(engine, query, repeat)
+    print "== %s: %.3f ms per query, %d rows" % (label, elapsed * 1000.0, num_rows)
+    for line in query_plan(engine, query):
+        print "   " + line
+
+
+def main():
+    usagestr = "%prog [OPTIONS] [sql_connection]"
+    parser = OptionParser(usage=usagestr)
+    parser.add_option("--hosts", dest="hosts", type="int", default=40,
+      help="Number of hypervisors to seed [%default]")
+    parser.add_option("--instances", dest="instances", type="int", default=80,
+      help="Instances per hypervisor [%default]")
+    parser.add_option("--ports", dest="ports", type="int", default=2,
+      help="Ports per instance [%default]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=20,
+      help="Times each query is run [%default]")
+
+    options, args = parser.parse_args()
+
+    if len(args) > 1:
+        parser.print_help()
+        sys.exit(1)
+    sql_connection = args and args[0] or 'sqlite://'
+
+    engine = create_engine(sql_connection)
+    meta = MetaData()
+    tables = define_tables(meta)
+    meta.create_all(engine)
+
+    num_ports = seed(engine, tables, options.hosts, options.instances, options.ports)
+    print "Seeded %d hosts, %d instances, %d ports" % \
+        (options.hosts, options.hosts * options.instances, num_ports)
+
+    # The instances of the last host seeded, as one agent would ask for them.
+    first = (options.hosts - 1) * options.instances
+    instances = ['instance-%08x' % i for i in range(first, first + options.instances)]
+    query = desired_state_query(tables, instances)
+
+    report("Before upgrade", engine, query, options.repeat)
+    created = neuca_db_upgrade.upgrade(engine)
+    print "Created indexes: " + ", ".join(created)
+    report("After upgrade", engine, query, options.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Adds the indexes used by the agent's desired-state query to an existing
+# Quantum database.  New databases get the NEuca ones from neuca_models;
+# run this once against databases created by older releases:
+#
+#   neuca-db-upgrade /etc/quantum/plugins/neuca/neuca_quantum_plugin.ini
+#
+# Only uses SQLAlchemy, so it runs without the Quantum server installed.
+
+import ConfigParser
+import logging as LOG
+import sys
+
+from optparse import OptionParser
+from sqlalchemy import create_engine, MetaData, Table, Index
+from sqlalchemy.engine.reflection import Inspector
+
+
+# (index name, table, columns).  The names of the NEuca indexes match the
+# ones neuca_models declares.
+INDEXES = [
+    # port_properties filtered by the instances on a host.
+    ('ix_port_properties_vm_id', 'port_properties', ['vm_id']),
+    # Bridges are keyed by (switch_name, vlan_tag).
+    ('ix_network_properties_switch_name_vlan_tag', 'network_properties',
+     ['switch_name', 'vlan_tag']),
+    # Quantum's ports joined to networks.  MySQL/InnoDB already indexes
+    # this foreign key; SQLite and others do not.
+    ('ix_ports_network_id', 'ports', ['network_id']),
+]
+
+# The indexes of INDEXES that neuca_models declares: new databases are
+# created with them, so they are part of the schema and never dropped.
+MODEL_INDEXES = set(['ix_port_properties_vm_id',
+                     'ix_network_properties_switch_name_vlan_tag'])
+
+
+def _covered(inspector, table, columns):
+    # True if some existing index starts with the given columns.
+    for index in inspector.get_indexes(table):
+        if list(index['column_names'][:len(columns)]) == columns:
+            return True
+    return False
+
+
+def upgrade(engine):
+    """Create the missing indexes; returns the names of those created."""
+    inspector = Inspector.from_engine(engine)
+    tables = inspector.get_table_names()
+    meta = MetaData()
+    created = []
+
+    for (name, table_name, columns) in INDEXES:
+        if table_name not in tables:
+            LOG.warn("Table %s does not exist; skipping index %s" % (table_name, name))
+            continue
+        if _covered(inspector, table_name, columns):
+            LOG.info("Index on %s(%s) already present" % (table_name, ", ".join(columns)))
+            continue
+
+        table = Table(table_name, meta, autoload=True, autoload_with=engine)
+        index = Index(name, *[table.c[c] for c in columns])
+        LOG.info("Creating index %s on %s(%s)" % (name, table_name, ", ".join(columns)))
+        index.create(engine)
+        created.append(name)
+
+    return created
+
+
+def downgrade(engine):
+    """Drop the indexes created by upgrade() that neuca_models does not
+    declare; returns the names of those dropped."""
+    inspector = Inspector.from_engine(engine)
+    tables = inspector.get_table_names()
+    meta = MetaData()
+    dropped = []
+
+    for (name, table_name, columns) in INDEXES:
+        if name in MODEL_INDEXES:
+            continue
+        if table_name not in tables:
+            continue
+        if name not in [i['name'] for i in inspector.get_indexes(table_name)]:
+            continue
+
+        table = Table(table_name, meta, autoload=True, autoload_with=engine)
+        LOG.info("Dropping index %s on %s" % (name, table_name))
+        Index(name, *[table.c[c] for c in columns]).drop(engine)
+        dropped.append(name)
+
+    return dropped
+
+
+def main():
+    usagestr = "%prog [OPTIONS] <config file | sql_connection>"
+    parser = OptionParser(usage=usagestr)
+    parser.add_option("--downgrade", dest="downgrade",
+      action="store_true", default=False, help="Drop the indexes that only this upgrade adds")
+    parser.add_option("-v", "--verbose", dest="verbose",
+      action="store_true", default=False, help="Log each step")
+
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    LOG.basicConfig(format='%(levelname)s:%(message)s',
+                    level=(options.verbose and LOG.INFO or LOG.WARN))
+
+    if '://' in args[0]:
+        sql_connection = args[0]
+    else:
+        config = ConfigParser.ConfigParser()
+        if not config.read(args[0]):
+            print "Unable to read config file \"%s\"" % args[0]
+            sys.exit(1)
+        sql_connection = config.get("DATABASE", "sql_connection")
+
+    engine = create_engine(sql_connection)
+    if options.downgrade:
+        names = downgrade(engine)
+        print "Dropped %d indexes: %s" % (len(names), ", ".join(names))
+    else:
+        names = upgrade(engine)
+        print "Created %d indexes: %s" % (len(names), ", ".join(names))
+
+
+if __name__ == "__main__":
+    main()
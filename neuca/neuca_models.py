@@ -24,7 +24,7 @@
 
 import uuid
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation
 from quantum.db.models import BASE
@@ -33,6 +33,9 @@ from quantum.db.models import BASE
 class network_properties(BASE):
     """Represents a network's properies including vlan_tag switch max_rate and burst_rate"""
     __tablename__ = 'network_properties'
+    # Bridges are keyed by (switch_name, vlan_tag).
+    __table_args__ = (Index('ix_network_properties_switch_name_vlan_tag',
+                            'switch_name', 'vlan_tag'),)
 
     network_id = Column(String(255), primary_key=True)
     network_type = Column(String(255))
@@ -62,7 +65,8 @@ class port_properties(BASE):
 
     port_id = Column(String(255), primary_key=True)
     mac_addr = Column(String(255))
-    vm_id = Column(String(255))
+    # The agent looks up the ports of its local instances by vm_id.
+    vm_id = Column(String(255), index=True)
 
     def __init__(self, port_id, mac_addr, vm_id):
         self.port_id = port_id
@@ -73,3 +77,40 @@ class port_properties(BASE):
         return "<port_properties(%s,%s,%s,%s)>" % \
           (self.port_id, self.mac_addr,self.vm_id)
 
+
+# neuca_generation scope of changes that affect every instance.
+ALL_INSTANCES = '*'
+
+
+class neuca_generation(BASE):
+    """Counts changes to the desired state of one instance (scope = vm_id) or of all instances (scope = '*')"""
+    __tablename__ = 'neuca_generation'
+
+    scope = Column(String(255), primary_key=True)
+    generation = Column(Integer, nullable=False)
+
+    def __init__(self, scope, generation):
+        self.scope = scope
+        self.generation = generation
+
+    def __repr__(self):
+        return "<neuca_generation(%s,%d)>" % \
+          (self.scope, self.generation)
+
+
+class neuca_vlan_allocation(BASE):
+    """Records a VLAN of a switch as used by a network; the primary key keeps two networks from taking the same VLAN"""
+    __tablename__ = 'neuca_vlan_allocation'
+
+    switch_name = Column(String(255), primary_key=True)
+    vlan_id = Column(Integer, primary_key=True, autoincrement=False)
+    network_id = Column(String(255), index=True)
+
+    def __init__(self, switch_name, vlan_id, network_id):
+        self.switch_name = switch_name
+        self.vlan_id = vlan_id
+        self.network_id = network_id
+
+    def __repr__(self):
+        return "<neuca_vlan_allocation(%s,%d,%s)>" % \
+          (self.switch_name, self.vlan_id, self.network_id)
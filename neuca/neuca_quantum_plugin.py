@@ -28,6 +28,7 @@ import logging as LOG
 from optparse import OptionParser
 import os
 import sys
+import threading
 
 from quantum.api.api_common import OperationalStatus
 from quantum.common import exceptions as q_exc
@@ -36,6 +37,7 @@ from quantum.quantum_plugin_base import QuantumPluginBase
 
 import quantum.common.utils
 import quantum.db.api as db
+import quantum.db.models as models
 import neuca_db
 import nova.db.api as nova_db
 
@@ -52,46 +54,160 @@ class NoFreeVLANException(Exception):
     pass
 
 
-class VlanMap(object):
-    vlans = {}
-    net_ids = {}
-    free_vlans = set()
-    VLAN_MIN = 1
-    VLAN_MAX = 4094
-
-    def __init__(self):
-        self.vlans.clear()
-        self.net_ids.clear()
-        self.free_vlans = set(xrange(self.VLAN_MIN, self.VLAN_MAX + 1))
-
-    def already_used(self, vlan_id, network_id):
-        self.free_vlans.remove(vlan_id)
-        self.set_vlan(vlan_id, network_id)
-
-    def set_vlan(self, vlan_id, network_id):
-        self.vlans[vlan_id] = network_id
-        self.net_ids[network_id] = vlan_id
-
-    def acquire(self, network_id):
-        if len(self.free_vlans):
-            vlan = self.free_vlans.pop()
-            self.set_vlan(vlan, network_id)
-            LOG.debug("Allocated VLAN %s for network %s" % (vlan, network_id))
-            return vlan
-        else:
-            raise NoFreeVLANException("No VLAN free for network %s" %
-                                      network_id)
+# Exception thrown if a network names a VLAN that another network has
+class VLANInUse(q_exc.StateInvalid):
+    message = "VLAN %(vlan_id)s on %(switch_name)s is already used by another network"
+
+
+# Exception thrown if another worker took the VLAN picked for a network
+# while it was being allocated in a transaction; the transaction is rolled
+# back, and has to be started over.
+class VLANTaken(Exception):
+    pass
+
+
+VLAN_MIN = 1
+VLAN_MAX = 4094
+
+# vlan_tag in a network name asking the plugin to pick a free VLAN.
+VLAN_AUTO = 'auto'
+
+# Section of the config file with the VLAN ranges allocated from, per
+# switch name; "default" applies to switches not listed.
+VLAN_RANGES_SECTION = 'VLAN_RANGES'
+DEFAULT_VLAN_RANGES = 'default'
+
+# Allocation attempts before giving up when other workers keep taking
+# the VLANs picked.
+VLAN_ALLOCATE_ATTEMPTS = 16
+
+
+def parse_vlan_ranges(value):
+    """Parse "100:199,300" into [(100, 199), (300, 300)]."""
+    ranges = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        (low, _, high) = part.partition(':')
+        low = int(low)
+        high = high and int(high) or low
+        if not VLAN_MIN <= low <= high <= VLAN_MAX:
+            raise ValueError("Invalid VLAN range \"%s\"" % part)
+        ranges.append((low, high))
+    return ranges
+
+
+class VlanBitmap(object):
+    """The VLANs of some ranges and which of them are used, as bits of a long."""
+
+    def __init__(self, ranges):
+        self.mask = 0
+        for (low, high) in ranges:
+            self.mask |= ((1 << (high - low + 1)) - 1) << low
+        self.used = 0
+
+    def set(self, vlan):
+        self.used |= 1 << vlan
+
+    def clear(self, vlan):
+        self.used &= ~(1 << vlan)
+
+    def first_free(self):
+        """The lowest free VLAN in range, or None if all are used."""
+        free = self.mask & ~self.used
+        if not free:
+            return None
+        return (free & -free).bit_length() - 1
+
+
+class VlanAllocator(object):
+    """Allocates VLANs per switch from configured ranges.
+
+    Allocations live in the neuca_vlan_allocation table, whose primary key
+    keeps concurrent plugin workers from handing out the same VLAN; the
+    bitmap per switch only caches what this worker last read from it.
+    """
+
+    def __init__(self, ranges):
+        # switch_name (or DEFAULT_VLAN_RANGES) -> [(low, high), ...]
+        self.ranges = ranges
+        self.bitmaps = {}
+        self.lock = threading.Lock()
+
+    def _load(self, switch_name):
+        ranges = self.ranges.get(switch_name, self.ranges.get(DEFAULT_VLAN_RANGES))
+        bitmap = VlanBitmap(ranges or [(VLAN_MIN, VLAN_MAX)])
+        for vlan in neuca_db.get_used_vlans(switch_name):
+            bitmap.set(vlan)
+        self.bitmaps[switch_name] = bitmap
+        return bitmap
+
+    # The allocations below are made in session, if given, and so are
+    # undone if its transaction rolls back; the caller then calls forget.
+    # A VLAN already taken rolls that transaction back (see
+    # neuca_db.add_vlan_allocation).
+
+    def acquire(self, switch_name, network_id, session=None):
+        with self.lock:
+            bitmap = self.bitmaps.get(switch_name) or self._load(switch_name)
+            reloaded = False
+            for attempt in range(VLAN_ALLOCATE_ATTEMPTS):
+                vlan = bitmap.first_free()
+                if vlan is None:
+                    if reloaded:
+                        break
+                    # Others may have released VLANs since we last looked.
+                    bitmap = self._load(switch_name)
+                    reloaded = True
+                    continue
+
+                bitmap.set(vlan)
+                if neuca_db.add_vlan_allocation(switch_name, vlan, network_id, session):
+                    LOG.debug("Allocated VLAN %s on %s for network %s" %
+                              (vlan, switch_name, network_id))
+                    return vlan
+
+                # Taken by another worker since we last looked.
+                if session is not None:
+                    self.bitmaps.pop(switch_name, None)
+                    raise VLANTaken("VLAN %s on %s was taken by another network" %
+                                    (vlan, switch_name))
+                bitmap = self._load(switch_name)
+                reloaded = True
+
+        raise NoFreeVLANException("No VLAN free on %s for network %s" %
+                                  (switch_name, network_id))
+
+    def reserve(self, switch_name, vlan, network_id, session=None):
+        """Record a VLAN chosen by the caller; returns False if another
+        network already has it."""
+        with self.lock:
+            if not neuca_db.add_vlan_allocation(switch_name, vlan, network_id, session):
+                return False
+            bitmap = self.bitmaps.get(switch_name)
+            if bitmap is not None:
+                bitmap.set(vlan)
+            return True
+
+    def forget(self, switch_names=None):
+        # Drops what is known of the VLANs of switch_names (of all
+        # switches if None), e.g. after allocations for them were rolled
+        # back; read again when needed.
+        with self.lock:
+            if switch_names is None:
+                switch_names = self.bitmaps.keys()
+            for switch_name in switch_names:
+                self.bitmaps.pop(switch_name, None)
 
     def release(self, network_id):
-        vlan = self.net_ids.get(network_id, None)
-        if vlan is not None:
-            self.free_vlans.add(vlan)
-            del self.vlans[vlan]
-            del self.net_ids[network_id]
-            LOG.debug("Deallocated VLAN %s (used by network %s)"
-                      % (vlan, network_id))
-        else:
-            LOG.error("No vlan found with network \"%s\"", network_id)
+        with self.lock:
+            for (switch_name, vlan) in neuca_db.remove_vlan_allocations(network_id):
+                bitmap = self.bitmaps.get(switch_name)
+                if bitmap is not None:
+                    bitmap.clear(vlan)
+                LOG.debug("Deallocated VLAN %s on %s (used by network %s)"
+                          % (vlan, switch_name, network_id))
 
 
 class NEUCAQuantumPlugin(QuantumPluginBase):
@@ -116,13 +232,34 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
         options = {"sql_connection": self.config.get("DATABASE", "sql_connection")}
         db.configure_db(options)
 
+        vlan_ranges = {}
+        if self.config.has_section(VLAN_RANGES_SECTION):
+            for (switch_name, value) in self.config.items(VLAN_RANGES_SECTION):
+                vlan_ranges[switch_name] = parse_vlan_ranges(value)
+        self.vlans = VlanAllocator(vlan_ranges)
+
+    def _list_options(self, kwargs, *handled):
+        # (filters, limit, marker) of a listing request, with limit and
+        # marker given either way.  The filters in the handled dicts are
+        # taken out of the API's filter options, so that it only applies
+        # the others itself.
+        filter_opts = kwargs.get('filter_opts')
+        if filter_opts is None:
+            filter_opts = {}
+        filters = {}
+        for key in filter_opts.keys():
+            if [h for h in handled if key in h]:
+                filters[key] = filter_opts.pop(key)
+        limit = filter_opts.pop('limit', None)
+        marker = filter_opts.pop('marker', None)
+        return (filters, kwargs.get('limit', limit), kwargs.get('marker', marker))
+
     def get_all_networks(self, tenant_id, **kwargs):
-        nets = []
-        for x in db.network_list(tenant_id):
-            LOG.debug("Adding network: %s" % x.uuid)
-            nets.append(self._make_net_dict(str(x.uuid), x.name,
-                                            None, x.op_status))
-        return nets
+        (filters, limit, marker) = self._list_options(kwargs, neuca_db.NETWORK_FILTERS,
+                                                      neuca_db.NETWORK_PORT_FILTERS)
+        return [self._make_net_dict(str(uuid), name, None, op_status)
+                for (uuid, name, op_status) in
+                neuca_db.network_list(tenant_id, filters, limit, marker)]
 
     def _make_net_dict(self, net_id, net_name, ports, op_status):
         res = {'net-id': net_id,
@@ -132,12 +269,9 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
             res['net-ports'] = ports
         return res
 
-    def create_network(self, tenant_id, net_name, **kwargs):
-        net = db.network_create(tenant_id, net_name,
-                          op_status=OperationalStatus.UP)
-        LOG.debug("Created network: %s" % net)
-        LOG.debug("PRUTH: Created network: %s %s" % (net, net_name))
- 
+    def _network_properties(self, tenant_id, net_name):
+        # (network_type, switch_name, vlan_tag, max_ingress_rate,
+        # max_ingress_burst) from the name of a network.
         properties = net_name.split(':')
 
         LOG.debug("PRUTH: len(properties) = %d" % (len(properties)))
@@ -165,11 +299,94 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
             max_ingress_rate =  0
             max_ingress_burst = 0
 
-            
+        return (network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst)
 
-        neuca_db.add_network_properties(str(net.uuid), network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst) 
-        return self._make_net_dict(str(net.uuid), net.name, [],
-                                        net.op_status)
+    def _allocate_vlan(self, net_id, switch_name, vlan_tag, session):
+        # The VLAN the network gets: a free one for "auto", else the one
+        # named, recorded as used in session.
+        if vlan_tag == VLAN_AUTO:
+            return self.vlans.acquire(switch_name, net_id, session)
+        if str(vlan_tag).isdigit() and VLAN_MIN <= int(vlan_tag) <= VLAN_MAX:
+            if not self.vlans.reserve(switch_name, int(vlan_tag), net_id, session):
+                raise VLANInUse(vlan_id=vlan_tag, switch_name=switch_name)
+        return vlan_tag
+
+    def create_network(self, tenant_id, net_name, **kwargs):
+        return self.create_networks(tenant_id, [net_name])[0]
+
+    def create_networks(self, tenant_id, net_names):
+        """
+        Creates several networks, named as for create_network, in one
+        transaction; either all of them are created or none.
+        """
+        nets = self._in_transaction(self._add_networks, tenant_id, net_names)
+        return [self._make_net_dict(str(net.uuid), net.name, [], net.op_status)
+                for net in nets]
+
+    def create_networks_and_ports(self, tenant_id, net_names, ports):
+        """
+        Creates networks, named as for create_network, and ports, given
+        as for create_ports, in one transaction; either all of them are
+        created or none.  The net_id of a port may also be the index in
+        net_names of a network created here.  Returns the networks and
+        the ports created.
+        """
+        def add(session):
+            nets = self._add_networks(session, tenant_id, net_names)
+            net_ids = [str(net.uuid) for net in nets]
+            net_ports = []
+            for (net_id, port_state, remote_iface_id) in ports:
+                if isinstance(net_id, (int, long)):
+                    if not 0 <= net_id < len(net_ids):
+                        raise q_exc.NetworkNotFound(net_id=net_id)
+                    net_id = net_ids[net_id]
+                net_ports.append((net_id, port_state, remote_iface_id))
+            return (nets, self._add_ports(session, tenant_id, net_ports))
+
+        (nets, new_ports) = self._in_transaction(add)
+        return ([self._make_net_dict(str(net.uuid), net.name, [], net.op_status)
+                 for net in nets],
+                [self._make_port_dict(port) for port in new_ports])
+
+    def _in_transaction(self, func, *args):
+        # Returns func(session, *args) run in one transaction, started
+        # over if a VLAN picked in it was taken by another worker meanwhile.
+        for attempt in range(VLAN_ALLOCATE_ATTEMPTS):
+            try:
+                with neuca_db.transaction() as session:
+                    return func(session, *args)
+            except VLANTaken, e:
+                self.vlans.forget()
+                LOG.debug("%s; starting over" % e)
+            except:
+                # The VLANs allocated in the session were rolled back too.
+                self.vlans.forget()
+                raise
+        raise NoFreeVLANException("VLANs kept being taken by other networks")
+
+    def _add_networks(self, session, tenant_id, net_names):
+        # Adds the networks and their properties in session; returns the
+        # networks.  The uuids are generated before storing, for
+        # allocating VLANs; the VLANs are allocated in the same session
+        # (see _in_transaction).
+        nets = []
+        properties = []
+        for net_name in net_names:
+            net = models.Network(tenant_id, net_name, OperationalStatus.UP)
+            (network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst) = \
+                self._network_properties(tenant_id, net_name)
+            nets.append(net)
+            vlan_tag = self._allocate_vlan(str(net.uuid), switch_name, vlan_tag, session)
+            properties.append((str(net.uuid), network_type, switch_name, vlan_tag,
+                               max_ingress_rate, max_ingress_burst))
+
+        session.add_all(nets)
+        session.flush()
+        neuca_db.add_network_properties_bulk(properties, session=session)
+
+        for (net, net_properties) in zip(nets, properties):
+            LOG.debug("PRUTH: Created network: %s %s" % (net, net_properties))
+        return nets
 
     def delete_network(self, tenant_id, net_id):
         db.validate_network_ownership(tenant_id, net_id)
@@ -181,6 +398,7 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
                 raise q_exc.NetworkInUse(net_id=net_id)
         net = db.network_destroy(net_id)
         neuca_db.remove_network_properties(net_id)
+        self.vlans.release(net_id)
         return self._make_net_dict(str(net.uuid), net.name, [],
                                         net.op_status)
 
@@ -193,10 +411,22 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
 
     def update_network(self, tenant_id, net_id, **kwargs):
         db.validate_network_ownership(tenant_id, net_id)
-        net = db.network_update(net_id, tenant_id, **kwargs)
 
-        #LOG.debug("PRUTH: update_network: %s %s" % (net, kwargs['name']))
-        update_network_properties(net.network_id, net.network_type, net.switch_name, net.vlan_tag, net.max_ingress_rate, net.max_ingress_burst)
+        # The network and the properties its name gives, in one
+        # transaction; as db.network_update does, but in our session.
+        with neuca_db.transaction() as session:
+            net = session.merge(db.network_get(net_id))
+            for key in kwargs.keys():
+                net[key] = kwargs[key]
+            session.flush()
+
+            #LOG.debug("PRUTH: update_network: %s %s" % (net, kwargs['name']))
+            (network_type, switch_name, vlan_tag, max_ingress_rate, max_ingress_burst) = \
+                self._network_properties(tenant_id, net.name)
+            # The network keeps the switch and VLAN allocated to it.
+            neuca_db.update_network_properties(net_id, network_type, None, None,
+                                               max_ingress_rate, max_ingress_burst,
+                                               session=session)
 
         return self._make_net_dict(str(net.uuid), net.name,
                                         None, net.op_status)
@@ -214,11 +444,10 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
                 'attachment': port.interface_id}
 
     def get_all_ports(self, tenant_id, net_id, **kwargs):
-        ids = []
         db.validate_network_ownership(tenant_id, net_id)
-        ports = db.port_list(net_id)
-        # This plugin does not perform filtering at the moment
-        return [{'port-id': str(p.uuid)} for p in ports]
+        (filters, limit, marker) = self._list_options(kwargs, neuca_db.PORT_FILTERS)
+        return [{'port-id': str(uuid)} for (uuid,) in
+                neuca_db.port_list(net_id, filters, limit, marker)]
 
     def create_port(self, tenant_id, net_id, port_state=None, **kwargs):
         LOG.debug("PRUTH: Creating port with network_id: %s" % net_id)
@@ -228,21 +457,31 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
         if tenant_id != neuca_tenant_id:
             db.validate_network_ownership(tenant_id, net_id)
             #new_mac = None
-        #else:
+        else:
+            # As db.port_create does; raises if the network does not exist.
+            db.network_get(net_id)
             #new_mac = str(quantum.common.utils.generate_mac())
-        #    pass
 
-        port = db.port_create(net_id, port_state,
-                                op_status=OperationalStatus.DOWN)
-        
+        port = models.Port(net_id, OperationalStatus.DOWN)
+        port.state = self._port_state(port_state)
+        with neuca_db.transaction() as session:
+            session.add(port)
+            session.flush()
+            neuca_db.add_port_properties(port.uuid, None, None, session=session)
 
         LOG.debug("PRUTH: neuca_tenant_id: %s, net_id: %s, interface_id: %s" % (neuca_tenant_id, net_id, port.interface_id))
         LOG.debug("PRUTH: kwargs:%s" % (str(kwargs)))
-        
-        neuca_db.add_port_properties(port.uuid,None,None)
 
         return self._make_port_dict(port)
 
+    def _port_state(self, port_state):
+        # The state of a new port, checked as db.port_create does.
+        if port_state is None:
+            return "DOWN"
+        if port_state not in ("ACTIVE", "DOWN"):
+            raise q_exc.StateInvalid(port_state=port_state)
+        return port_state
+
     def delete_port(self, tenant_id, net_id, port_id):
         db.validate_port_ownership(tenant_id, net_id, port_id)
         port = db.port_destroy(port_id, net_id)
@@ -266,9 +505,63 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
         port = db.port_get(port_id, net_id)
         return self._make_port_dict(port)
 
-    def plug_interface(self, tenant_id, net_id, port_id, remote_iface_id):
-        db.validate_port_ownership(tenant_id, net_id, port_id)
-        db.port_set_attachment(port_id, net_id, remote_iface_id)
+    def create_ports(self, tenant_id, ports):
+        """
+        Creates several ports, each given as (net_id, port_state,
+        remote_iface_id), and plugs the interfaces of those with a
+        remote_iface_id; the networks, states and attachments of the whole
+        batch are validated up front and everything is written in one
+        transaction.
+        """
+        with neuca_db.transaction() as session:
+            new_ports = self._add_ports(session, tenant_id, ports)
+        return [self._make_port_dict(port) for port in new_ports]
+
+    def _add_ports(self, session, tenant_id, ports):
+        # Adds the ports and their properties in session; returns the
+        # ports.
+        neuca_tenant_id = self.config.get("NEUCA", "neuca_tenant_id")
+
+        tenants = neuca_db.network_tenants(set(net_id for (net_id, state, iface_id) in ports),
+                                           session)
+        for (net_id, port_state, remote_iface_id) in ports:
+            # As create_port: others may add ports to networks of the
+            # NEuca tenant only if they own them.
+            if net_id not in tenants or \
+                    (tenant_id != neuca_tenant_id and tenants[net_id] != tenant_id):
+                raise q_exc.NetworkNotFound(net_id=net_id)
+
+        new_ports = []
+        properties = []
+        attached = {}
+        for (net_id, port_state, remote_iface_id) in ports:
+            port = models.Port(net_id, OperationalStatus.DOWN)
+            port.state = self._port_state(port_state)
+            if remote_iface_id:
+                if remote_iface_id in attached:
+                    raise q_exc.AlreadyAttached(net_id=net_id, port_id=port.uuid,
+                                                att_id=remote_iface_id,
+                                                att_port_id=attached[remote_iface_id])
+                attached[remote_iface_id] = port.uuid
+                port.interface_id = remote_iface_id
+            (vm_id, vm_mac) = self._iface_properties(tenant_id, remote_iface_id)
+            new_ports.append(port)
+            properties.append((port.uuid, vm_mac, vm_id))
+
+        plugged = neuca_db.attached_ports(attached, session)
+        if plugged:
+            (iface_id, (net_id, port_id)) = sorted(plugged.items())[0]
+            raise q_exc.AlreadyAttached(net_id=net_id, port_id=attached[iface_id],
+                                        att_id=iface_id, att_port_id=port_id)
+        session.add_all(new_ports)
+        session.flush()
+        neuca_db.add_port_properties_bulk(properties, session=session)
+        return new_ports
+
+    def _iface_properties(self, tenant_id, remote_iface_id):
+        # (vm_id, vm_mac) from the id of an interface plugged in.
+        if not remote_iface_id:
+            return (None, None)
 
         iface_properties = remote_iface_id.split('.')
 
@@ -282,7 +575,13 @@ class NEUCAQuantumPlugin(QuantumPluginBase):
             LOG.debug("PRUTH: not enough iface properites or not neuca: len(iface_properties) = %d, %s" % (len(iface_properties),remote_iface_id))
             vm_id = None
             vm_mac = None
+        return (vm_id, vm_mac)
+
+    def plug_interface(self, tenant_id, net_id, port_id, remote_iface_id):
+        db.validate_port_ownership(tenant_id, net_id, port_id)
+        db.port_set_attachment(port_id, net_id, remote_iface_id)
 
+        (vm_id, vm_mac) = self._iface_properties(tenant_id, remote_iface_id)
         neuca_db.update_port_properties_iface(port_id, vm_id, vm_mac)
 
     def unplug_interface(self, tenant_id, net_id, port_id):
@@ -39,6 +39,11 @@ filterlist = [
     # quantum/plugins/neuca/agent/neuca_quantum_agent.py:
     filters.CommandFilter("/sbin/vconfig", "root"),
 
+    # quantum/plugins/neuca/agent/links.py:
+    #   "ip", "link", ...
+    filters.CommandFilter("/sbin/ip", "root"),
+    filters.CommandFilter("/usr/sbin/ip", "root"),
+
     # quantum/plugins/neuca/agent/neuca_quantum_agent.py:
     filters.CommandFilter("/usr/sbin/tunctl", "root"),
     ]
@@ -0,0 +1,248 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Long-lived mode for neuca-rootwrap.
+#
+# Started once (via "sudo neuca-rootwrap --daemon") by the agent, it listens
+# on a private unix socket and runs the commands the agent sends, after
+# checking them against the same filter list used by the one-shot wrapper.
+# This avoids paying for sudo and a python interpreter on every command.
+#
+# Protocol: one JSON object per line in each direction.
+#   request:  {"cmd": ["ovs-vsctl", "--timeout=2", "show"]}
+#   reply:    {"returncode": 0, "stdout": "...", "stderr": "..."}
+#
+# Link changes (see quantum.plugins.neuca.agent.netlink) are applied over
+# one rtnetlink socket kept open by the daemon:
+#   request:  {"link": [{"op": "set", "name": "eth1.100", "up": true}]}
+#   reply:    {"returncode": 0, "results": [0], "stdout": "", "stderr": ""}
+# A batch is refused as a whole unless the "ip link" command of each of
+# its operations passes the filters, and each changes a link the agent
+# manages (see LinkFilter).
+#
+# The socket path is written to stdout once the daemon is ready.  The
+# daemon exits when its stdin is closed, i.e. when the agent goes away.
+
+import ConfigParser
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+from quantum.plugins.neuca.agent import netlink
+from quantum.plugins.neuca.agent.links import ip_command
+
+
+RC_UNAUTHORIZED = 99
+RC_NOCOMMAND = 98
+
+# Read for the data plane interfaces the agent manages; not taken from
+# the agent, which may not widen what it is allowed to change.
+NEUCA_CONFIG = "/etc/quantum/plugins/neuca/neuca_quantum_plugin.ini"
+
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+
+def _allowed_uids():
+    uids = set([0, os.getuid()])
+    if os.environ.get("SUDO_UID"):
+        uids.add(int(os.environ["SUDO_UID"]))
+    return uids
+
+
+def _peer_uid(conn):
+    creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def run_command(filters, match_filter, userargs):
+    if not userargs:
+        return {"returncode": RC_NOCOMMAND, "stdout": "",
+                "stderr": "No command specified"}
+
+    filtermatch = match_filter(filters, userargs)
+    if not filtermatch:
+        return {"returncode": RC_UNAUTHORIZED, "stdout": "",
+                "stderr": "Unauthorized command: %s" % ' '.join(userargs)}
+
+    try:
+        obj = subprocess.Popen(filtermatch.get_command(userargs),
+                               stdin=open(os.devnull),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               close_fds=True,
+                               env=filtermatch.get_environment(userargs))
+        (out, err) = obj.communicate()
+    except OSError, e:
+        return {"returncode": RC_NOCOMMAND, "stdout": "", "stderr": str(e)}
+
+    # latin-1 round-trips arbitrary bytes through JSON.
+    return {"returncode": obj.returncode,
+            "stdout": out.decode("latin-1"),
+            "stderr": err.decode("latin-1")}
+
+
+def managed_ifaces(config_file=NEUCA_CONFIG):
+    """The data plane interfaces named in [NETWORKS] of the plugin
+    configuration."""
+    config = ConfigParser.ConfigParser()
+    try:
+        config.read(config_file)
+        return set(iface for (switch_name, iface) in config.items("NETWORKS"))
+    except ConfigParser.Error:
+        return set()
+
+
+class LinkFilter(object):
+    """Allows link operations only on the links the agent manages: the
+    VLAN interfaces "<iface>.<vlan>" and bridges "br-<iface>-<vlan>" of
+    the data plane interfaces, and VM interfaces "vif-<port>"."""
+
+    VLAN_RE = re.compile(r"^(.+)\.(\d+)$")
+    BRIDGE_RE = re.compile(r"^br-(.+)-(\d+)$")
+    VIF_RE = re.compile(r"^vif-[0-9A-Za-z-]{1,11}$")
+
+    def __init__(self, ifaces):
+        self.ifaces = set(ifaces)
+
+    def _of_iface(self, regex, name):
+        match = regex.match(name)
+        return match is not None and match.group(1) in self.ifaces
+
+    def allowed(self, op):
+        name = op.get("name")
+        if not isinstance(name, basestring):
+            return False
+        kind = op.get("op")
+        if kind == "add_vlan":
+            return (op.get("parent") in self.ifaces and
+                    name == "%s.%s" % (op.get("parent"), op.get("vlan")))
+        if kind == "delete":
+            return self._of_iface(self.VLAN_RE, name)
+        if kind == "set":
+            return (self._of_iface(self.VLAN_RE, name) or
+                    self._of_iface(self.BRIDGE_RE, name) or
+                    self.VIF_RE.match(name) is not None)
+        return False
+
+
+# Opened on the first link request, so that the daemon runs commands even
+# where rtnetlink cannot be used.
+_netlink = None
+_netlink_lock = threading.Lock()
+
+
+def _netlink_socket():
+    global _netlink
+    with _netlink_lock:
+        if _netlink is None:
+            _netlink = netlink.NetlinkSocket().open()
+        return _netlink
+
+
+def apply_links(ops, filters, match_filter, link_filter):
+    try:
+        if not isinstance(ops, list) or [op for op in ops if not isinstance(op, dict)]:
+            raise netlink.NetlinkError("link operations must be a list of objects")
+        for op in ops:
+            if not link_filter.allowed(op) or not match_filter(filters, ip_command(op)):
+                return {"returncode": RC_UNAUTHORIZED, "stdout": "",
+                        "stderr": "Unauthorized link operation: %s" % json.dumps(op)}
+        results = _netlink_socket().apply(ops)
+    except (netlink.NetlinkError, KeyError, ValueError, TypeError), e:
+        return {"returncode": RC_NOCOMMAND, "stdout": "", "stderr": str(e)}
+    return {"returncode": 0, "results": results, "stdout": "", "stderr": ""}
+
+
+def handle_connection(conn, filters, match_filter, link_filter):
+    try:
+        if _peer_uid(conn) not in _allowed_uids():
+            return
+
+        f = conn.makefile("rb")
+        for line in iter(f.readline, ""):
+            if not line.endswith("\n"):
+                # Cut short by the agent going away; never run it.
+                break
+            try:
+                request = json.loads(line)
+                if "link" in request:
+                    reply = apply_links(request["link"], filters, match_filter,
+                                        link_filter)
+                else:
+                    reply = run_command(filters, match_filter,
+                                        [str(a) for a in request["cmd"]])
+            except (ValueError, KeyError, TypeError):
+                reply = {"returncode": RC_NOCOMMAND, "stdout": "",
+                         "stderr": "Malformed request"}
+            conn.sendall(json.dumps(reply) + "\n")
+    except socket.error:
+        pass
+    finally:
+        conn.close()
+
+
+def serve(filters, match_filter):
+    # Only the invoking (sudo) user may reach the socket.
+    sock_dir = tempfile.mkdtemp(prefix="neuca-rootwrap-")
+    sock_path = os.path.join(sock_dir, "rootwrap.sock")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    os.chmod(sock_path, 0600)
+    if os.environ.get("SUDO_UID"):
+        uid = int(os.environ["SUDO_UID"])
+        gid = int(os.environ.get("SUDO_GID", -1))
+        os.chown(sock_dir, uid, gid)
+        os.chown(sock_path, uid, gid)
+    server.listen(16)
+
+    link_filter = LinkFilter(managed_ifaces())
+
+    def accept_loop():
+        while True:
+            try:
+                (conn, _) = server.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=handle_connection,
+                                 args=(conn, filters, match_filter, link_filter))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept_loop)
+    t.daemon = True
+    t.start()
+
+    sys.stdout.write(sock_path + "\n")
+    sys.stdout.flush()
+
+    # Run until the agent closes our stdin (or exits).
+    try:
+        while sys.stdin.read(4096):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        shutil.rmtree(sock_dir, ignore_errors=True)
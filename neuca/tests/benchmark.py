@@ -0,0 +1,295 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# Runs NEUCAQuantumAgent reconcile cycles against the stand-ins in fakes.py
+# and a seeded SQLite database, and reports what each cycle costs:
+#
+#   python -m quantum.plugins.neuca.tests.benchmark [--scales 10,100,1000]
+#       [--interfaces 2] [--networks 10] [--cycles 5] [--workers 4] [--ovsdb]
+#
+# For every scale (number of VMs) three kinds of cycle are measured:
+#
+#   create    the first cycle, building all bridges and attaching all ports
+#   steady    the following cycles, with nothing left to change
+#   cold      the first cycle of an agent restarted without a checkpoint
+#   warm      the first cycle of an agent restarted from its checkpoint
+#   teardown  the cycle after all ports were removed from the database
+#
+# Commands are the ovs-vsctl runs the agent would have forked (or with
+# --ovsdb, the JSON-RPC transactions it sent to the fake ovsdb-server)
+# plus the rtnetlink requests it sent; libvirt calls and database
+# statements come from the agent's own metrics.  Memory is the peak RSS of
+# the benchmark process so far.
+
+import logging as LOG
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from optparse import OptionParser
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+
+from quantum.plugins.neuca import neuca_db_benchmark
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent import neuca_quantum_agent as agent_module
+from quantum.plugins.neuca.agent.domain_index import DomainInterfaceIndex
+from quantum.plugins.neuca.agent.host_interfaces import HostInterfaceInventory
+from quantum.plugins.neuca.agent.libvirt_connection import LibvirtConnection
+from quantum.plugins.neuca.agent.links import LinkManager
+from quantum.plugins.neuca.agent.ovs_network import OVS_Network
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+from quantum.plugins.neuca.tests import fakes
+
+
+TENANT_ID = 'neuca'
+ALL_INSTANCES = agent_module.ALL_INSTANCES
+# switch name -> host interface, as in the [NETWORKS] section.
+SWITCHES = {'data': 'eth1', 'management': 'eth0'}
+
+CONFIG_TEMPLATE = """[DATABASE]
+sql_connection = %(sql_connection)s
+
+[NEUCA]
+integration-bridge = br-int
+neuca_tenant_id = %(tenant_id)s
+verbose = false
+log_dir = %(log_dir)s
+
+[AGENT]
+root_helper = sudo
+actuation_workers = %(workers)d
+state_file = %(state_file)s
+
+[NETWORKS]
+%(networks)s
+"""
+
+
+def write_config(path, sql_connection, log_dir, workers, state_file):
+    networks = "\n".join("%s = %s" % item for item in sorted(SWITCHES.items()))
+    f = open(path, "w")
+    try:
+        f.write(CONFIG_TEMPLATE % {"sql_connection": sql_connection, "tenant_id": TENANT_ID,
+                                   "log_dir": log_dir, "workers": workers,
+                                   "state_file": state_file, "networks": networks})
+    finally:
+        f.close()
+
+
+def define_tables(meta):
+    Table('neuca_generation', meta,
+          Column('scope', String(255), primary_key=True),
+          Column('generation', Integer, nullable=False))
+    return neuca_db_benchmark.define_tables(meta)
+
+
+def bump_generation(conn, meta):
+    # What neuca_db.bump_generation does for network changes, so that the
+    # agent does not keep using the desired state it cached.
+    generation = meta.tables['neuca_generation']
+    row = conn.execute(generation.select(generation.c.scope == ALL_INSTANCES)).fetchone()
+    if row is None:
+        conn.execute(generation.insert(), {'scope': ALL_INSTANCES, 'generation': 1})
+    else:
+        conn.execute(generation.update(generation.c.scope == ALL_INSTANCES),
+                     {'generation': row.generation + 1})
+
+
+def vm_name(i):
+    return 'instance-%08x' % i
+
+
+def seed(engine, meta, tables, num_vms, num_interfaces, num_networks):
+    """Networks shared by all VMs; interface j of every VM is on network
+    j % num_networks."""
+    (networks, ports, network_properties, port_properties) = tables
+    switch_names = sorted(SWITCHES.keys())
+
+    net_ids = []
+    net_rows = []
+    net_prop_rows = []
+    for n in range(num_networks):
+        net_id = str(uuid.uuid4())
+        switch_name = switch_names[n % len(switch_names)]
+        vlan = n + 100
+        net_ids.append(net_id)
+        net_rows.append({'uuid': net_id, 'tenant_id': TENANT_ID,
+                         'name': 'vlan:%s:%d' % (switch_name, vlan), 'op_status': 'UP'})
+        net_prop_rows.append({'network_id': net_id, 'network_type': 'vlan',
+                              'switch_name': switch_name, 'vlan_tag': vlan,
+                              'max_ingress_rate': 0, 'max_ingress_burst': 0})
+
+    port_rows = []
+    port_prop_rows = []
+    for i in range(num_vms):
+        for j in range(num_interfaces):
+            port_id = str(uuid.uuid4())
+            mac = 'fe:16:3e:%02x:%02x:%02x' % ((i >> 8) & 0xff, i & 0xff, j & 0xff)
+            port_rows.append({'uuid': port_id, 'network_id': net_ids[j % num_networks],
+                              'interface_id': vm_name(i) + '.' + mac,
+                              'state': 'ACTIVE', 'op_status': 'UP'})
+            port_prop_rows.append({'port_id': port_id, 'mac_addr': mac, 'vm_id': vm_name(i)})
+
+    conn = engine.connect()
+    try:
+        for table in (port_properties, ports, network_properties, networks):
+            conn.execute(table.delete())
+        conn.execute(networks.insert(), net_rows)
+        conn.execute(network_properties.insert(), net_prop_rows)
+        if port_rows:
+            conn.execute(ports.insert(), port_rows)
+            conn.execute(port_properties.insert(), port_prop_rows)
+        bump_generation(conn, meta)
+    finally:
+        conn.close()
+
+
+def delete_ports(engine, meta, tables):
+    (networks, ports, network_properties, port_properties) = tables
+    conn = engine.connect()
+    try:
+        conn.execute(port_properties.delete())
+        conn.execute(ports.delete())
+        bump_generation(conn, meta)
+    finally:
+        conn.close()
+
+
+def counter_value(counter):
+    return sum(counter.values.values())
+
+
+def run_cycles(agent, host, count):
+    """Runs count reconcile cycles; returns (seconds, commands, libvirt
+    calls, db queries, results) summed over them."""
+    commands = host.count()
+    libvirt_calls = counter_value(metrics.LIBVIRT_CALLS)
+    db_queries = counter_value(metrics.DB_QUERIES)
+    results = []
+
+    start = time.time()
+    for i in range(count):
+        results.append(agent.reconcile_once())
+    elapsed = time.time() - start
+
+    return (elapsed, host.count() - commands,
+            counter_value(metrics.LIBVIRT_CALLS) - libvirt_calls,
+            counter_value(metrics.DB_QUERIES) - db_queries, results)
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report(num_vms, kind, count, measured):
+    (elapsed, commands, libvirt_calls, db_queries, results) = measured
+    print "%8d  %-8s  %6d  %10.1f  %10.1f  %10.1f  %10.1f  %8.1f  %s" % \
+        (num_vms, kind, count, elapsed * 1000.0 / count, float(commands) / count,
+         float(libvirt_calls) / count, float(db_queries) / count, max_rss_mb(),
+         ",".join(sorted(set(results))))
+
+
+def forget_state(agent):
+    # What a restarted agent starts with.
+    agent.converged_fingerprints = None
+    agent_module.NEUCAQuantumAgent.desired_state = None
+    agent_module.NEUCAQuantumAgent.desired_state_key = None
+    agent_module.NEUCAQuantumAgent.checkpointed_state = None
+    agent_module.NEUCABridge.domain_index = DomainInterfaceIndex()
+
+
+def benchmark_scale(agent, engine, meta, tables, workdir, num_vms, options):
+    host = fakes.FakeHost(os.path.join(workdir, "host-%d" % num_vms))
+    RootHelper.execute = classmethod(lambda cls, args: host.execute(args))
+    LinkManager.set_netlink(fakes.FakeRtnlSocket(host))
+    OVS_Network.set_ovsdb_connection(None)
+    if options.ovsdb:
+        OVS_Network.ovsdb = fakes.FakeOVSDBClient(host.ovsdb_server)
+    LibvirtConnection.conn = fakes.FakeConnection(host, [vm_name(i) for i in range(num_vms)])
+    forget_state(agent)
+    agent_module.NEUCABridge.host_interfaces = HostInterfaceInventory(host.sys_class_net,
+                                                                      host.proc_net_vlan_config)
+
+    seed(engine, meta, tables, num_vms, options.interfaces, options.networks)
+
+    report(num_vms, "create", 1, run_cycles(agent, host, 1))
+    report(num_vms, "steady", options.cycles, run_cycles(agent, host, options.cycles))
+    forget_state(agent)
+    report(num_vms, "cold", 1, run_cycles(agent, host, 1))
+    forget_state(agent)
+    agent.load_checkpoint(agent.state_file)
+    report(num_vms, "warm", 1, run_cycles(agent, host, 1))
+    delete_ports(engine, meta, tables)
+    report(num_vms, "teardown", 1, run_cycles(agent, host, 1))
+    LOG.info("Commands by program at %d VMs: %s" % (num_vms, host.commands))
+
+
+def main():
+    usagestr = "%prog [OPTIONS]"
+    parser = OptionParser(usage=usagestr)
+    parser.add_option("--scales", dest="scales", default="10,100,1000",
+      help="Comma separated numbers of VMs to run at [%default]")
+    parser.add_option("--interfaces", dest="interfaces", type="int", default=2,
+      help="Interfaces per VM [%default]")
+    parser.add_option("--networks", dest="networks", type="int", default=10,
+      help="Networks (bridges) the interfaces are spread over [%default]")
+    parser.add_option("--cycles", dest="cycles", type="int", default=5,
+      help="Steady state cycles run per scale [%default]")
+    parser.add_option("--workers", dest="workers", type="int",
+      default=agent_module.ACTUATION_WORKERS,
+      help="Actuation worker threads [%default]")
+    parser.add_option("--ovsdb", dest="ovsdb", action="store_true", default=False,
+      help="Talk JSON-RPC to a fake ovsdb-server instead of running ovs-vsctl")
+
+    options, args = parser.parse_args()
+
+    if args or options.networks < 1 or options.cycles < 1:
+        parser.print_help()
+        sys.exit(1)
+    scales = [int(s) for s in options.scales.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="neuca-benchmark-")
+    try:
+        db_path = os.path.join(workdir, "neuca.db")
+
+        engine = create_engine("sqlite:///" + db_path)
+        meta = MetaData()
+        tables = define_tables(meta)
+        meta.create_all(engine)
+
+        config_file = os.path.join(workdir, "neuca_quantum_plugin.ini")
+        write_config(config_file, "sqlite:///" + db_path, os.path.join(workdir, "log"),
+                     options.workers, os.path.join(workdir, "agent-state.json"))
+        agent = agent_module.NEUCAQuantumAgent(config_file)
+
+        print "%8s  %-8s  %6s  %10s  %10s  %10s  %10s  %8s  %s" % \
+            ("vms", "cycle", "cycles", "ms/cycle", "cmds/cycle", "libvirt", "db",
+             "rss MB", "result")
+        for num_vms in scales:
+            benchmark_scale(agent, engine, meta, tables, workdir, num_vms, options)
+    finally:
+        OVS_Network.set_ovsdb_connection(None)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
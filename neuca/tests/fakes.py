@@ -0,0 +1,1192 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+#
+# In-memory stand-ins for the host the agent manages, used by benchmark.py
+# and the unit tests:
+#
+#   FakeHost.execute  replaces RootHelper.execute and understands the
+#                     ovs-vsctl invocations the agent makes, keeping Open
+#                     vSwitch state in memory (FakeOVS).
+#   FakeOVSDBServer   serves the same FakeOVS over RFC 7047 JSON-RPC
+#                     ("transact", "monitor"), on socket pairs handed to
+#                     FakeOVSDBClient, for the agent's OVSDB backend.
+#   FakeRtnlSocket    stands in for the agent's rtnetlink socket (see
+#                     LinkManager.set_netlink), keeping the host's links in
+#                     memory and in a fake /sys/class/net and
+#                     /proc/net/vlan/config.
+#   FakeConnection    plays a libvirt connection with a set of domains;
+#                     attaching an interface plugs it into the fake OVS,
+#                     as libvirt does for openvswitch virtualports.
+
+import errno
+import json
+import os
+import re
+import shutil
+import socket
+import struct
+import threading
+import uuid
+
+from quantum.plugins.neuca.agent import netlink
+from quantum.plugins.neuca.agent.ovsdb_client import OVSDB_Client
+
+# Links present on a fresh fake host.
+HOST_LINKS = ["lo", "eth0", "eth1"]
+
+
+def _refs(table):
+    return {"key": {"type": "uuid", "refTable": table}, "min": 0, "max": "unlimited"}
+
+_STRING_MAP = {"key": "string", "value": "string", "min": 0, "max": "unlimited"}
+_QOS = {"key": {"type": "integer", "minInteger": 0}}
+
+# The part of the Open_vSwitch schema the agent uses, as get_schema
+# returns it.  Bridges, ports and interfaces are garbage collected once
+# nothing refers to them any more.
+SCHEMA = {
+    "name": "Open_vSwitch",
+    "version": "7.6.0",
+    "tables": {
+        "Open_vSwitch": {
+            "isRoot": True,
+            "maxRows": 1,
+            "columns": {
+                "bridges": {"type": _refs("Bridge")},
+                "next_cfg": {"type": "integer"},
+                "cur_cfg": {"type": "integer"},
+            },
+        },
+        "Bridge": {
+            "indexes": [["name"]],
+            "columns": {
+                "name": {"type": "string", "mutable": False},
+                "ports": {"type": _refs("Port")},
+                "external_ids": {"type": _STRING_MAP},
+            },
+        },
+        "Port": {
+            "indexes": [["name"]],
+            "columns": {
+                "name": {"type": "string", "mutable": False},
+                "tag": {"type": {"key": {"type": "integer", "minInteger": 0, "maxInteger": 4095},
+                                 "min": 0, "max": 1}},
+                "interfaces": {"type": dict(_refs("Interface"), min=1)},
+                "external_ids": {"type": _STRING_MAP},
+            },
+        },
+        "Interface": {
+            "indexes": [["name"]],
+            "columns": {
+                "name": {"type": "string", "mutable": False},
+                "type": {"type": "string"},
+                "ofport": {"type": {"key": "integer", "min": 0, "max": 1}},
+                "external_ids": {"type": _STRING_MAP},
+                "options": {"type": _STRING_MAP},
+                "statistics": {"type": {"key": "string", "value": "integer",
+                                        "min": 0, "max": "unlimited"}},
+                "ingress_policing_rate": {"type": _QOS},
+                "ingress_policing_burst": {"type": _QOS},
+            },
+        },
+    },
+}
+
+_ATOM_DEFAULTS = {"integer": 0, "real": 0.0, "boolean": False, "string": "", "uuid": None}
+
+
+# Exception thrown for a failed OVSDB operation; becomes the error
+# object in the "transact" result.
+class TransactError(Exception):
+
+    def __init__(self, error, details=""):
+        Exception.__init__(self, "%s: %s" % (error, details))
+        self.error = error
+        self.details = details
+
+    def result(self):
+        return {"error": self.error, "details": self.details}
+
+
+def _atom_type(atom_type):
+    if isinstance(atom_type, dict):
+        return (atom_type["type"], atom_type.get("refTable"))
+    return (atom_type, None)
+
+
+class ColumnType(object):
+    """The type of one column; values are atoms, lists (sets) or dicts (maps)."""
+
+    def __init__(self, column, spec):
+        self.column = column
+        self.mutable = spec.get("mutable", True)
+        col_type = spec["type"]
+        if not isinstance(col_type, dict):
+            col_type = {"key": col_type}
+        (self.key, self.ref) = _atom_type(col_type["key"])
+        self.value = None
+        if "value" in col_type:
+            self.value = _atom_type(col_type["value"])[0]
+        self.min = col_type.get("min", 1)
+        self.max = col_type.get("max", 1)
+
+    def is_map(self):
+        return self.value is not None
+
+    def is_scalar(self):
+        return self.value is None and self.min == 1 and self.max == 1
+
+    def default(self):
+        if self.is_map():
+            return {}
+        if self.is_scalar():
+            return _ATOM_DEFAULTS[self.key]
+        return []
+
+    def canonical(self, value):
+        # A hashable form for comparing values.
+        if self.is_map():
+            return tuple(sorted(value.items()))
+        if self.is_scalar():
+            return value
+        return tuple(sorted(value))
+
+    def refs(self, value):
+        if self.ref is None:
+            return []
+        if self.is_scalar():
+            return [value]
+        return list(value)
+
+    # RFC 7047 <value> notation.
+
+    def _atom_to_json(self, atom_type, atom):
+        if atom_type == "uuid":
+            return ["uuid", atom]
+        return atom
+
+    def _atom_from_json(self, atom_type, datum, named):
+        if atom_type == "uuid":
+            if isinstance(datum, list) and len(datum) == 2:
+                if datum[0] == "uuid":
+                    return str(datum[1])
+                if datum[0] == "named-uuid":
+                    if datum[1] not in named:
+                        raise TransactError("unknown named-uuid", str(datum[1]))
+                    return named[datum[1]]
+            raise TransactError("syntax error", "%s is not a <uuid>" % json.dumps(datum))
+
+        if isinstance(datum, unicode):
+            datum = str(datum)
+        valid = {"integer": (int, long), "real": (int, long, float), "boolean": bool,
+                 "string": str}[atom_type]
+        if not isinstance(datum, valid) or (atom_type != "boolean" and isinstance(datum, bool)):
+            raise TransactError("syntax error", "%s is not a <%s> for column %s" %
+                                (json.dumps(datum), atom_type, self.column))
+        return datum
+
+    def to_json(self, value):
+        if self.is_map():
+            return ["map", [[self._atom_to_json(self.key, k), self._atom_to_json(self.value, v)]
+                            for (k, v) in sorted(value.items())]]
+        if self.is_scalar():
+            return self._atom_to_json(self.key, value)
+        if len(value) == 1:
+            return self._atom_to_json(self.key, value[0])
+        return ["set", [self._atom_to_json(self.key, a) for a in value]]
+
+    def _atoms_from_json(self, datum, named):
+        if isinstance(datum, list) and len(datum) == 2 and datum[0] == "set":
+            atoms = []
+            for a in datum[1]:
+                a = self._atom_from_json(self.key, a, named)
+                if a not in atoms:
+                    atoms.append(a)
+            return atoms
+        return [self._atom_from_json(self.key, datum, named)]
+
+    def from_json(self, datum, named=None):
+        named = named or {}
+        if self.is_map():
+            if not (isinstance(datum, list) and len(datum) == 2 and datum[0] == "map"):
+                raise TransactError("syntax error", "%s is not a <map>" % json.dumps(datum))
+            return dict((self._atom_from_json(self.key, k, named),
+                         self._atom_from_json(self.value, v, named)) for (k, v) in datum[1])
+        atoms = self._atoms_from_json(datum, named)
+        if self.is_scalar():
+            if len(atoms) != 1:
+                raise TransactError("syntax error", "column %s takes one value" % self.column)
+            return atoms[0]
+        return atoms
+
+    def keys_from_json(self, datum, named=None):
+        # Keys to delete from a map, given as a set of keys or as a map.
+        if isinstance(datum, list) and len(datum) == 2 and datum[0] == "map":
+            return self.from_json(datum, named).items()
+        return self._atoms_from_json(datum, named or {})
+
+    # ovs-vsctl "set" notation.
+
+    def _atom_from_text(self, atom_type, text):
+        text = text.strip()
+        if atom_type == "integer":
+            return int(text)
+        if atom_type == "real":
+            return float(text)
+        if atom_type == "boolean":
+            return text.lower() == "true"
+        return text.strip('"')
+
+    def from_text(self, text):
+        if self.is_map():
+            pairs = [item.split("=", 1) for item in text.strip("{}").split(",") if "=" in item]
+            return dict((self._atom_from_text(self.key, k), self._atom_from_text(self.value, v))
+                        for (k, v) in pairs)
+        if self.is_scalar():
+            return self._atom_from_text(self.key, text)
+        return [self._atom_from_text(self.key, a) for a in text.strip("[]").split(",") if a.strip()]
+
+
+def _columns(table):
+    columns = dict((column, ColumnType(column, spec))
+                   for (column, spec) in SCHEMA["tables"][table]["columns"].items())
+    columns["_uuid"] = ColumnType("_uuid", {"type": "uuid", "mutable": False})
+    return columns
+
+COLUMNS = dict((table, _columns(table)) for table in SCHEMA["tables"])
+
+
+class FakeOVS(object):
+    """Open vSwitch's database, and what ovs-vswitchd does when it changes.
+
+    Rows are dicts of column -> value and are never changed in place, so
+    that a transaction can be undone by putting back the rows it replaced.
+    """
+
+    def __init__(self, host):
+        # Internal interfaces are links on the host.
+        self.host = host
+        # table -> uuid -> row
+        self.tables = dict((table, {}) for table in SCHEMA["tables"])
+        # table -> name -> set of uuids, for the tables indexed by name
+        self.names = dict((table, {}) for (table, spec) in SCHEMA["tables"].items()
+                          if "indexes" in spec)
+        # uuid -> number of references to that row
+        self.refcounts = {}
+        # (table, uuid) -> row before the running transaction, or None
+        self.dirty = None
+        self.monitors = []
+        self.next_ofport = 1
+        self.root = str(uuid.uuid4())
+        self._set_row("Open_vSwitch", self.root, self._new_row("Open_vSwitch", self.root))
+
+    def _new_row(self, table, row_uuid):
+        row = dict((column, col_type.default())
+                   for (column, col_type) in COLUMNS[table].items())
+        row["_uuid"] = row_uuid
+        return row
+
+    def _index(self, table, row, delta):
+        columns = COLUMNS[table]
+        for (column, col_type) in columns.items():
+            if col_type.ref is None or column == "_uuid":
+                continue
+            for ref in col_type.refs(row[column]):
+                count = self.refcounts.get(ref, 0) + delta
+                if count:
+                    self.refcounts[ref] = count
+                else:
+                    del self.refcounts[ref]
+        names = self.names.get(table)
+        if names is not None:
+            uuids = names.setdefault(row["name"], set())
+            if delta > 0:
+                uuids.add(row["_uuid"])
+            else:
+                uuids.discard(row["_uuid"])
+                if not uuids:
+                    del names[row["name"]]
+
+    def _set_row(self, table, row_uuid, row):
+        rows = self.tables[table]
+        old = rows.get(row_uuid)
+        if old is not None:
+            self._index(table, old, -1)
+            del rows[row_uuid]
+        if row is not None:
+            rows[row_uuid] = row
+            self._index(table, row, 1)
+
+    def _put(self, table, row_uuid, row):
+        # Replaces (or with row None, deletes) a row within a transaction.
+        key = (table, row_uuid)
+        if key not in self.dirty:
+            self.dirty[key] = self.tables[table].get(row_uuid)
+        self._set_row(table, row_uuid, row)
+
+    def _insert(self, table, values, row_uuid=None):
+        row_uuid = row_uuid or str(uuid.uuid4())
+        row = self._new_row(table, row_uuid)
+        row.update(values)
+        self._put(table, row_uuid, row)
+        return row_uuid
+
+    def _update(self, table, row_uuid, values):
+        self._put(table, row_uuid, dict(self.tables[table][row_uuid], **values))
+
+    def _rollback(self):
+        for ((table, row_uuid), row) in self.dirty.items():
+            self._set_row(table, row_uuid, row)
+        self.dirty = None
+
+    def _collect_garbage(self):
+        # Deletes the rows of non-root tables that nothing refers to any
+        # more, and then what only they referred to.
+        candidates = []
+        for ((table, row_uuid), old) in self.dirty.items():
+            new = self.tables[table].get(row_uuid)
+            for row in (old, new):
+                if row is None:
+                    continue
+                for (column, col_type) in COLUMNS[table].items():
+                    if column != "_uuid":
+                        candidates += [(col_type.ref, r) for r in col_type.refs(row[column])]
+            if new is not None:
+                candidates.append((table, row_uuid))
+
+        while candidates:
+            (table, row_uuid) = candidates.pop()
+            if SCHEMA["tables"][table].get("isRoot") or self.refcounts.get(row_uuid):
+                continue
+            row = self.tables[table].get(row_uuid)
+            if row is None:
+                continue
+            self._put(table, row_uuid, None)
+            for (column, col_type) in COLUMNS[table].items():
+                if column != "_uuid":
+                    candidates += [(col_type.ref, r) for r in col_type.refs(row[column])]
+
+    def _check_integrity(self):
+        for ((table, row_uuid), old) in self.dirty.items():
+            row = self.tables[table].get(row_uuid)
+            if row is None:
+                if self.refcounts.get(row_uuid):
+                    raise TransactError("referential integrity violation",
+                                        "cannot delete %s row %s that is still referenced" %
+                                        (table, row_uuid))
+                continue
+            for (column, col_type) in COLUMNS[table].items():
+                if column == "_uuid":
+                    continue
+                value = row[column]
+                for ref in col_type.refs(value):
+                    if ref not in self.tables[col_type.ref]:
+                        raise TransactError("referential integrity violation",
+                                            "%s column %s refers to missing %s row %s" %
+                                            (table, column, col_type.ref, ref))
+                if not col_type.is_scalar() and len(value) < col_type.min:
+                    raise TransactError("constraint violation",
+                                        "%s column %s of %s is empty" % (table, column, row_uuid))
+            names = self.names.get(table)
+            if names is not None and len(names[row["name"]]) > 1:
+                raise TransactError("constraint violation",
+                                    "duplicate %s name %s" % (table, row["name"]))
+
+    def _reconfigure(self, changes):
+        # What ovs-vswitchd does: number new interfaces, create and remove
+        # the links of internal ones, and catch up with next_cfg.
+        for ((table, row_uuid), old) in changes.items():
+            if table != "Interface":
+                continue
+            new = self.tables[table].get(row_uuid)
+            if new is not None and not new["ofport"]:
+                self._set_row(table, row_uuid, dict(new, ofport=[self.next_ofport]))
+                self.next_ofport += 1
+            was_internal = old is not None and old["type"] == "internal"
+            is_internal = new is not None and new["type"] == "internal"
+            if was_internal and not is_internal and old["name"] in self.host.links:
+                self.host.del_link(old["name"])
+            if is_internal and not was_internal and new["name"] not in self.host.links:
+                self.host.add_link(new["name"])
+
+        root = self.tables["Open_vSwitch"][self.root]
+        if root["cur_cfg"] != root["next_cfg"]:
+            changes.setdefault(("Open_vSwitch", self.root), root)
+            self._set_row("Open_vSwitch", self.root, dict(root, cur_cfg=root["next_cfg"]))
+
+    def _notify(self, changes):
+        for (tables, send) in self.monitors:
+            updates = {}
+            for ((table, row_uuid), old) in changes.items():
+                if table not in tables:
+                    continue
+                columns = tables[table]
+                new = self.tables[table].get(row_uuid)
+                if old is new:
+                    continue
+                update = {}
+                if new is not None:
+                    update["new"] = self.row_to_json(table, new, columns)
+                if old is not None:
+                    if new is not None:
+                        columns = [c for c in columns if old[c] != new[c]]
+                        if not columns:
+                            continue
+                    update["old"] = self.row_to_json(table, old, columns)
+                updates.setdefault(table, {})[row_uuid] = update
+            if updates:
+                send(updates)
+
+    def change(self, fn, *args):
+        """Run fn(*args) as one transaction: all of its changes or none."""
+        self.dirty = {}
+        try:
+            result = fn(*args)
+            self._collect_garbage()
+            self._check_integrity()
+        except:
+            self._rollback()
+            raise
+        self._commit()
+        return result
+
+    def _commit(self):
+        changes = self.dirty
+        self.dirty = None
+        self._reconfigure(changes)
+        self._notify(changes)
+
+    def row_to_json(self, table, row, columns):
+        return dict((column, COLUMNS[table][column].to_json(row[column])) for column in columns)
+
+    def find(self, table, record):
+        """The uuid of the row named (or with uuid) record, or None."""
+        if record in self.tables[table]:
+            return record
+        uuids = self.names.get(table, {}).get(record)
+        if uuids:
+            return iter(uuids).next()
+        return None
+
+    # RFC 7047 "transact" and "monitor".
+
+    def _column(self, table, column):
+        try:
+            return COLUMNS[table][column]
+        except KeyError:
+            raise TransactError("unknown column", "no column %s in table %s" % (column, table))
+
+    def _table(self, op):
+        table = op.get("table")
+        if table not in self.tables:
+            raise TransactError("unknown table", str(table))
+        return table
+
+    def _test(self, table, row, condition):
+        (column, function, datum) = condition
+        col_type = self._column(table, column)
+        current = col_type.canonical(row[column])
+        if function in ("==", "!="):
+            equal = current == col_type.canonical(col_type.from_json(datum))
+            return equal == (function == "==")
+        if function in ("includes", "excludes"):
+            value = col_type.from_json(datum)
+            if col_type.is_map():
+                found = [item in row[column].items() for item in value.items()]
+            elif col_type.is_scalar():
+                found = [row[column] == value]
+            else:
+                found = [atom in row[column] for atom in value]
+            if function == "includes":
+                return all(found)
+            return not any(found)
+        if function in ("<", "<=", ">", ">=") and col_type.is_scalar():
+            value = col_type.from_json(datum)
+            return {"<": current < value, "<=": current <= value,
+                    ">": current > value, ">=": current >= value}[function]
+        raise TransactError("syntax error", "unsupported function %s" % function)
+
+    def _where(self, table, where):
+        # The uuids of the rows matching a "where" clause.
+        rows = self.tables[table]
+        if len(where) == 1 and where[0][1] == "==":
+            (column, function, datum) = where[0]
+            if column == "_uuid":
+                row_uuid = self._column(table, column).from_json(datum)
+                return row_uuid in rows and [row_uuid] or []
+            if column == "name" and table in self.names:
+                return list(self.names[table].get(self._column(table, column).from_json(datum), ()))
+        return [row_uuid for (row_uuid, row) in rows.items()
+                if all(self._test(table, row, condition) for condition in where)]
+
+    def _mutate(self, table, row, mutation, named):
+        (column, mutator, datum) = mutation
+        col_type = self._column(table, column)
+        if not col_type.mutable or column == "_uuid":
+            raise TransactError("constraint violation", "column %s is not mutable" % column)
+        value = row[column]
+        if mutator in ("+=", "-=", "*=", "/=", "%=") and col_type.key in ("integer", "real"):
+            operand = col_type._atom_from_json(col_type.key, datum, named)
+            apply = {"+=": lambda a: a + operand, "-=": lambda a: a - operand,
+                     "*=": lambda a: a * operand, "/=": lambda a: a / operand,
+                     "%=": lambda a: a % operand}[mutator]
+            if col_type.is_scalar():
+                return apply(value)
+            return [apply(a) for a in value]
+        if mutator == "insert" and col_type.is_map():
+            return dict(col_type.from_json(datum, named), **value)
+        if mutator == "insert" and not col_type.is_scalar():
+            value = value + [a for a in col_type.from_json(datum, named) if a not in value]
+            if col_type.max != "unlimited" and len(value) > col_type.max:
+                raise TransactError("constraint violation",
+                                    "too many values in column %s" % column)
+            return value
+        if mutator == "delete" and col_type.is_map():
+            keys = col_type.keys_from_json(datum, named)
+            return dict((k, v) for (k, v) in value.items() if k not in keys and (k, v) not in keys)
+        if mutator == "delete" and not col_type.is_scalar():
+            atoms = col_type.from_json(datum, named)
+            return [a for a in value if a not in atoms]
+        raise TransactError("domain error", "cannot apply %s to column %s" % (mutator, column))
+
+    def _operation(self, op, named):
+        kind = op.get("op")
+        if kind == "comment":
+            return {}
+        if kind == "abort":
+            raise TransactError("aborted", "aborted by request")
+        table = self._table(op)
+
+        if kind == "insert":
+            values = {}
+            for (column, datum) in op.get("row", {}).items():
+                col_type = self._column(table, str(column))
+                values[str(column)] = col_type.from_json(datum, named)
+            row_uuid = self._insert(table, values, named.get(op.get("uuid-name")))
+            return {"uuid": ["uuid", row_uuid]}
+
+        uuids = self._where(table, op.get("where", []))
+
+        if kind == "select":
+            columns = [str(c) for c in op.get("columns") or COLUMNS[table].keys()]
+            for column in columns:
+                self._column(table, column)
+            rows = self.tables[table]
+            return {"rows": [self.row_to_json(table, rows[u], columns) for u in uuids]}
+
+        if kind == "update":
+            values = {}
+            for (column, datum) in op.get("row", {}).items():
+                col_type = self._column(table, str(column))
+                if not col_type.mutable:
+                    raise TransactError("constraint violation",
+                                        "column %s is not mutable" % column)
+                values[str(column)] = col_type.from_json(datum, named)
+            for row_uuid in uuids:
+                self._update(table, row_uuid, values)
+            return {"count": len(uuids)}
+
+        if kind == "mutate":
+            for row_uuid in uuids:
+                row = self.tables[table][row_uuid]
+                values = {}
+                for mutation in op.get("mutations", []):
+                    values[str(mutation[0])] = self._mutate(table, dict(row, **values),
+                                                            mutation, named)
+                self._update(table, row_uuid, values)
+            return {"count": len(uuids)}
+
+        if kind == "delete":
+            for row_uuid in uuids:
+                self._put(table, row_uuid, None)
+            return {"count": len(uuids)}
+
+        if kind == "wait":
+            # There are no other clients to wait for: the condition either
+            # holds now or the wait times out.
+            columns = [str(c) for c in op.get("columns", [])]
+            col_types = [self._column(table, c) for c in columns]
+            rows = self.tables[table]
+            current = sorted(tuple(t.canonical(rows[u][c]) for (c, t) in zip(columns, col_types))
+                             for u in uuids)
+            expected = sorted(tuple(t.canonical(t.from_json(row[c], named))
+                                    for (c, t) in zip(columns, col_types))
+                              for row in op.get("rows", []))
+            if (current == expected) != (op.get("until") == "=="):
+                raise TransactError("timed out", "wait on %s timed out" % table)
+            return {}
+
+        raise TransactError("unknown operation", str(kind))
+
+    def transact(self, operations):
+        """Run a "transact" request; returns its result array."""
+        results = []
+        self.dirty = {}
+        try:
+            named = {}
+            try:
+                for op in operations:
+                    if op.get("op") == "insert" and "uuid-name" in op:
+                        if op["uuid-name"] in named:
+                            raise TransactError("duplicate uuid-name", op["uuid-name"])
+                        named[op["uuid-name"]] = str(uuid.uuid4())
+                for op in operations:
+                    results.append(self._operation(op, named))
+            except TransactError, e:
+                self._rollback()
+                results.append(e.result())
+                return results + [None] * (len(operations) - len(results))
+
+            try:
+                self._collect_garbage()
+                self._check_integrity()
+            except TransactError, e:
+                self._rollback()
+                return results + [e.result()]
+        except:
+            if self.dirty is not None:
+                self._rollback()
+            raise
+
+        self._commit()
+        return results
+
+    def monitor(self, requests, send):
+        """Register send(updates) for changes to the tables in requests;
+        returns the initial contents and the registration."""
+        tables = {}
+        for (table, table_requests) in requests.items():
+            table = str(table)
+            if table not in self.tables:
+                raise TransactError("unknown table", table)
+            if isinstance(table_requests, dict):
+                table_requests = [table_requests]
+            columns = []
+            for request in table_requests:
+                columns += [str(c) for c in request.get("columns") or COLUMNS[table].keys()
+                            if str(c) not in columns]
+            for column in columns:
+                self._column(table, column)
+            tables[table] = columns
+
+        registration = (tables, send)
+        self.monitors.append(registration)
+        initial = {}
+        for (table, columns) in tables.items():
+            rows = self.tables[table]
+            if rows:
+                initial[table] = dict((u, {"new": self.row_to_json(table, row, columns)})
+                                      for (u, row) in rows.items())
+        return (initial, registration)
+
+    # What the ovs-vsctl commands the agent runs do; to be run within
+    # change().
+
+    def _new_port(self, port_name, iface_type=""):
+        if self.find("Port", port_name):
+            raise ValueError("a port named %s already exists" % port_name)
+        iface = self._insert("Interface", {"name": port_name, "type": iface_type})
+        return self._insert("Port", {"name": port_name, "interfaces": [iface]})
+
+    def add_bridge(self, br_name):
+        if self.find("Bridge", br_name):
+            raise ValueError("a bridge named %s already exists" % br_name)
+        port = self._new_port(br_name, "internal")
+        bridge = self._insert("Bridge", {"name": br_name, "ports": [port]})
+        root = self.tables["Open_vSwitch"][self.root]
+        self._update("Open_vSwitch", self.root, {"bridges": root["bridges"] + [bridge]})
+
+    def del_bridge(self, br_name, if_exists=False):
+        bridge = self.find("Bridge", br_name)
+        if bridge is None:
+            if if_exists:
+                return
+            raise ValueError("no bridge named " + br_name)
+        # Its ports and interfaces are garbage collected with it.
+        root = self.tables["Open_vSwitch"][self.root]
+        self._update("Open_vSwitch", self.root,
+                     {"bridges": [b for b in root["bridges"] if b != bridge]})
+
+    def add_port(self, br_name, port_name):
+        bridge = self.find("Bridge", br_name)
+        if bridge is None:
+            raise ValueError("no bridge named " + br_name)
+        port = self._new_port(port_name)
+        self._update("Bridge", bridge, {"ports": self.tables["Bridge"][bridge]["ports"] + [port]})
+
+    def del_port(self, br_name, port_name, if_exists=False):
+        bridge = self.find("Bridge", br_name)
+        port = self.find("Port", port_name)
+        if bridge is None or port not in self.tables["Bridge"][bridge]["ports"]:
+            if if_exists:
+                return
+            raise ValueError("no port named %s on bridge %s" % (port_name, br_name))
+        self._update("Bridge", bridge,
+                     {"ports": [p for p in self.tables["Bridge"][bridge]["ports"] if p != port]})
+
+    def set(self, table, record, column, text):
+        # text as given to "ovs-vsctl set"; None clears the column.
+        row_uuid = self.find(table, record)
+        if row_uuid is None:
+            raise ValueError("no row %s in table %s" % (record, table))
+        col_type = COLUMNS[table][column]
+        if text is None:
+            if col_type.is_scalar():
+                raise ValueError("cannot clear column %s" % column)
+            value = col_type.default()
+        else:
+            value = col_type.from_text(text)
+        self._update(table, row_uuid, {column: value})
+
+    def list(self, table, columns):
+        # As "ovs-vsctl --format=json list" prints it.
+        return json.dumps({"headings": columns,
+                           "data": [[COLUMNS[table][c].to_json(row[c]) for c in columns]
+                                    for row in self.tables[table].values()]})
+
+
+class FakeOVSDBServer(object):
+    """Serves a FakeOVS over RFC 7047 JSON-RPC, one thread per connection."""
+
+    def __init__(self, host):
+        self.host = host
+        self.ovs = host.ovs
+
+    def connect(self):
+        """Returns a socket connected to a new session with the server."""
+        (server_sock, client_sock) = socket.socketpair()
+        thread = threading.Thread(target=self._serve, args=(server_sock,))
+        thread.daemon = True
+        thread.start()
+        return client_sock
+
+    def _serve(self, sock):
+        send_lock = threading.Lock()
+
+        def send(msg):
+            with send_lock:
+                sock.sendall(json.dumps(msg))
+
+        monitors = {}
+        decoder = json.JSONDecoder()
+        buf = ""
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while True:
+                    buf = buf.lstrip()
+                    try:
+                        (msg, end) = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    if msg.get("method") is not None:
+                        self._handle(msg, send, monitors)
+        except socket.error:
+            pass
+        finally:
+            with self.host.lock:
+                for registration in monitors.values():
+                    self.ovs.monitors.remove(registration)
+            sock.close()
+
+    def _handle(self, msg, send, monitors):
+        (method, params, msg_id) = (msg["method"], msg.get("params") or [], msg.get("id"))
+        if msg_id is None:
+            # A notification; none are expected from clients.
+            return
+
+        def reply(result=None, error=None):
+            send({"id": msg_id, "result": result, "error": error})
+
+        if method == "echo":
+            return reply(params)
+        if method == "list_dbs":
+            return reply([SCHEMA["name"]])
+        if method == "monitor_cancel":
+            with self.host.lock:
+                registration = monitors.pop(json.dumps(params[0]), None)
+                if registration is None:
+                    return reply(error={"error": "unknown monitor"})
+                self.ovs.monitors.remove(registration)
+            return reply({})
+        if not params or params[0] != SCHEMA["name"]:
+            return reply(error={"error": "unknown database", "details": str(params[:1])})
+
+        with self.host.lock:
+            try:
+                if method == "get_schema":
+                    return reply(SCHEMA)
+                if method == "transact":
+                    self.host._count("ovsdb")
+                    return reply(self.ovs.transact(params[1:]))
+                if method == "monitor":
+                    (monitor_id, requests) = (params[1], params[2])
+                    if json.dumps(monitor_id) in monitors:
+                        return reply(error={"error": "duplicate monitor ID"})
+                    sender = lambda updates: send({"method": "update", "id": None,
+                                                   "params": [monitor_id, updates]})
+                    (initial, registration) = self.ovs.monitor(requests, sender)
+                    monitors[json.dumps(monitor_id)] = registration
+                    # Sent before any update, which needs the lock.
+                    return reply(initial)
+            except TransactError, e:
+                return reply(error=e.result())
+
+        reply(error={"error": "unknown method", "details": method})
+
+
+class FakeOVSDBClient(OVSDB_Client):
+    """An OVSDB_Client connected to a FakeOVSDBServer instead of a socket path."""
+
+    def __init__(self, server):
+        OVSDB_Client.__init__(self, "fake:")
+        self.server = server
+
+    def _open(self):
+        sock = self.server.connect()
+        sock.settimeout(self.timeout + 1)
+        return sock
+
+
+class FakeHost(object):
+
+    def __init__(self, root):
+        # The host's links are also written out under root, as the kernel
+        # shows them in /sys/class/net and /proc/net/vlan/config.
+        self.sys_class_net = os.path.join(root, "sys", "class", "net")
+        self.proc_net_vlan_config = os.path.join(root, "proc", "net", "vlan", "config")
+        for path in (self.sys_class_net, os.path.dirname(self.proc_net_vlan_config)):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        # name -> {"index", "address", "flags", "mtu", "parent", "vlan"}
+        self.links = {}
+        self.next_index = 1
+        for name in HOST_LINKS:
+            self.add_link(name, flags=netlink.IFF_UP)
+        self.write_vlan_config()
+        self.ovs = FakeOVS(self)
+        self.ovsdb_server = FakeOVSDBServer(self)
+        self.lock = threading.Lock()
+        # Commands run, by program name; rtnetlink counts requests sent.
+        self.commands = {}
+
+    def count(self):
+        return sum(self.commands.values())
+
+    def _count(self, program):
+        self.commands[program] = self.commands.get(program, 0) + 1
+
+    def write_link(self, name):
+        link = self.links[name]
+        path = os.path.join(self.sys_class_net, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        for (attr, value) in (("address", link["address"]),
+                              ("operstate", link["flags"] & netlink.IFF_UP and "up" or "down"),
+                              ("mtu", link["mtu"])):
+            f = open(os.path.join(path, attr), "w")
+            try:
+                f.write("%s\n" % value)
+            finally:
+                f.close()
+
+    def write_vlan_config(self):
+        lines = ["VLAN Dev name\t | VLAN ID",
+                 "Name-Type: VLAN_NAME_TYPE_RAW_PLUS_VID_NO_PAD"]
+        for (name, link) in sorted(self.links.items()):
+            if link["vlan"] is not None:
+                lines.append("%-15s| %d  | %s" % (name, link["vlan"], link["parent"]))
+        f = open(self.proc_net_vlan_config, "w")
+        try:
+            f.write("\n".join(lines) + "\n")
+        finally:
+            f.close()
+
+    def add_link(self, name, parent=None, vlan=None, flags=0):
+        index = self.next_index
+        self.next_index += 1
+        self.links[name] = {"index": index, "flags": flags, "mtu": 1500,
+                            "address": "52:54:00:%02x:%02x:%02x" %
+                            ((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff),
+                            "parent": parent, "vlan": vlan}
+        self.write_link(name)
+        if vlan is not None:
+            self.write_vlan_config()
+
+    def del_link(self, name):
+        link = self.links.pop(name)
+        shutil.rmtree(os.path.join(self.sys_class_net, name), ignore_errors=True)
+        if link["vlan"] is not None:
+            self.write_vlan_config()
+
+    def link_by_index(self, index):
+        for (name, link) in self.links.items():
+            if link["index"] == index:
+                return name
+        return None
+
+    def execute(self, args):
+        """Stands in for RootHelper.execute; returns (returncode, stdout)."""
+        with self.lock:
+            program = os.path.basename(args[0])
+            self._count(program)
+            try:
+                if program == "ovs-vsctl":
+                    return (0, self._vsctl(args[1:]))
+                if program == "ip":
+                    return (self._ip(args[1:]), "")
+            except (ValueError, KeyError, IndexError), e:
+                return (1, str(e))
+            return (127, "")
+
+    def _vsctl(self, args):
+        # Global options, then commands separated by "--".
+        while args and args[0].startswith("--") and args[0] != "--":
+            args = args[1:]
+
+        commands = [[]]
+        for arg in args:
+            if arg == "--":
+                commands.append([])
+            else:
+                commands[-1].append(arg)
+
+        # Like a real OVSDB transaction: all commands or none.
+        return self.ovs.change(self._vsctl_commands, commands)
+
+    def _vsctl_commands(self, commands):
+        output = []
+        for command in commands:
+            options = [a for a in command if a.startswith("--")]
+            words = [a for a in command if not a.startswith("--")]
+            if not words:
+                continue
+            (verb, cmd_args) = (words[0], words[1:])
+            if_exists = "--if-exists" in options
+
+            if verb == "list":
+                columns = None
+                for option in options:
+                    if option.startswith("--columns="):
+                        columns = option[len("--columns="):].split(",")
+                output.append(self.ovs.list(cmd_args[0], columns or ["_uuid", "name"]))
+            elif verb == "add-br":
+                self.ovs.add_bridge(cmd_args[0])
+            elif verb == "del-br":
+                self.ovs.del_bridge(cmd_args[0], if_exists)
+            elif verb == "add-port":
+                self.ovs.add_port(cmd_args[0], cmd_args[1])
+            elif verb == "del-port":
+                self.ovs.del_port(cmd_args[0], cmd_args[1], if_exists)
+            elif verb == "set":
+                (column, value) = cmd_args[2].split("=", 1)
+                self.ovs.set(cmd_args[0], cmd_args[1], column, value)
+            elif verb == "clear":
+                self.ovs.set(cmd_args[0], cmd_args[1], cmd_args[2], None)
+            else:
+                raise ValueError("unsupported ovs-vsctl command: " + verb)
+
+        return "\n".join(output) + (output and "\n" or "")
+
+
+    def _ip(self, args):
+        # The "ip link" commands of links.ip_command; returns the exit
+        # code, 1 for a missing device and 2 for an error from the kernel.
+        if args[:2] == ["link", "add"]:
+            (parent, name, vlan) = (args[3], args[5], int(args[9]))
+            if name in self.links:
+                return 2
+            if parent not in self.links:
+                return 1
+            self.add_link(name, parent, vlan)
+            return 0
+
+        name = args[args[1] == "set" and 3 or 2]
+        if name not in self.links:
+            return 1
+        if args[1] == "delete":
+            self.del_link(name)
+            return 0
+
+        link = self.links[name]
+        options = args[4:]
+        while options:
+            if options[0] in ("up", "down"):
+                link["flags"] &= ~netlink.IFF_UP
+                if options[0] == "up":
+                    link["flags"] |= netlink.IFF_UP
+                options = options[1:]
+            else:
+                link["mtu"] = int(options[1])
+                options = options[2:]
+        self.write_link(name)
+        return 0
+
+
+class FakeRtnlSocket(object):
+
+    def __init__(self, host):
+        self.host = host
+        self.replies = []
+
+    def close(self):
+        pass
+
+    def send(self, data):
+        with self.host.lock:
+            self.host._count("rtnetlink")
+            for (msg_type, flags, seq, body) in netlink.parse_messages(data):
+                header = netlink.NLMSGHDR.pack(netlink.NLMSGHDR.size + len(body),
+                                               msg_type, flags, seq, 0)
+                try:
+                    (code, reply) = self._handle(msg_type, flags, body)
+                except (struct.error, KeyError, ValueError):
+                    (code, reply) = (errno.EINVAL, None)
+                if reply is not None:
+                    self.replies.append(netlink.pack_message(netlink.RTM_NEWLINK, 0, seq, reply))
+                self.replies.append(netlink.pack_message(netlink.NLMSG_ERROR, 0, seq,
+                                                         netlink.NLMSGERR.pack(-code) + header))
+        return len(data)
+
+    def recv(self, bufsize):
+        data = "".join(self.replies)
+        self.replies = []
+        return data
+
+    def _handle(self, msg_type, flags, body):
+        # Returns (error code, RTM_NEWLINK reply body or None).
+        (family, dev_type, index, ifi_flags, change) = netlink.IFINFOMSG.unpack_from(body)
+        attrs = netlink.parse_attrs(body[netlink.IFINFOMSG.size:])
+        name = attrs[netlink.IFLA_IFNAME].rstrip("\0")
+        links = self.host.links
+
+        if msg_type == netlink.RTM_GETLINK:
+            if name not in links:
+                return (errno.ENODEV, None)
+            link = links[name]
+            return (0, netlink.ifinfo(link["index"], link["flags"]) +
+                    netlink.pack_attr(netlink.IFLA_IFNAME, name + "\0"))
+
+        if msg_type == netlink.RTM_DELLINK:
+            if name not in links:
+                return (errno.ENODEV, None)
+            self.host.del_link(name)
+            return (0, None)
+
+        if msg_type != netlink.RTM_NEWLINK:
+            return (errno.EOPNOTSUPP, None)
+
+        if name in links:
+            if flags & netlink.NLM_F_EXCL:
+                return (errno.EEXIST, None)
+            link = links[name]
+            link["flags"] = (link["flags"] & ~change) | (ifi_flags & change)
+            if netlink.IFLA_MTU in attrs:
+                link["mtu"] = struct.unpack("=I", attrs[netlink.IFLA_MTU])[0]
+            self.host.write_link(name)
+            return (0, None)
+
+        if not flags & netlink.NLM_F_CREATE:
+            return (errno.ENODEV, None)
+        info = netlink.parse_attrs(attrs[netlink.IFLA_LINKINFO])
+        if info[netlink.IFLA_INFO_KIND].rstrip("\0") != "vlan":
+            return (errno.EOPNOTSUPP, None)
+        parent = self.host.link_by_index(struct.unpack("=I", attrs[netlink.IFLA_LINK])[0])
+        if parent is None:
+            return (errno.ENODEV, None)
+        vlan_data = netlink.parse_attrs(info[netlink.IFLA_INFO_DATA])
+        vlan = struct.unpack("=H", vlan_data[netlink.IFLA_VLAN_ID])[0]
+        self.host.add_link(name, parent, vlan, ifi_flags & change)
+        return (0, None)
+
+
+_DEV_RE = re.compile(r"<target dev='([^']*)'")
+_MAC_RE = re.compile(r"<mac address='([^']*)'")
+_BRIDGE_RE = re.compile(r"<source bridge='([^']*)'")
+
+
+class FakeDomain(object):
+
+    def __init__(self, host, name, dom_id):
+        self.host = host
+        self._name = name
+        self._uuid = str(uuid.uuid4())
+        # -1 while not running
+        self._id = dom_id
+        # target dev -> (mac, bridge)
+        self.interfaces = {}
+
+    def name(self):
+        return self._name
+
+    def UUIDString(self):
+        return self._uuid
+
+    def ID(self):
+        return self._id
+
+    def isActive(self):
+        return True
+
+    def XMLDesc(self, flags):
+        ifaces = "".join("<interface type='bridge'><mac address='%s'/>"
+                         "<source bridge='%s'/><target dev='%s'/>"
+                         "<model type='virtio'/></interface>" % (mac, bridge, dev)
+                         for (dev, (mac, bridge)) in sorted(self.interfaces.items()))
+        return ("<domain type='kvm'><name>%s</name><uuid>%s</uuid>"
+                "<devices>%s</devices></domain>" % (self._name, self._uuid, ifaces))
+
+    def attachDeviceFlags(self, xml, flags):
+        dev = _DEV_RE.search(xml).group(1)
+        bridge = _BRIDGE_RE.search(xml).group(1)
+        with self.host.lock:
+            self.host.add_link(dev)
+            self.host.ovs.change(self.host.ovs.add_port, bridge, dev)
+        self.interfaces[dev] = (_MAC_RE.search(xml).group(1), bridge)
+
+    def detachDeviceFlags(self, xml, flags):
+        mac = _MAC_RE.search(xml).group(1)
+        for (dev, (dev_mac, bridge)) in self.interfaces.items():
+            if dev_mac == mac:
+                with self.host.lock:
+                    self.host.ovs.change(self.host.ovs.del_port, bridge, dev, True)
+                    self.host.del_link(dev)
+                del self.interfaces[dev]
+
+
+class FakeConnection(object):
+
+    def __init__(self, host, domain_names):
+        self.domains = dict((name, FakeDomain(host, name, dom_id + 1))
+                            for (dom_id, name) in enumerate(domain_names))
+
+    def isAlive(self):
+        return True
+
+    def close(self):
+        pass
+
+    def listAllDomains(self, flags):
+        return self.domains.values()
+
+    def lookupByName(self, name):
+        return self.domains.get(name)
@@ -0,0 +1,175 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import ConfigParser
+import shutil
+import tempfile
+import threading
+import unittest
+
+import libvirt
+
+from quantum.plugins.neuca.agent import actuation
+from quantum.plugins.neuca.agent import neuca_quantum_agent as agent_module
+from quantum.plugins.neuca.agent.libvirt_connection import LibvirtConnection
+from quantum.plugins.neuca.agent.links import LinkManager
+from quantum.plugins.neuca.agent.ovs_network import OVS_Network
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+from quantum.plugins.neuca.tests import fakes
+
+
+class ActuationPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ran = []
+        self.lock = threading.Lock()
+
+    def step(self, name, fail=False):
+        def run():
+            with self.lock:
+                self.ran.append(name)
+            if fail:
+                raise actuation.ActuationError(str(name) + " failed")
+        return run
+
+    def check_failed_requirement(self, workers):
+        plan = actuation.ActuationPlan()
+        bridge = plan.add(actuation.CREATE_BRIDGE, "br-1", self.step("br-1", fail=True))
+        port1 = plan.add(actuation.CREATE_PORT, "port-1", self.step("port-1"),
+                         after=[bridge], domain="vm-1")
+        # Only waits for port-1, being on the same domain.
+        port2 = plan.add(actuation.DESTROY_PORT, "port-2", self.step("port-2"), domain="vm-1")
+        other = plan.add(actuation.CREATE_BRIDGE, "br-2", self.step("br-2"))
+        port3 = plan.add(actuation.CREATE_PORT, "port-3", self.step("port-3"),
+                         after=[other, None], domain="vm-2")
+
+        self.assertEqual(actuation.run_plan(plan, workers), 2)
+        self.assertEqual(sorted(self.ran), ["br-1", "br-2", "port-2", "port-3"])
+        self.assertTrue(bridge.failed and not bridge.skipped)
+        self.assertTrue(port1.failed and port1.skipped)
+        self.assertFalse(port2.failed or port3.failed)
+
+    def test_failed_requirement_serial(self):
+        self.check_failed_requirement(1)
+
+    def test_failed_requirement_parallel(self):
+        self.check_failed_requirement(4)
+
+    def test_domain_order(self):
+        plan = actuation.ActuationPlan()
+        for i in range(20):
+            plan.add(actuation.CREATE_PORT, "port-%d" % i, self.step(i), domain="vm-1")
+        self.assertEqual(actuation.run_plan(plan, 4), 0)
+        self.assertEqual(self.ran, range(20))
+
+    def test_empty_plan(self):
+        self.assertEqual(actuation.run_plan(actuation.ActuationPlan(), 4), 0)
+
+
+class FailingDomain(fakes.FakeDomain):
+
+    def attachDeviceFlags(self, xml, flags):
+        raise libvirt.libvirtError("attach failed")
+
+
+class BridgeActuationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        self.saved = (RootHelper.__dict__["execute"], LinkManager.mode, LinkManager.netlink,
+                      OVS_Network.ovsdb, LibvirtConnection.conn,
+                      getattr(agent_module, "config", None))
+        self.execute = self.host.execute
+        RootHelper.execute = classmethod(lambda cls, args: self.execute(args))
+        LinkManager.set_netlink(fakes.FakeRtnlSocket(self.host))
+        OVS_Network.ovsdb = None
+        self.conn = fakes.FakeConnection(self.host, ["instance-1"])
+        LibvirtConnection.conn = self.conn
+
+        config = ConfigParser.ConfigParser()
+        config.add_section("NEUCA")
+        config.set("NEUCA", "integration-bridge", "br-int")
+        agent_module.config = config
+        # plan_changes needs nothing of an agent that was set up.
+        self.agent = agent_module.NEUCAQuantumAgent.__new__(agent_module.NEUCAQuantumAgent)
+
+    def tearDown(self):
+        (RootHelper.execute, LinkManager.mode, LinkManager.netlink,
+         OVS_Network.ovsdb, LibvirtConnection.conn, agent_module.config) = self.saved
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def bridge(self, vm_ids):
+        bridge = agent_module.NEUCABridge("br-data-100", "data", "100", "eth1", None, None)
+        for (i, vm_id) in enumerate(vm_ids):
+            bridge.add_port(agent_module.NEUCAPort("port-%d" % i, "vif-%d" % i,
+                                                   "fe:16:3e:00:00:%02x" % i, bridge,
+                                                   "iface-%d" % i, vm_id))
+        return bridge
+
+    def run_changes(self, old_bridges, new_bridges):
+        txn = OVS_Network.transaction(independent=True)
+        plan = self.agent.plan_changes(old_bridges, new_bridges, txn)
+        failed = actuation.run_plan(plan, 4)
+        self.assertTrue(txn.commit())
+        return (plan, failed)
+
+    def test_create_and_destroy(self):
+        bridge = self.bridge(["instance-1", "instance-1"])
+        (plan, failed) = self.run_changes({}, {"br-data-100": bridge})
+        self.assertEqual((len(plan), failed), (3, 0))
+        self.assertTrue("eth1.100" in self.host.links)
+        self.assertEqual(sorted(self.conn.domains["instance-1"].interfaces), ["vif-0", "vif-1"])
+
+        (plan, failed) = self.run_changes({"br-data-100": bridge}, {})
+        self.assertEqual((len(plan), failed), (3, 0))
+        self.assertFalse("eth1.100" in self.host.links)
+        self.assertEqual(self.conn.domains["instance-1"].interfaces, {})
+
+    def test_failed_bridge_skips_its_ports(self):
+        def execute(args):
+            if "add-br" in args:
+                return (1, "")
+            return self.host.execute(args)
+
+        self.execute = execute
+        (plan, failed) = self.run_changes({}, {"br-data-100": self.bridge(["instance-1"] * 2)})
+        self.assertEqual(failed, 3)
+        for task in plan.tasks:
+            self.assertEqual(task.skipped, task.action == actuation.CREATE_PORT)
+        self.assertEqual(self.conn.domains["instance-1"].interfaces, {})
+
+    def test_failed_vlan_iface_skips_its_ports(self):
+        bridge = agent_module.NEUCABridge("br-data-100", "data", "100", "eth9", None, None)
+        bridge.add_port(agent_module.NEUCAPort("port-0", "vif-0", "fe:16:3e:00:00:00",
+                                               bridge, "iface-0", "instance-1"))
+        (plan, failed) = self.run_changes({}, {"br-data-100": bridge})
+        self.assertEqual(failed, 2)
+        self.assertEqual(self.host.ovs.tables["Bridge"], {})
+
+    def test_failed_attach(self):
+        self.conn.domains["instance-1"] = FailingDomain(self.host, "instance-1", 1)
+        # A domain that is gone has no interfaces to attach.
+        (plan, failed) = self.run_changes({}, {"br-data-100": self.bridge(["instance-1",
+                                                                         "instance-2"])})
+        self.assertEqual(failed, 1)
+        failed_tasks = [task.name for task in plan.tasks if task.failed]
+        self.assertEqual(failed_tasks, [actuation.CREATE_PORT + " port-0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
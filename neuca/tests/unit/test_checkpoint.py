@@ -0,0 +1,76 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from quantum.plugins.neuca.agent import checkpoint
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.path = os.path.join(self.root, "lib", "agent-state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_save_and_load(self):
+        state = {"bridges": {"br-eth1-100": {"vlan_tag": "100", "ports": []}}, "key": None}
+        checkpoint.save(self.path, state)
+        loaded = checkpoint.load(self.path)
+        self.assertEqual(loaded, dict(state, version=checkpoint.FORMAT_VERSION))
+        # Nothing is left behind but the checkpoint itself.
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["agent-state.json"])
+
+    def test_save_replaces(self):
+        checkpoint.save(self.path, {"key": 1})
+        checkpoint.save(self.path, {"key": 2})
+        self.assertEqual(checkpoint.load(self.path)["key"], 2)
+
+    def test_missing(self):
+        self.assertEqual(checkpoint.load(self.path), None)
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        f = open(self.path, "w")
+        f.write('{"key": ')
+        f.close()
+        self.assertEqual(checkpoint.load(self.path), None)
+
+    def test_other_version(self):
+        checkpoint.save(self.path, {"key": 1})
+        old_version = checkpoint.FORMAT_VERSION
+        checkpoint.FORMAT_VERSION = old_version + 1
+        try:
+            self.assertEqual(checkpoint.load(self.path), None)
+        finally:
+            checkpoint.FORMAT_VERSION = old_version
+
+    def test_failed_save_keeps_old(self):
+        checkpoint.save(self.path, {"key": 1})
+        # Not serializable as JSON.
+        self.assertRaises(TypeError, checkpoint.save, self.path, {"key": object()})
+        self.assertEqual(checkpoint.load(self.path)["key"], 1)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["agent-state.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
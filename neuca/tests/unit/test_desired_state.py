@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import ConfigParser
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, MetaData
+
+from quantum.plugins.neuca.agent import neuca_quantum_agent as agent_module
+from quantum.plugins.neuca.agent import metrics
+from quantum.plugins.neuca.agent.links import LinkManager
+from quantum.plugins.neuca.tests import benchmark
+
+
+NUM_VMS = 3
+
+
+class DesiredStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.handlers = logging.getLogger('').handlers[:]
+        self.saved = (LinkManager.mode, LinkManager.netlink,
+                      agent_module.NEUCABridge.domain_names)
+
+        db_url = "sqlite:///" + os.path.join(self.root, "neuca.db")
+        self.engine = create_engine(db_url)
+        self.meta = MetaData()
+        self.tables = benchmark.define_tables(self.meta)
+        self.meta.create_all(self.engine)
+        config_file = os.path.join(self.root, "neuca_quantum_plugin.ini")
+        benchmark.write_config(config_file, db_url, os.path.join(self.root, "log"), 1, "")
+        config = ConfigParser.ConfigParser()
+        config.read(config_file)
+        # Links are not touched here.
+        config.set("AGENT", "link_manager", "ip")
+        f = open(config_file, "w")
+        config.write(f)
+        f.close()
+
+        self.agent = agent_module.NEUCAQuantumAgent(config_file)
+        benchmark.forget_state(self.agent)
+        agent_module.NEUCAQuantumAgent.desired_state_time = 0
+        agent_module.NEUCABridge.domain_names = [benchmark.vm_name(i) for i in range(NUM_VMS)]
+        benchmark.seed(self.engine, self.meta, self.tables, NUM_VMS, 2, 2)
+
+    def tearDown(self):
+        benchmark.forget_state(self.agent)
+        self.agent.db.session.close()
+        (LinkManager.mode, LinkManager.netlink,
+         agent_module.NEUCABridge.domain_names) = self.saved
+        for handler in logging.getLogger('').handlers[:]:
+            if handler not in self.handlers:
+                logging.getLogger('').removeHandler(handler)
+                handler.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self):
+        # The desired state, and the number of database queries it took.
+        queries = benchmark.counter_value(metrics.DB_QUERIES)
+        bridges = self.agent._NEUCAQuantumAgent__read_bridge_info_from_db(self.agent.db)
+        return (bridges, benchmark.counter_value(metrics.DB_QUERIES) - queries)
+
+    def num_ports(self, bridges):
+        return sum(len(bridge.ports) for bridge in bridges.values())
+
+    def bump(self, scope):
+        conn = self.engine.connect()
+        try:
+            generation = self.meta.tables['neuca_generation']
+            if conn.execute(generation.update(generation.c.scope == scope),
+                            {'generation': 100}).rowcount == 0:
+                conn.execute(generation.insert(), {'scope': scope, 'generation': 100})
+        finally:
+            conn.close()
+
+    def test_reuse(self):
+        (bridges, queries) = self.read()
+        self.assertEqual(self.num_ports(bridges), NUM_VMS * 2)
+
+        # Only the generations are read again.
+        (again, queries) = self.read()
+        self.assertTrue(again is bridges)
+        self.assertEqual(queries, 1)
+
+    def test_reload_on_bump(self):
+        (bridges, queries) = self.read()
+        for scope in (agent_module.ALL_INSTANCES, benchmark.vm_name(1)):
+            self.bump(scope)
+            (again, queries) = self.read()
+            self.assertFalse(again is bridges)
+            self.assertTrue(self.read()[0] is again)
+            bridges = again
+
+        # After ports are deleted, which bumps the generation.
+        benchmark.delete_ports(self.engine, self.meta, self.tables)
+        self.assertEqual(self.read()[0], {})
+
+    def test_reload_on_other_instances(self):
+        (bridges, queries) = self.read()
+        agent_module.NEUCABridge.domain_names = [benchmark.vm_name(0)]
+        (again, queries) = self.read()
+        self.assertEqual(self.num_ports(again), 2)
+
+    def test_reload_when_old(self):
+        (bridges, queries) = self.read()
+        agent_module.NEUCAQuantumAgent.desired_state_time -= agent_module.DESIRED_STATE_MAX_AGE
+        self.assertFalse(self.read()[0] is bridges)
+
+    def test_read_generations(self):
+        # As polled in event driven mode.
+        generations = self.agent.read_generations()
+        self.assertEqual(self.agent.read_generations(), generations)
+        self.bump(benchmark.vm_name(2))
+        self.assertNotEqual(self.agent.read_generations(), generations)
+
+        agent_module.NEUCABridge.domain_names = None
+        self.assertEqual(self.agent.read_generations(), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+from quantum.plugins.neuca.agent import events
+from quantum.plugins.neuca.tests import fakes
+
+
+class EventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = events.EVENT_SETTLE_INTERVAL
+        events.EVENT_SETTLE_INTERVAL = 0
+        self.trigger = events.ReconcileTrigger()
+
+    def tearDown(self):
+        events.EVENT_SETTLE_INTERVAL = self.saved
+
+    def wait_for(self, reason, timeout=5):
+        # The reasons seen until reason comes up; fails if it does not.
+        seen = []
+        while reason not in seen:
+            reasons = self.trigger.wait(timeout)
+            self.assertTrue(reasons, "no %s event within %ds" % (reason, timeout))
+            seen += reasons
+        return seen
+
+
+class ReconcileTriggerTest(EventsTestCase):
+
+    def test_wait(self):
+        self.trigger.notify("libvirt:instance-1")
+        self.trigger.notify("ovsdb")
+        self.assertEqual(self.trigger.wait(1), ["libvirt:instance-1", "ovsdb"])
+        self.assertEqual(self.trigger.wait(0.05), [])
+
+    def test_notify_from_thread(self):
+        t = threading.Timer(0.05, self.trigger.notify, ("db",))
+        t.start()
+        self.assertEqual(self.trigger.wait(5), ["db"])
+        t.join()
+
+
+class GenerationPollSourceTest(EventsTestCase):
+
+    def test_changes(self):
+        values = [None, 1, 1, 2, 2, None, 2, 3]
+        lock = threading.Lock()
+
+        def read():
+            with lock:
+                if len(values) > 1:
+                    return values.pop(0)
+                return values[0]
+
+        source = events.GenerationPollSource(self.trigger, read, 0.01)
+        source.start()
+        try:
+            # 1 is the first value read, and None means unknown.
+            self.assertEqual(self.wait_for("db"), ["db"])
+            self.assertEqual(self.wait_for("db"), ["db"])
+            self.assertEqual(self.trigger.wait(0.1), [])
+        finally:
+            source.stop()
+
+    def test_read_errors(self):
+        def read():
+            raise Exception("database is gone")
+
+        source = events.GenerationPollSource(self.trigger, read, 0.01)
+        source.start()
+        try:
+            self.assertEqual(self.trigger.wait(0.1), [])
+            self.assertTrue(source.thread.isAlive())
+        finally:
+            source.stop()
+
+
+class OVSDBMonitorSourceTest(EventsTestCase):
+
+    def setUp(self):
+        EventsTestCase.setUp(self)
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        self.client = fakes.FakeOVSDBClient(self.host.ovsdb_server)
+        self.client.run_batch([("add-br", [], ["br0"]), ("add-port", [], ["br0", "vif-1"])])
+        self.source = events.OVSDBMonitorSource(self.trigger, "fake",
+                                                fakes.FakeOVSDBClient(self.host.ovsdb_server))
+
+    def tearDown(self):
+        self.source.stop()
+        self.client.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+        EventsTestCase.tearDown(self)
+
+    def test_changes(self):
+        self.source.start()
+        self.wait_for("ovsdb:monitor")
+
+        self.client.run_batch([("add-port", [], ["br0", "vif-2"])])
+        self.wait_for("ovsdb")
+
+        # QoS set by someone else has to be undone.
+        self.client.run_batch([("set", [], ["Interface", "vif-1", "ingress_policing_rate", "1000"])])
+        self.wait_for("ovsdb")
+
+        self.client.run_batch([("set", [], ["Interface", "vif-1", "options", "{key=flow}"])])
+        self.assertEqual(self.trigger.wait(0.2), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import errno
+import shutil
+import tempfile
+import unittest
+
+from quantum.plugins.neuca.agent.links import LinkManager, LINK_MANAGER_IP
+from quantum.plugins.neuca.agent.root_helper import RootHelper
+from quantum.plugins.neuca.tests import fakes
+
+
+# The same operations fail the same way over netlink and with "ip".
+FAILING_OPS = [({"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+                errno.EEXIST),
+               ({"op": "add_vlan", "name": "eth9.100", "parent": "eth9", "vlan": 100},
+                errno.ENODEV),
+               ({"op": "delete", "name": "eth1.200"}, errno.ENODEV),
+               ({"op": "set", "name": "eth1.200", "up": True}, errno.ENODEV)]
+
+
+class LinkManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        self.saved = (LinkManager.mode, LinkManager.netlink, LinkManager.sys_class_net,
+                      RootHelper.__dict__["execute"])
+        host = self.host
+        RootHelper.execute = classmethod(lambda cls, args: host.execute(args))
+        LinkManager.sys_class_net = self.host.sys_class_net
+
+    def tearDown(self):
+        (LinkManager.mode, LinkManager.netlink, LinkManager.sys_class_net,
+         RootHelper.execute) = self.saved
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def use_ip(self):
+        LinkManager.mode = LINK_MANAGER_IP
+        LinkManager.netlink = None
+
+    def use_netlink(self):
+        LinkManager.set_netlink(fakes.FakeRtnlSocket(self.host))
+
+    def check_batches(self):
+        batch = LinkManager.batch().add_vlan("eth1", 100).set("eth1.100", up=True, mtu=9000)
+        self.assertTrue(batch.commit())
+        link = self.host.links["eth1.100"]
+        self.assertEqual((link["parent"], link["vlan"], link["mtu"]), ("eth1", 100, 9000))
+
+        # The VLAN interface being there already, or gone already, is fine.
+        self.assertTrue(LinkManager.batch().add_vlan("eth1", 100).commit())
+        self.assertTrue(LinkManager.delete_link("eth1.100"))
+        self.assertTrue(LinkManager.delete_link("eth1.100"))
+        self.assertFalse("eth1.100" in self.host.links)
+
+        # Unless the caller says otherwise.
+        LinkManager.batch().add_vlan("eth1", 100).commit()
+        self.assertFalse(LinkManager.batch().add_vlan("eth1", 100, may_exist=False).commit())
+        self.assertFalse(LinkManager.batch().delete("eth1.200", if_exists=False).commit())
+
+    def check_errors(self):
+        LinkManager.batch().add_vlan("eth1", 100).commit()
+        self.assertEqual(LinkManager.apply([op for (op, code) in FAILING_OPS]),
+                         [code for (op, code) in FAILING_OPS])
+
+    def test_ip_batches(self):
+        self.use_ip()
+        self.check_batches()
+        self.assertTrue(self.host.commands["ip"] > 0)
+
+    def test_ip_errors(self):
+        self.use_ip()
+        self.check_errors()
+
+    def test_netlink_batches(self):
+        self.use_netlink()
+        self.check_batches()
+        self.assertFalse("ip" in self.host.commands)
+
+    def test_netlink_errors(self):
+        self.use_netlink()
+        self.check_errors()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import errno
+import shutil
+import struct
+import tempfile
+import unittest
+
+from quantum.plugins.neuca.agent import netlink
+from quantum.plugins.neuca.tests import fakes
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_attrs_are_aligned(self):
+        data = netlink.pack_attr(netlink.IFLA_IFNAME, "eth1\0") + \
+            netlink.pack_attr(netlink.IFLA_MTU, struct.pack("=I", 9000))
+        # 4 byte header, 5 bytes of name padded to 8, then 4 + 4.
+        self.assertEqual(len(data), 12 + 8)
+        attrs = netlink.parse_attrs(data)
+        self.assertEqual(attrs[netlink.IFLA_IFNAME], "eth1\0")
+        self.assertEqual(struct.unpack("=I", attrs[netlink.IFLA_MTU])[0], 9000)
+
+    def test_nested_attrs(self):
+        info = netlink.pack_attr(netlink.IFLA_INFO_KIND, "vlan") + \
+            netlink.pack_attr(netlink.IFLA_INFO_DATA,
+                              netlink.pack_attr(netlink.IFLA_VLAN_ID, struct.pack("=H", 100)))
+        attrs = netlink.parse_attrs(netlink.pack_attr(netlink.IFLA_LINKINFO, info))
+        info = netlink.parse_attrs(attrs[netlink.IFLA_LINKINFO])
+        self.assertEqual(info[netlink.IFLA_INFO_KIND], "vlan")
+        vlan = netlink.parse_attrs(info[netlink.IFLA_INFO_DATA])[netlink.IFLA_VLAN_ID]
+        self.assertEqual(struct.unpack("=H", vlan)[0], 100)
+
+    def test_messages(self):
+        body = netlink.ifinfo(index=3, flags=netlink.IFF_UP, change=netlink.IFF_UP)
+        data = netlink.pack_message(netlink.RTM_NEWLINK, netlink.NLM_F_REQUEST, 7, body) + \
+            netlink.pack_message(netlink.RTM_DELLINK, 0, 8, body + "\1")
+        messages = netlink.parse_messages(data)
+        self.assertEqual([(t, f, s) for (t, f, s, b) in messages],
+                         [(netlink.RTM_NEWLINK, netlink.NLM_F_REQUEST, 7),
+                          (netlink.RTM_DELLINK, 0, 8)])
+        self.assertEqual(messages[0][3], body)
+        self.assertEqual(netlink.IFINFOMSG.unpack_from(messages[0][3])[1:4],
+                         (0, 3, netlink.IFF_UP))
+
+    def test_truncated(self):
+        self.assertEqual(netlink.parse_attrs("\x02\x00"), {})
+        self.assertEqual(netlink.parse_messages("\x00" * 8), [])
+
+    def test_unknown_op(self):
+        sock = netlink.NetlinkSocket(object())
+        self.assertRaises(netlink.NetlinkError, sock.apply, [{"op": "rename", "name": "x"}])
+
+
+class NetlinkSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        self.sock = netlink.NetlinkSocket(fakes.FakeRtnlSocket(self.host))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_apply(self):
+        codes = self.sock.apply([
+            {"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+            {"op": "set", "name": "eth1.100", "up": True, "mtu": 9000},
+            {"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+            {"op": "add_vlan", "name": "eth9.100", "parent": "eth9", "vlan": 100},
+            {"op": "delete", "name": "eth1.200"}])
+        self.assertEqual(codes, [0, 0, errno.EEXIST, errno.ENODEV, errno.ENODEV])
+
+        link = self.host.links["eth1.100"]
+        self.assertEqual((link["parent"], link["vlan"], link["mtu"]), ("eth1", 100, 9000))
+        self.assertTrue(link["flags"] & netlink.IFF_UP)
+        self.assertEqual(self.sock.link_indexes(["eth1", "eth1.100", "eth9"]),
+                         {"eth1": self.host.links["eth1"]["index"],
+                          "eth1.100": link["index"]})
+
+        self.assertEqual(self.sock.apply([{"op": "delete", "name": "eth1.100"}]), [0])
+        self.assertFalse("eth1.100" in self.host.links)
+
+    def test_large_batch(self):
+        ops = [{"op": "add_vlan", "name": "eth1.%d" % vlan, "parent": "eth1", "vlan": vlan}
+               for vlan in range(1, 2 * netlink.MAX_BATCH + 2)]
+        self.assertEqual(self.sock.apply(ops), [0] * len(ops))
+        self.assertEqual(len([l for l in self.host.links.values() if l["vlan"]]), len(ops))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import unittest
+
+from sqlalchemy.orm import exc
+
+from quantum.db import api as db
+from quantum.plugins.neuca import neuca_db
+from quantum.plugins.neuca import neuca_models
+
+
+ALL_INSTANCES = neuca_models.ALL_INSTANCES
+
+
+class NeucaDBTest(unittest.TestCase):
+
+    def setUp(self):
+        db.configure_db({'sql_connection': 'sqlite:///:memory:'})
+
+    def tearDown(self):
+        db.clear_db()
+
+    def generations(self):
+        gen = neuca_models.neuca_generation
+        return dict(db.get_session().query(gen.scope, gen.generation).all())
+
+    def test_transaction_commits_together(self):
+        with neuca_db.transaction() as session:
+            neuca_db.add_network_properties('net-1', 'vlan', 'data', 100, 0, 0, session=session)
+            neuca_db.add_network_properties('net-2', 'vlan', 'data', 101, 0, 0, session=session)
+            neuca_db.add_port_properties('port-1', 'fe:16:3e:00:00:01', 'vm-1', session=session)
+            neuca_db.add_port_properties('port-2', 'fe:16:3e:00:00:02', 'vm-1', session=session)
+            # Not bumped until the transaction commits.
+            self.assertEqual(self.generations(), {})
+
+        self.assertEqual(len(neuca_db.get_network_properties()), 2)
+        self.assertEqual(len(neuca_db.get_port_properties()), 2)
+        # Once per scope.
+        self.assertEqual(self.generations(), {ALL_INSTANCES: 1, 'vm-1': 1})
+
+    def test_transaction_rolls_back_together(self):
+        def write():
+            with neuca_db.transaction() as session:
+                neuca_db.add_network_properties('net-1', 'vlan', 'data', 100, 0, 0,
+                                                session=session)
+                neuca_db.add_port_properties('port-1', 'fe:16:3e:00:00:01', 'vm-1',
+                                             session=session)
+                raise ValueError("failed half way")
+
+        self.assertRaises(ValueError, write)
+        self.assertEqual(neuca_db.get_network_properties(), [])
+        self.assertEqual(neuca_db.get_port_properties(), [])
+        self.assertEqual(self.generations(), {})
+
+    def test_own_transaction(self):
+        neuca_db.add_network_properties('net-1', 'vlan', 'data', 100, 0, 0)
+        neuca_db.add_network_properties('net-2', 'vlan', 'data', 101, 0, 0)
+        self.assertEqual(self.generations(), {ALL_INSTANCES: 2})
+        neuca_db.remove_network_properties('net-1')
+        self.assertEqual(neuca_db.get_network_properties(),
+                         [('net-2', 'vlan', 'data', 101, 0, 0)])
+        self.assertEqual(self.generations(), {ALL_INSTANCES: 3})
+
+    def test_bulk_inserts(self):
+        neuca_db.add_network_properties_bulk([('net-1', 'vlan', 'data', 100, 0, 0),
+                                              ('net-2', 'vlan', 'storage', 100, 1000, 10)])
+        neuca_db.add_port_properties_bulk([('port-1', 'fe:16:3e:00:00:01', 'vm-1'),
+                                           ('port-2', 'fe:16:3e:00:00:02', 'vm-1'),
+                                           ('port-3', None, None)])
+        self.assertEqual(sorted(neuca_db.get_network_properties()),
+                         [('net-1', 'vlan', 'data', 100, 0, 0),
+                          ('net-2', 'vlan', 'storage', 100, 1000, 10)])
+        self.assertEqual(sorted(neuca_db.get_port_properties()),
+                         [('port-1', 'fe:16:3e:00:00:01', 'vm-1'),
+                          ('port-2', 'fe:16:3e:00:00:02', 'vm-1'),
+                          ('port-3', None, None)])
+        self.assertEqual(self.generations(), {ALL_INSTANCES: 1, 'vm-1': 1})
+
+        # Nothing to insert, nothing bumped.
+        neuca_db.add_port_properties_bulk([])
+        self.assertEqual(self.generations(), {ALL_INSTANCES: 1, 'vm-1': 1})
+
+    def test_update_iface_bulk(self):
+        neuca_db.add_port_properties_bulk([('port-1', 'fe:16:3e:00:00:01', 'vm-1'),
+                                           ('port-2', None, None)])
+        neuca_db.update_port_properties_iface_bulk([('port-1', 'vm-2', 'fe:16:3e:00:00:03'),
+                                                    ('port-2', 'vm-3', 'fe:16:3e:00:00:04')])
+        self.assertEqual(sorted(neuca_db.get_port_properties()),
+                         [('port-1', 'fe:16:3e:00:00:03', 'vm-2'),
+                          ('port-2', 'fe:16:3e:00:00:04', 'vm-3')])
+        # The instance the port moved away from changed as well.
+        self.assertEqual(self.generations(), {'vm-1': 2, 'vm-2': 1, 'vm-3': 1})
+
+    def test_update_iface_bulk_missing_port(self):
+        neuca_db.add_port_properties('port-1', 'fe:16:3e:00:00:01', 'vm-1')
+        self.assertRaises(exc.NoResultFound, neuca_db.update_port_properties_iface_bulk,
+                          [('port-1', 'vm-2', 'fe:16:3e:00:00:02'),
+                           ('port-2', 'vm-2', 'fe:16:3e:00:00:03')])
+        self.assertEqual(neuca_db.get_port_properties(),
+                         [('port-1', 'fe:16:3e:00:00:01', 'vm-1')])
+        self.assertEqual(self.generations(), {'vm-1': 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
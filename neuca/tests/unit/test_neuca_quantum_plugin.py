@@ -0,0 +1,144 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from quantum.common import exceptions as q_exc
+from quantum.db import api as db
+from quantum.db import models
+from quantum.plugins.neuca import neuca_db
+from quantum.plugins.neuca.neuca_quantum_plugin import NEUCAQuantumPlugin
+
+
+TENANT_ID = 'neuca'
+
+
+class PluginTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        path = os.path.join(self.root, "neuca_quantum_plugin.ini")
+        f = open(path, "w")
+        f.write("[DATABASE]\nsql_connection = sqlite:///:memory:\n"
+                "[NEUCA]\nneuca_tenant_id = %s\n"
+                "[VLAN_RANGES]\ndata = 10:19\n" % TENANT_ID)
+        f.close()
+        self.plugin = NEUCAQuantumPlugin(path)
+        self.net_id = self.plugin.create_network(TENANT_ID, 'vlan:data:auto')['net-id']
+
+    def tearDown(self):
+        db.clear_db()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def port_states(self):
+        port = models.Port
+        return sorted(state for (state,) in
+                      db.get_session().query(port.state).filter_by(network_id=self.net_id))
+
+
+class CreatePortTest(PluginTestCase):
+
+    def test_states(self):
+        self.assertEqual(self.plugin.create_port(TENANT_ID, self.net_id)['port-state'], 'DOWN')
+        self.assertEqual(self.plugin.create_port(TENANT_ID, self.net_id, 'ACTIVE')['port-state'],
+                         'ACTIVE')
+        self.assertEqual(len(neuca_db.get_port_properties()), 2)
+
+    def test_invalid_state(self):
+        self.assertRaises(q_exc.StateInvalid, self.plugin.create_port,
+                          TENANT_ID, self.net_id, 'UP')
+        self.assertEqual(self.port_states(), [])
+        self.assertEqual(neuca_db.get_port_properties(), [])
+
+    def test_missing_network(self):
+        self.assertRaises(q_exc.NetworkNotFound, self.plugin.create_port,
+                          TENANT_ID, 'no-such-network')
+        self.assertRaises(q_exc.NetworkNotFound, self.plugin.create_port,
+                          'other', self.net_id)
+
+
+
+class CreatePortsTest(PluginTestCase):
+
+    def test_create_ports(self):
+        ports = self.plugin.create_ports(TENANT_ID, [(self.net_id, None, 'vm-1.fe:16:3e:00:00:01'),
+                                                     (self.net_id, 'ACTIVE', None)])
+        self.assertEqual([port['attachment'] for port in ports],
+                         ['vm-1.fe:16:3e:00:00:01', None])
+        self.assertEqual(self.port_states(), ['ACTIVE', 'DOWN'])
+        self.assertEqual(sorted((mac, vm_id) for (port_id, mac, vm_id)
+                                in neuca_db.get_port_properties()),
+                         [(None, None), ('fe:16:3e:00:00:01', 'vm-1')])
+
+    def test_invalid_state(self):
+        self.assertRaises(q_exc.StateInvalid, self.plugin.create_ports, TENANT_ID,
+                          [(self.net_id, 'ACTIVE', None), (self.net_id, 'UP', None)])
+        self.assertEqual(self.port_states(), [])
+        self.assertEqual(neuca_db.get_port_properties(), [])
+
+    def test_already_attached(self):
+        iface_id = 'vm-1.fe:16:3e:00:00:01'
+        self.assertRaises(q_exc.AlreadyAttached, self.plugin.create_ports, TENANT_ID,
+                          [(self.net_id, None, iface_id), (self.net_id, None, iface_id)])
+        self.assertEqual(self.port_states(), [])
+
+        self.plugin.create_ports(TENANT_ID, [(self.net_id, None, iface_id)])
+        self.assertRaises(q_exc.AlreadyAttached, self.plugin.create_ports, TENANT_ID,
+                          [(self.net_id, None, 'vm-2.fe:16:3e:00:00:02'),
+                           (self.net_id, None, iface_id)])
+        self.assertEqual(self.port_states(), ['DOWN'])
+
+    def test_missing_network(self):
+        self.assertRaises(q_exc.NetworkNotFound, self.plugin.create_ports, TENANT_ID,
+                          [(self.net_id, None, None), ('no-such-network', None, None)])
+        self.assertEqual(self.port_states(), [])
+
+
+class CreateNetworksAndPortsTest(PluginTestCase):
+
+    def test_create(self):
+        (nets, ports) = self.plugin.create_networks_and_ports(
+            TENANT_ID, ['vlan:data:auto', 'vlan:data:100'],
+            [(0, 'ACTIVE', 'vm-1.fe:16:3e:00:00:01'),
+             (1, None, 'vm-1.fe:16:3e:00:00:02'),
+             (self.net_id, None, 'vm-2.fe:16:3e:00:00:03')])
+        self.assertEqual([port['net-id'] for port in ports],
+                         [nets[0]['net-id'], nets[1]['net-id'], self.net_id])
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([10, 11, 100]))
+        self.assertEqual(len(neuca_db.get_port_properties()), 3)
+
+    def test_all_or_nothing(self):
+        for ports in ([(0, None, None), (1, 'UP', None)],
+                      [(0, None, None), (2, None, None)],
+                      [(0, None, 'vm-1.fe:16:3e:00:00:01'), (1, None, 'vm-1.fe:16:3e:00:00:01')]):
+            self.assertRaises(q_exc.QuantumException, self.plugin.create_networks_and_ports,
+                              TENANT_ID, ['vlan:data:auto', 'vlan:data:auto'], ports)
+            self.assertEqual(len(self.plugin.get_all_networks(TENANT_ID)), 1)
+            self.assertEqual(neuca_db.get_used_vlans('data'), set([10]))
+            self.assertEqual(neuca_db.get_port_properties(), [])
+
+        # The VLANs picked for the networks rolled back are free again.
+        (nets, ports) = self.plugin.create_networks_and_ports(TENANT_ID, ['vlan:data:auto'],
+                                                              [(0, None, None)])
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([10, 11]))
+
+
+if __name__ == "__main__":
+    unittest.main()
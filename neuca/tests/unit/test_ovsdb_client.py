@@ -0,0 +1,188 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import shutil
+import tempfile
+import unittest
+
+from quantum.plugins.neuca.tests import fakes
+from quantum.plugins.neuca.agent.ovsdb_client import (OVSDBError, name_or_uuid,
+                                                      to_ovsdb, to_python)
+
+
+class DatumTest(unittest.TestCase):
+
+    def test_to_python(self):
+        self.assertEqual(to_python(["map", [["a", 1], ["b", ["uuid", "u1"]]]]),
+                         {"a": 1, "b": "u1"})
+        self.assertEqual(to_python(["set", [1, 2]]), [1, 2])
+        self.assertEqual(to_python(["set", []]), [])
+        self.assertEqual(to_python(["named-uuid", "row0"]), "row0")
+        self.assertEqual(to_python(u"eth0"), "eth0")
+        self.assertEqual(to_python(7), 7)
+
+    def test_to_ovsdb(self):
+        self.assertEqual(to_ovsdb({"b": 2, "a": 1}), ["map", [["a", 1], ["b", 2]]])
+        self.assertEqual(to_ovsdb([1, 2]), ["set", [1, 2]])
+        self.assertEqual(to_ovsdb("br0"), "br0")
+
+    def test_name_or_uuid(self):
+        self.assertEqual(name_or_uuid("br0"), [["name", "==", "br0"]])
+        uuid = "6c4ac6f2-0c5a-4b8e-8a8c-3b2d1f0e9a7b"
+        self.assertEqual(name_or_uuid(uuid), [["_uuid", "==", ["uuid", uuid]]])
+
+
+class OVSDBClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        self.client = fakes.FakeOVSDBClient(self.host.ovsdb_server)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def bridges(self):
+        # bridge name -> sorted port names, as the fake OVS has them
+        ovs = self.host.ovs
+        ports = ovs.tables["Port"]
+        return dict((bridge["name"], sorted(ports[p]["name"] for p in bridge["ports"]))
+                    for bridge in ovs.tables["Bridge"].values())
+
+    def test_parse_value(self):
+        self.assertEqual(self.client.parse_value("Interface", "ingress_policing_rate", "1000"),
+                         1000)
+        self.assertEqual(self.client.parse_value("Port", "tag", "10"), ["set", [10]])
+        self.assertEqual(self.client.parse_value("Port", "tag", "[]"), ["set", []])
+        self.assertEqual(self.client.parse_value("Interface", "options",
+                                                 '{remote_ip="10.0.0.1", in_key=flow}'),
+                         ["map", [["remote_ip", "10.0.0.1"], ["in_key", "flow"]]])
+        self.assertEqual(self.client.empty_value("Interface", "options"), ["map", []])
+        self.assertEqual(self.client.empty_value("Port", "tag"), ["set", []])
+        self.assertRaises(OVSDBError, self.client.column_type, "Port", "no_such_column")
+
+    def test_run_batch(self):
+        self.client.run_batch([("add-br", [], ["br0"]),
+                               ("add-port", [], ["br0", "eth1.100"]),
+                               ("set", [], ["Interface", "eth1.100",
+                                            "ingress_policing_rate", "1000"])])
+        self.assertEqual(self.bridges(), {"br0": ["br0", "eth1.100"]})
+        self.assertTrue("br0" in self.host.links)
+        self.assertEqual(self.client.list_ports("br0"), ["eth1.100"])
+        self.assertEqual(self.client.get_column("Interface", "eth1.100",
+                                                "ingress_policing_rate"), 1000)
+        # ovs-vswitchd caught up with the configuration.
+        root = self.client.select("Open_vSwitch", [], ["next_cfg", "cur_cfg"])[0]
+        self.assertEqual(root["cur_cfg"], root["next_cfg"])
+
+        self.client.run_batch([("del-port", ["--if-exists"], ["br0", "eth1.100"]),
+                               ("del-port", ["--if-exists"], ["br0", "vif-missing"])])
+        self.assertEqual(self.bridges(), {"br0": ["br0"]})
+        self.assertEqual(self.host.ovs.tables["Interface"].keys(),
+                         [self.host.ovs.find("Interface", "br0")])
+
+        self.client.run_batch([("del-br", [], ["br0"])])
+        self.assertEqual(self.bridges(), {})
+        self.assertFalse("br0" in self.host.links)
+        self.assertEqual(self.host.ovs.tables["Port"], {})
+
+    def test_run_batch_is_atomic(self):
+        self.client.run_batch([("add-br", [], ["br0"])])
+        self.assertRaises(OVSDBError, self.client.run_batch,
+                          [("add-port", [], ["br0", "vif-1"]),
+                           ("set", [], ["Interface", "vif-1", "no_such_column", "1"])])
+        self.assertRaises(OVSDBError, self.client.run_batch,
+                          [("add-port", [], ["br0", "vif-1"]),
+                           ("add-port", [], ["br1", "vif-2"])])
+        self.assertEqual(self.bridges(), {"br0": ["br0"]})
+
+    def test_run_batch_guards_rows_read(self):
+        self.client.run_batch([("add-br", [], ["br0"])])
+        other = fakes.FakeOVSDBClient(self.host.ovsdb_server)
+        transact = self.client.transact
+
+        def racing_transact(operations):
+            # Another client changes br0 right after the batch read it.
+            results = transact(operations)
+            if operations[0]["op"] == "select":
+                other.run_batch([("add-port", [], ["br0", "vif-2"])])
+            return results
+
+        self.client.transact = racing_transact
+        try:
+            self.assertRaises(OVSDBError, self.client.run_batch,
+                              [("add-port", [], ["br0", "vif-1"])])
+        finally:
+            other.close()
+        self.assertEqual(self.bridges(), {"br0": ["br0", "vif-2"]})
+
+    def test_run_batch_set_missing_record(self):
+        self.assertRaises(OVSDBError, self.client.run_batch,
+                          [("set", [], ["Interface", "vif-1", "ingress_policing_rate", "1"])])
+
+    def test_select_tables(self):
+        self.client.run_batch([("add-br", [], ["br0"]), ("add-port", [], ["br0", "vif-1"])])
+        (bridges, ifaces) = self.client.select_tables([("Bridge", ["name", "ports"]),
+                                                       ("Interface", ["name", "ofport"])])
+        self.assertEqual([b["name"] for b in bridges], ["br0"])
+        self.assertEqual(len(bridges[0]["ports"]), 2)
+        self.assertEqual(sorted(i["name"] for i in ifaces), ["br0", "vif-1"])
+        self.assertEqual(sorted(i["ofport"] for i in ifaces), [1, 2])
+
+    def test_transaction_errors(self):
+        # A failing operation undoes the ones before it.
+        self.assertRaises(OVSDBError, self.client.transact, [
+            {"op": "insert", "table": "Interface", "row": {"name": "vif-1"}},
+            {"op": "wait", "timeout": 0, "table": "Bridge", "where": [],
+             "columns": ["name"], "until": "==", "rows": [{"name": "br0"}]}])
+        self.assertEqual(self.host.ovs.tables["Interface"], {})
+
+        # So does a commit that would leave a dangling reference.
+        self.assertRaises(OVSDBError, self.client.transact, [
+            {"op": "insert", "table": "Bridge", "row": {"name": "br0"}, "uuid-name": "br"},
+            {"op": "mutate", "table": "Open_vSwitch", "where": [],
+             "mutations": [["bridges", "insert",
+                            ["set", [["named-uuid", "br"],
+                                     ["uuid", "6c4ac6f2-0c5a-4b8e-8a8c-3b2d1f0e9a7b"]]]]]}])
+        self.assertEqual(self.host.ovs.tables["Bridge"], {})
+
+    def test_monitor(self):
+        self.client.run_batch([("add-br", [], ["br0"])])
+
+        monitor = fakes.FakeOVSDBClient(self.host.ovsdb_server)
+        try:
+            initial = monitor.monitor({"Bridge": {"columns": ["name"]}})
+            self.assertEqual([row["new"]["name"] for row in initial["Bridge"].values()],
+                             ["br0"])
+
+            self.client.run_batch([("add-br", [], ["br1"])])
+            (method, params) = monitor.next_notification(timeout=5)
+            self.assertEqual(method, "update")
+            self.assertEqual(params[0], "neuca")
+            self.assertEqual([row["new"]["name"] for row in params[1]["Bridge"].values()],
+                             ["br1"])
+
+            # Changes to unmonitored columns are not reported.
+            self.client.run_batch([("add-port", [], ["br1", "vif-1"])])
+            self.assertEqual(monitor.next_notification(timeout=0.2), None)
+        finally:
+            monitor.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
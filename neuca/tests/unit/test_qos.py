@@ -0,0 +1,113 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import ConfigParser
+import unittest
+
+from quantum.plugins.neuca.agent import actuation
+from quantum.plugins.neuca.agent import neuca_quantum_agent as agent_module
+
+
+class RecordingTransaction(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def set(self, table, record, column, value):
+        self.commands.append((table, record, column, value))
+        return self
+
+
+def bridge(rate, burst, ovs_iface=None):
+    br = agent_module.NEUCABridge("br-eth1-100", "data", "100", "eth1", rate, burst)
+    port = agent_module.NEUCAPort("vif-1", "vif-1", "fe:16:3e:00:00:01", br, "iface-1",
+                                  "instance-1")
+    port.ovs_iface = ovs_iface
+    br.add_port(port)
+    return br
+
+
+class QoSChangesTest(unittest.TestCase):
+
+    def test_unknown_current(self):
+        port = bridge(1000, 100).ports["vif-1"]
+        self.assertEqual(port.qos_changes(),
+                         [("ingress_policing_rate", 1000), ("ingress_policing_burst", 100)])
+
+    def test_changes(self):
+        port = bridge("1000", 0).ports["vif-1"]
+        # Values from the database are strings or ints; OVS has ints.
+        self.assertEqual(port.qos_changes({"ingress_policing_rate": 1000,
+                                           "ingress_policing_burst": 0}), [])
+        self.assertEqual(port.qos_changes({"ingress_policing_rate": 500,
+                                           "ingress_policing_burst": 0}),
+                         [("ingress_policing_rate", "1000")])
+        # Columns not read are set.
+        self.assertEqual(port.qos_changes({"ingress_policing_rate": 1000}),
+                         [("ingress_policing_burst", 0)])
+
+    def test_unset(self):
+        port = bridge(None, None).ports["vif-1"]
+        self.assertEqual(port.qos_changes({}), [])
+
+    def test_update(self):
+        port = bridge(1000, 100).ports["vif-1"]
+        txn = RecordingTransaction()
+        port.update(txn, {"ingress_policing_rate": 1000, "ingress_policing_burst": 10})
+        self.assertEqual(txn.commands,
+                         [("Interface", "vif-1", "ingress_policing_burst", 100)])
+
+
+class PlanQoSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = getattr(agent_module, "config", None)
+        config = ConfigParser.ConfigParser()
+        config.add_section("NEUCA")
+        config.set("NEUCA", "integration-bridge", "br-int")
+        agent_module.config = config
+        self.agent = agent_module.NEUCAQuantumAgent.__new__(agent_module.NEUCAQuantumAgent)
+
+    def tearDown(self):
+        agent_module.config = self.saved
+
+    def plan(self, current, rate, burst):
+        old = bridge(None, None, current)
+        new = bridge(rate, burst)
+        txn = RecordingTransaction()
+        plan = self.agent.plan_changes({old.br_name: old}, {new.br_name: new}, txn)
+        actuation.run_plan(plan, 1)
+        return ([task.action for task in plan.tasks], txn.commands)
+
+    def test_unchanged(self):
+        current = {"ingress_policing_rate": 1000, "ingress_policing_burst": 100}
+        self.assertEqual(self.plan(current, 1000, 100), ([], []))
+
+    def test_changed(self):
+        current = {"ingress_policing_rate": 1000, "ingress_policing_burst": 100}
+        self.assertEqual(self.plan(current, 2000, 100),
+                         ([actuation.UPDATE_PORT],
+                          [("Interface", "vif-1", "ingress_policing_rate", 2000)]))
+
+    def test_not_read_from_ovs(self):
+        (actions, commands) = self.plan(None, 1000, 100)
+        self.assertEqual(actions, [actuation.UPDATE_PORT])
+        self.assertEqual(len(commands), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
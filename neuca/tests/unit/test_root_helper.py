@@ -0,0 +1,108 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import json
+import socket
+import threading
+import unittest
+
+from quantum.plugins.neuca.agent.root_helper import (RootHelper, RootHelperError,
+                                                     RootHelperRequestNotRun,
+                                                     RootwrapDaemonClient)
+
+
+class SocketDaemonClient(RootwrapDaemonClient):
+    # Talks to serve(request line) over a socketpair instead of a daemon.
+
+    def __init__(self, serve):
+        RootwrapDaemonClient.__init__(self, "neuca-rootwrap --daemon")
+        self.serve = serve
+        self.requests = []
+
+    def _connection(self):
+        if getattr(self.local, "sock", None) is None:
+            (self.local.sock, server) = socket.socketpair()
+            self.local.reader = self.local.sock.makefile("rb")
+            t = threading.Thread(target=self._serve, args=(server,))
+            t.daemon = True
+            t.start()
+        return (self.local.sock, self.local.reader)
+
+    def _serve(self, server):
+        line = server.makefile("rb").readline()
+        self.requests.append(json.loads(line))
+        reply = self.serve(line)
+        if reply is not None:
+            server.sendall(reply)
+        server.close()
+
+
+class UnreachableDaemonClient(RootwrapDaemonClient):
+
+    def __init__(self):
+        RootwrapDaemonClient.__init__(self, "neuca-rootwrap --daemon")
+
+    def _connection(self):
+        raise socket.error("connection refused")
+
+
+class RootHelperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (RootHelper.root_helper, RootHelper.daemon)
+        # Runs the fallback command unprivileged.
+        RootHelper.root_helper = "env"
+
+    def tearDown(self):
+        (RootHelper.root_helper, RootHelper.daemon) = self.saved
+
+    def test_daemon_reply(self):
+        RootHelper.daemon = SocketDaemonClient(
+            lambda line: json.dumps({"returncode": 0, "stdout": "ok\n"}) + "\n")
+        self.assertEqual(RootHelper.execute(["ovs-vsctl", "show"]), (0, "ok\n"))
+        self.assertEqual(RootHelper.daemon.requests, [{"cmd": ["ovs-vsctl", "show"]}])
+
+    def test_unreachable_daemon_falls_back(self):
+        RootHelper.daemon = UnreachableDaemonClient()
+        self.assertEqual(RootHelper.execute(["echo", "fallback"]), (0, "fallback\n"))
+
+    def test_lost_reply_is_not_run_again(self):
+        # The daemon got the command, but no reply came back.
+        RootHelper.daemon = SocketDaemonClient(lambda line: None)
+        self.assertRaises(RootHelperError, RootHelper.execute, ["echo", "twice"])
+        self.assertEqual(len(RootHelper.daemon.requests), 1)
+
+    def test_malformed_reply_is_not_run_again(self):
+        RootHelper.daemon = SocketDaemonClient(lambda line: "{}\n")
+        try:
+            RootHelper.execute(["echo", "twice"])
+            self.fail("RootHelperError not raised")
+        except RootHelperRequestNotRun:
+            self.fail("a request that reached the daemon was reported as not run")
+        except RootHelperError:
+            pass
+
+    def test_refused_link_changes(self):
+        client = SocketDaemonClient(
+            lambda line: json.dumps({"returncode": 99, "stdout": "",
+                                     "stderr": "Unauthorized"}) + "\n")
+        self.assertRaises(RootHelperRequestNotRun, client.apply_links,
+                          [{"op": "delete", "name": "eth0"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from quantum.plugins.neuca import rootwrap_daemon
+from quantum.plugins.neuca.tests import fakes
+from quantum.plugins.neuca.agent import netlink
+
+
+def match_ip(filters, userargs):
+    # Stands in for quantum.rootwrap.wrapper.match_filter.
+    return userargs[0] in filters
+
+
+class LinkFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.link_filter = rootwrap_daemon.LinkFilter(["eth1"])
+
+    def test_managed_links(self):
+        for op in [{"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+                   {"op": "set", "name": "eth1.100", "up": True},
+                   {"op": "set", "name": "br-eth1-100", "up": True},
+                   {"op": "set", "name": "vif-3b2d1f0e9a7", "up": True},
+                   {"op": "delete", "name": "eth1.100"}]:
+            self.assertTrue(self.link_filter.allowed(op), op)
+
+    def test_other_links(self):
+        for op in [{"op": "add_vlan", "name": "eth0.100", "parent": "eth0", "vlan": 100},
+                   {"op": "add_vlan", "name": "eth1.200", "parent": "eth1", "vlan": 100},
+                   {"op": "set", "name": "eth0", "up": False},
+                   {"op": "set", "name": "eth0.100", "up": False},
+                   {"op": "set", "name": "br-eth0-100", "up": False},
+                   {"op": "delete", "name": "eth1"},
+                   {"op": "delete", "name": "vif-3b2d1f0e9a7"},
+                   {"op": "set", "name": ["eth1.100"]},
+                   {"op": "rename", "name": "eth1.100"}]:
+            self.assertFalse(self.link_filter.allowed(op), op)
+
+    def test_managed_ifaces(self):
+        root = tempfile.mkdtemp(prefix="neuca-test-")
+        try:
+            path = os.path.join(root, "neuca_quantum_plugin.ini")
+            f = open(path, "w")
+            f.write("[NETWORKS]\ndata = eth1\nstorage = eth2\n")
+            f.close()
+            self.assertEqual(rootwrap_daemon.managed_ifaces(path), set(["eth1", "eth2"]))
+            self.assertEqual(rootwrap_daemon.managed_ifaces(os.path.join(root, "none")), set())
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+class ApplyLinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        self.host = fakes.FakeHost(self.root)
+        rootwrap_daemon._netlink = netlink.NetlinkSocket(fakes.FakeRtnlSocket(self.host))
+        self.link_filter = rootwrap_daemon.LinkFilter(["eth1"])
+
+    def tearDown(self):
+        rootwrap_daemon._netlink = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def apply(self, ops, filters=("ip",)):
+        return rootwrap_daemon.apply_links(ops, filters, match_ip, self.link_filter)
+
+    def test_apply(self):
+        reply = self.apply([{"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+                            {"op": "set", "name": "eth1.100", "up": True}])
+        self.assertEqual((reply["returncode"], reply["results"]), (0, [0, 0]))
+        self.assertTrue("eth1.100" in self.host.links)
+
+    def test_refused_as_a_whole(self):
+        reply = self.apply([{"op": "add_vlan", "name": "eth1.100", "parent": "eth1", "vlan": 100},
+                            {"op": "set", "name": "eth0", "up": False}])
+        self.assertEqual(reply["returncode"], rootwrap_daemon.RC_UNAUTHORIZED)
+        self.assertFalse("eth1.100" in self.host.links)
+
+    def test_filters_apply(self):
+        # Without "ip" in the filters, link changes are not allowed either.
+        reply = self.apply([{"op": "set", "name": "eth1.100", "up": True}], filters=())
+        self.assertEqual(reply["returncode"], rootwrap_daemon.RC_UNAUTHORIZED)
+
+
+if __name__ == "__main__":
+    unittest.main()
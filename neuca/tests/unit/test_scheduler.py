@@ -0,0 +1,59 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import unittest
+
+from quantum.plugins.neuca.agent import scheduler
+
+
+class ReconcileSchedulerTest(unittest.TestCase):
+
+    def test_idle_cycles_back_off_to_max(self):
+        sched = scheduler.ReconcileScheduler(2, 10, jitter=0)
+        intervals = [sched.next_interval(scheduler.CYCLE_IDLE) for i in range(6)]
+        self.assertEqual(intervals, [3.0, 4.5, 6.75, 10.0, 10.0, 10.0])
+
+    def test_change_resets_interval(self):
+        sched = scheduler.ReconcileScheduler(2, 10, jitter=0)
+        for i in range(4):
+            sched.next_interval(scheduler.CYCLE_IDLE)
+        self.assertEqual(sched.next_interval(scheduler.CYCLE_CHANGED), 2.0)
+
+    def test_failures_back_off_exponentially(self):
+        sched = scheduler.ReconcileScheduler(1, 30, jitter=0)
+        intervals = [sched.next_interval(scheduler.CYCLE_FAILED) for i in range(6)]
+        self.assertEqual(intervals, [2.0, 4.0, 8.0, 16.0, 30.0, 30.0])
+        self.assertEqual(sched.next_interval(scheduler.CYCLE_CHANGED), 1.0)
+        self.assertEqual(sched.failures, 0)
+
+    def test_jitter_is_bounded_and_seeded(self):
+        intervals = []
+        for i in range(2):
+            sched = scheduler.ReconcileScheduler(2, 2, jitter=0.2, seed="host-1")
+            intervals.append([sched.next_interval(scheduler.CYCLE_CHANGED) for j in range(50)])
+        self.assertEqual(intervals[0], intervals[1])
+        for interval in intervals[0]:
+            self.assertTrue(1.6 <= interval <= 2.4)
+
+    def test_max_below_min(self):
+        sched = scheduler.ReconcileScheduler(5, 1, jitter=0)
+        self.assertEqual(sched.next_interval(scheduler.CYCLE_IDLE), 5.0)
+        self.assertTrue(0 <= sched.initial_delay() <= 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import unittest
+
+from quantum.plugins.neuca.agent import snapshot
+
+
+class Colliding(object):
+    # Values that all hash alike, but are only equal to themselves.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_equal_values(self):
+        port = snapshot.PortSnapshot("vif-1", "fe:16:3e:00:00:01", "p1", "instance-1")
+        self.assertEqual(snapshot.fingerprint(frozenset([port])),
+                         snapshot.fingerprint(frozenset([port])))
+        self.assertEqual(snapshot.fingerprint("output"), snapshot.fingerprint("out" + "put"))
+        self.assertNotEqual(snapshot.fingerprint("output"), snapshot.fingerprint("outputs"))
+
+    def test_hash_collision(self):
+        a = snapshot.fingerprint(Colliding("a"))
+        b = snapshot.fingerprint(Colliding("b"))
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(a, b)
+        self.assertFalse(a == b)
+
+    def test_in_tuples(self):
+        # As the agent compares the fingerprints of a cycle.
+        fingerprints = ((snapshot.fingerprint("ovs"), None), snapshot.fingerprint(frozenset()))
+        self.assertEqual(fingerprints,
+                         ((snapshot.fingerprint("ovs"), None), snapshot.fingerprint(frozenset())))
+        self.assertNotEqual(fingerprints, None)
+        self.assertNotEqual(snapshot.fingerprint(42), 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
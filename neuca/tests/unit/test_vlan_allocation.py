@@ -0,0 +1,182 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# Copyright (c) 2012 Renaissance Computing Institute except where noted. All rights reserved.
+#
+# This software is distributed under the terms of the Eclipse Public License
+# Version 1.0 found in the file named LICENSE.Eclipse, which was shipped with
+# this distribution. Any use, reproduction or distribution of this software
+# constitutes the recipient's acceptance of the Eclipse license terms. This
+# notice and the full text of the license must be included with any distribution
+# of this software.
+#
+# Renaissance Computing Institute,
+# (A Joint Institute between the University of North Carolina at Chapel Hill,
+# North Carolina State University, and Duke University)
+# http://www.renci.org
+#
+# For questions, comments please contact software@renci.org
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from quantum.db import api as db
+from quantum.plugins.neuca import neuca_db
+from quantum.plugins.neuca.neuca_quantum_plugin import (NEUCAQuantumPlugin, VLANInUse,
+                                                        VLANTaken, VlanAllocator,
+                                                        VlanBitmap, parse_vlan_ranges)
+
+
+class ParseVlanRangesTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parse_vlan_ranges("100:199, 300,"), [(100, 199), (300, 300)])
+        self.assertEqual(parse_vlan_ranges(""), [])
+
+    def test_invalid(self):
+        for value in ("0:10", "10:5", "4000:4095", "a:b"):
+            self.assertRaises(ValueError, parse_vlan_ranges, value)
+
+
+class VlanBitmapTest(unittest.TestCase):
+
+    def test_first_free(self):
+        bitmap = VlanBitmap([(100, 102), (200, 200)])
+        self.assertEqual(bitmap.first_free(), 100)
+        bitmap.set(100)
+        bitmap.set(101)
+        self.assertEqual(bitmap.first_free(), 102)
+        bitmap.set(102)
+        self.assertEqual(bitmap.first_free(), 200)
+        bitmap.set(200)
+        self.assertEqual(bitmap.first_free(), None)
+
+        bitmap.clear(101)
+        self.assertEqual(bitmap.first_free(), 101)
+
+    def test_used_outside_ranges(self):
+        # VLANs taken outside the ranges (e.g. named explicitly) do not
+        # affect allocation.
+        bitmap = VlanBitmap([(10, 11)])
+        bitmap.set(5)
+        bitmap.set(4094)
+        self.assertEqual(bitmap.first_free(), 10)
+
+    def test_full_range(self):
+        bitmap = VlanBitmap([(1, 4094)])
+        for vlan in range(1, 4094):
+            bitmap.set(vlan)
+        self.assertEqual(bitmap.first_free(), 4094)
+
+
+class VlanAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        db.configure_db({'sql_connection': 'sqlite:///:memory:'})
+        self.vlans = VlanAllocator({'default': [(10, 12)]})
+
+    def tearDown(self):
+        db.clear_db()
+
+    def test_acquire(self):
+        self.assertEqual(self.vlans.acquire('data', 'net-1'), 10)
+        self.assertEqual(self.vlans.acquire('data', 'net-2'), 11)
+        self.assertEqual(self.vlans.acquire('storage', 'net-3'), 10)
+        self.vlans.release('net-1')
+        self.assertEqual(self.vlans.acquire('data', 'net-4'), 10)
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([10, 11]))
+
+    def test_acquire_with_other_workers(self):
+        # Each worker has its own allocator, and so its own bitmaps.
+        other = VlanAllocator({'default': [(10, 12)]})
+        self.assertEqual(self.vlans.acquire('data', 'net-1'), 10)
+        self.assertEqual(other.acquire('data', 'net-2'), 11)
+        self.assertEqual(self.vlans.acquire('data', 'net-3'), 12)
+
+    def test_acquire_in_transaction_with_other_workers(self):
+        other = VlanAllocator({'default': [(10, 12)]})
+        self.assertEqual(self.vlans.acquire('data', 'net-1'), 10)
+        self.assertEqual(other.acquire('data', 'net-2'), 11)
+
+        # The transaction that picked the VLAN taken meanwhile is rolled
+        # back, to be started over.
+        def acquire_in_transaction():
+            with neuca_db.transaction() as session:
+                self.vlans.acquire('data', 'net-3', session)
+
+        self.assertRaises(VLANTaken, acquire_in_transaction)
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([10, 11]))
+        self.assertEqual(self.vlans.acquire('data', 'net-3'), 12)
+
+    def test_reserve(self):
+        self.assertTrue(self.vlans.reserve('data', 100, 'net-1'))
+        self.assertFalse(self.vlans.reserve('data', 100, 'net-2'))
+        self.assertTrue(self.vlans.reserve('storage', 100, 'net-2'))
+
+    def test_reserve_in_transaction(self):
+        self.assertTrue(self.vlans.reserve('data', 100, 'net-1'))
+
+        def reserve_in_transaction():
+            with neuca_db.transaction() as session:
+                self.assertTrue(self.vlans.reserve('data', 101, 'net-2', session))
+                if not self.vlans.reserve('data', 100, 'net-2', session):
+                    raise VLANInUse(vlan_id=100, switch_name='data')
+
+        self.assertRaises(VLANInUse, reserve_in_transaction)
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([100]))
+
+    def test_legacy_vlans(self):
+        # Networks created before VLAN allocations were recorded only have
+        # their VLAN in their properties.
+        neuca_db.add_network_properties('net-1', 'vlan', 'data', 100, 0, 0)
+        neuca_db.add_network_properties('net-2', 'vlan', 'data', 10, 0, 0)
+        self.assertFalse(self.vlans.reserve('data', 100, 'net-3'))
+        self.assertEqual(self.vlans.acquire('data', 'net-3'), 11)
+
+
+class CreateNetworksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="neuca-test-")
+        path = os.path.join(self.root, "neuca_quantum_plugin.ini")
+        f = open(path, "w")
+        f.write("[DATABASE]\nsql_connection = sqlite:///:memory:\n"
+                "[NEUCA]\nneuca_tenant_id = neuca\n"
+                "[VLAN_RANGES]\ndata = 10:12\n")
+        f.close()
+        self.plugin = NEUCAQuantumPlugin(path)
+
+    def tearDown(self):
+        db.clear_db()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def vlans(self):
+        return sorted(vlan_tag for (net_id, network_type, switch_name, vlan_tag, rate, burst)
+                      in neuca_db.get_network_properties())
+
+    def test_create_networks(self):
+        nets = self.plugin.create_networks('neuca', ['vlan:data:auto', 'vlan:data:100',
+                                                     'vlan:data:auto:1000'])
+        self.assertEqual(len(nets), 3)
+        self.assertEqual(self.vlans(), [10, 11, 100])
+
+    def test_vlan_in_use(self):
+        self.plugin.create_network('neuca', 'vlan:data:100')
+        self.assertRaises(VLANInUse, self.plugin.create_networks, 'neuca',
+                          ['vlan:data:auto', 'vlan:data:100'])
+        self.assertEqual(self.vlans(), [100])
+        self.assertEqual(neuca_db.get_used_vlans('data'), set([100]))
+        # The VLAN picked in the rolled back transaction is free again.
+        self.plugin.create_network('neuca', 'vlan:data:auto')
+        self.assertEqual(self.vlans(), [10, 100])
+
+    def test_vlan_taken_by_other_worker(self):
+        self.plugin.create_network('neuca', 'vlan:data:auto')
+        VlanAllocator({'default': [(10, 12)]}).acquire('data', 'other')
+        # The second network is created in a new transaction.
+        self.plugin.create_networks('neuca', ['vlan:data:100', 'vlan:data:auto'])
+        self.assertEqual(self.vlans(), [10, 12, 100])
+
+
+if __name__ == "__main__":
+    unittest.main()
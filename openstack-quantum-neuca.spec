@@ -43,10 +43,13 @@ find neuca -name \*.py -exec sed -i '/\/usr\/bin\/env python/d' {} \;
 umask 0022
 mkdir -p %{buildroot}%{python_sitelib}/quantum/plugins/
 cp -R neuca %{buildroot}%{python_sitelib}/quantum/plugins/
+# The unit tests, and the fakes and benchmark that go with them, are not installed
+rm -rf %{buildroot}%{python_sitelib}/quantum/plugins/neuca/tests
 
 # Install execs (using hand-coded rather than generated versions)
 install -p -D -m 755 neuca-agent %{buildroot}%{_bindir}/neuca-agent
 install -p -D -m 755 neuca-rootwrap %{buildroot}%{_bindir}/neuca-rootwrap
+install -p -D -m 755 neuca-db-upgrade %{buildroot}%{_bindir}/neuca-db-upgrade
 
 # Install config
 install -p -D -m 640 neuca_quantum_plugin.ini %{buildroot}%{_sysconfdir}/quantum/plugins/neuca/neuca_quantum_plugin.ini
@@ -61,11 +64,13 @@ install -p -D -m 644 neuca-polkit.pkla %{buildroot}%{_sysconfdir}/polkit-1/local
 install -p -D -m 755 neuca-agent.init %{buildroot}%{_initrddir}/neuca-agent
 
 # Configure agent to use neuca-rootwrap
-sed -i 's/root_helper = sudo/root_helper = sudo neuca-rootwrap/g' %{buildroot}%{_sysconfdir}/quantum/plugins/neuca/neuca_quantum_plugin.ini
+sed -i 's/^root_helper = sudo$/root_helper = sudo neuca-rootwrap/g' %{buildroot}%{_sysconfdir}/quantum/plugins/neuca/neuca_quantum_plugin.ini
+sed -i 's/^root_helper_daemon =$/root_helper_daemon = sudo neuca-rootwrap --daemon/g' %{buildroot}%{_sysconfdir}/quantum/plugins/neuca/neuca_quantum_plugin.ini
 
 # Setup directories
 install -d -m 755 %{buildroot}%{_localstatedir}/log/neuca
 install -d -m 755 %{buildroot}%{_localstatedir}/run/neuca
+install -d -m 755 %{buildroot}%{_localstatedir}/lib/neuca
 
 %post
 if [ $1 -eq 1 ] ; then
@@ -90,6 +95,7 @@ fi
 %doc LICENSE.Eclipse
 %{_bindir}/neuca-agent
 %{_bindir}/neuca-rootwrap
+%{_bindir}/neuca-db-upgrade
 %config(noreplace) %{_sysconfdir}/sudoers.d/neuca
 %{_sysconfdir}/polkit-1/localauthority/50-local.d/50-neuca.pkla
 %{_initrddir}/neuca-agent
@@ -98,6 +104,7 @@ fi
 %config(noreplace) %attr(-, root, quantum) %{_sysconfdir}/quantum/plugins/neuca/*.ini
 %dir %attr(0755, quantum, quantum) %{_localstatedir}/log/neuca
 %dir %attr(0755, quantum, quantum) %{_localstatedir}/run/neuca
+%dir %attr(0755, quantum, quantum) %{_localstatedir}/lib/neuca
 
 %changelog
 * Thu Jul 7 2016 Victor J. Orlikowski <vjo@duke.edu> - 0.2-exogeni3